@@ -1,17 +1,30 @@
+from typing import Optional
 from injector import Binder, singleton, multiprovider, Module, provider, noscope
 
-from custom_log_formatter import CustomLogFormatter
+from compute_executor import ComputeExecutor
+from hashing_embeddings_provider import HashingEmbeddingsProvider
+from jsonl_match_writer import JsonlMatchWriter
+from lexical_matcher import LexicalMatcher
 from main import Main
 from match_writer import MatchWriter
 from matching_engine import MatchingEngine
+from matching_http_server import MatchingHttpServer
+from matching_service import MatchingService
 from matching_strategy import MatchingStrategy
 from matching_strategy_config import MatchingStrategyConfig
+from memory_monitor import MemoryMonitor
+from multi_language_matching_strategy import MultiLanguageMatchingStrategy
 from package_completion_embeddings_provider import PackageCompletionEmbeddingsProvider
+from package_snapshot import PackageSnapshot
 from package_to_skill_matching_filter import PackageToSkillMatchingFilter
+from parquet_match_writer import ParquetMatchWriter
+from queue_logging import QueueLogging
 from skill_completion_embeddings_provider import SkillCompletionEmbeddingsProvider
+from skill_index_store import SkillIndexStore
 from open_ai_api_wrapper import OpenAiApiWrapper
 from open_ai_api_wrapper_config import OpenAiApiWrapperConfig
 from raw_embeddings_provider import RawEmbeddingsProvider
+from sql_match_writer import SqlMatchWriter
 from package import Package
 from skill import Skill
 import logging
@@ -19,25 +32,21 @@ import logging
 
 class AppModule(Module):
     __skills_source_path: str
-    __packages_source_path: str
+    __packages_source_path: Optional[str]
     __output_path: str
     __config_path: str
     __log_level: int
-    __console_logging_formatter: logging.Formatter = CustomLogFormatter()
-    __stream_logging_formatter: logging.Formatter = (
-        logging.Formatter('%(asctime)s - %(levelname)s - %(message)s (%(filename)s:%(lineno)d)'))
-    __file_handler: logging.FileHandler = logging.FileHandler('application_module.log')
-    __console_handler: logging.StreamHandler = logging.StreamHandler()
+    __open_ai_api_wrapper_config: OpenAiApiWrapperConfig
+    __matching_strategy_config: MatchingStrategyConfig
 
-    def __init__(self, skills_source_path: str, packages_source_path: str,
-                 output_path: str, config_path: str, log_level: int = logging.INFO) -> None:
+    def __init__(self, skills_source_path: str, packages_source_path: Optional[str],
+                 output_path: str, config_path: str, log_level: int = logging.INFO, service: bool = False,
+                 memory_budget: Optional[int] = None) -> None:
         if not skills_source_path:
             raise ValueError("skills_source_path is missing or empty")
         if not isinstance(skills_source_path, str):
             raise TypeError("skills_source_path must be a string")
-        if not packages_source_path:
-            raise ValueError("packages_source_path is missing or empty")
-        if not isinstance(packages_source_path, str):
+        if packages_source_path and not isinstance(packages_source_path, str):
             raise TypeError("packages_source_path must be a string")
         if not output_path:
             raise ValueError("output_path is missing or empty")
@@ -51,65 +60,94 @@ class AppModule(Module):
             raise ValueError("log_level is missing or empty")
         if not isinstance(log_level, int):
             raise TypeError("log_level must be an integer")
+        if memory_budget is not None and not isinstance(memory_budget, int):
+            raise TypeError("memory_budget must be an integer")
         self.__skills_source_path = skills_source_path
         self.__packages_source_path = packages_source_path
         self.__output_path = output_path
         self.__config_path = config_path
         self.__log_level = log_level
+        self.__open_ai_api_wrapper_config = OpenAiApiWrapperConfig.read_config(config_path)
+        self.__matching_strategy_config = MatchingStrategyConfig.read_config(config_path, memory_budget)
+        if not packages_source_path and not self.__matching_strategy_config.jobs and not service:
+            raise ValueError("packages_source_path is missing or empty and the config defines no jobs")
         self.configure_logger()
 
     def configure_logger(self):
-        self.__console_handler.setLevel(self.__log_level)
-        self.__console_handler.setFormatter(self.__console_logging_formatter)
-        self.__file_handler.setLevel(logging.INFO)
-        self.__file_handler.setFormatter(self.__stream_logging_formatter)
+        QueueLogging.setup(logging.getLogger(__name__), self.__log_level, self.__matching_strategy_config.log_format,
+                           self.__matching_strategy_config.log_sample_rate)
 
     @provider
     def provide_logger(self) -> logging.Logger:
-        logger = logging.getLogger(__name__)
-        logger.setLevel(self.__log_level)
-        logger.addHandler(self.__console_handler)
-        logger.addHandler(self.__file_handler)
-        return logger
+        # Configured once in configure_logger, every injection gets the same logger
+        return logging.getLogger(__name__)
 
     @multiprovider
     @singleton
     def provide_skills(self) -> dict[int, Skill]:
-        return Skill.read_db(self.__skills_source_path)
+        return Skill.read_db(self.__skills_source_path, self.__matching_strategy_config.skills_filter)
 
     @multiprovider
     @singleton
     def provide_packages(self) -> list[Package]:
         return Package.read_csv(self.__packages_source_path)
 
+    @multiprovider
+    @singleton
+    def provide_matching_jobs(self) -> list[MultiLanguageMatchingStrategy.Job]:
+        jobs, skills = [], {}
+        for job in self.__matching_strategy_config.jobs:
+            job_skills = Skill.read_db(self.__skills_source_path, job.skills_filter)
+            # Skills selected by several jobs are shared, so they are embedded once
+            job_skills = {key: skills.setdefault(key, skill) for key, skill in job_skills.items()}
+            jobs.append(MultiLanguageMatchingStrategy.Job(job.programming_language,
+                                                          job_skills,
+                                                          Package.read_csv(job.packages_path)))
+        return jobs
+
     @provider
     @singleton
     def provide_match_writer(self, matching_strategy_config: MatchingStrategyConfig) -> MatchWriter:
-        return MatchWriter(self.__output_path,
-                           matching_strategy_config)
+        # Any output path without a file scheme is a database URL
+        if self.__output_path.startswith(ParquetMatchWriter.SCHEME):
+            return ParquetMatchWriter(self.__output_path[len(ParquetMatchWriter.SCHEME):],
+                                      matching_strategy_config)
+        if self.__output_path.startswith(JsonlMatchWriter.SCHEME):
+            return JsonlMatchWriter(self.__output_path[len(JsonlMatchWriter.SCHEME):], matching_strategy_config)
+        return SqlMatchWriter(self.__output_path,
+                              matching_strategy_config)
 
     @provider
     @singleton
     def provide_open_ai_api_wrapper_config(self) -> OpenAiApiWrapperConfig:
-        return OpenAiApiWrapperConfig.read_config(self.__config_path)
+        return self.__open_ai_api_wrapper_config
 
     @provider
     @singleton
     def provide_matching_strategy_config(self) -> MatchingStrategyConfig:
-        return MatchingStrategyConfig.read_config(self.__config_path)
+        return self.__matching_strategy_config
 
     def configure(self, binder: Binder) -> None:
         binder.bind(OpenAiApiWrapperConfig, to=self.provide_open_ai_api_wrapper_config, scope=singleton)
+        binder.bind(ComputeExecutor, to=ComputeExecutor, scope=singleton)
+        binder.bind(MemoryMonitor, to=MemoryMonitor, scope=singleton)
         binder.bind(OpenAiApiWrapper, to=OpenAiApiWrapper, scope=singleton)
         binder.bind(RawEmbeddingsProvider, to=RawEmbeddingsProvider, scope=singleton)
+        binder.bind(HashingEmbeddingsProvider, to=HashingEmbeddingsProvider, scope=singleton)
+        binder.bind(SkillIndexStore, to=SkillIndexStore, scope=singleton)
         binder.bind(PackageCompletionEmbeddingsProvider, to=PackageCompletionEmbeddingsProvider, scope=singleton)
         binder.bind(SkillCompletionEmbeddingsProvider, to=SkillCompletionEmbeddingsProvider, scope=singleton)
         binder.bind(PackageToSkillMatchingFilter, to=PackageToSkillMatchingFilter, scope=singleton)
         binder.bind(MatchingEngine[Skill, Package], to=MatchingEngine, scope=singleton)
+        binder.bind(LexicalMatcher, to=LexicalMatcher, scope=singleton)
         binder.bind(MatchingStrategy, to=MatchingStrategy, scope=singleton)
+        binder.bind(MultiLanguageMatchingStrategy, to=MultiLanguageMatchingStrategy, scope=singleton)
+        binder.bind(MatchingService, to=MatchingService, scope=singleton)
+        binder.bind(MatchingHttpServer, to=MatchingHttpServer, scope=singleton)
         binder.bind(MatchingStrategyConfig, to=self.provide_matching_strategy_config, scope=singleton)
-        binder.multibind(dict[int, Skill], to=self.provide_skills, scope=singleton)
-        binder.multibind(list[Package], to=self.provide_packages, scope=singleton)
+        # dict[int, Skill], list[Package] and list[MultiLanguageMatchingStrategy.Job] are bound by their
+        # @multiprovider methods; binding them here as well would contribute every provider twice
         binder.bind(MatchWriter, to=self.provide_match_writer, scope=singleton)
+        binder.bind(PackageSnapshot, to=PackageSnapshot, scope=singleton)
         binder.bind(Main, to=Main, scope=singleton)
         binder.bind(logging.Logger, to=self.provide_logger, scope=noscope)
@@ -0,0 +1,220 @@
+import asyncio
+import glob
+import hashlib
+import json
+import os
+import re
+import time
+from typing import Optional
+from injector import inject
+from open_ai_api_wrapper_config import OpenAiApiWrapperConfig
+import utils
+import logging
+
+
+class BatchFileExchange:
+    """Passes the requests of the wrapper through files in batch_dir, in the format of the OpenAI Batch API,
+    instead of sending them to the servers. Requests arriving within batch_collect_seconds of each other are
+    written to one batch_NNNN.jsonl file and answered from batch_NNNN.results.jsonl once it appears.
+    The results of all earlier batches are read first, and a request already written to a batch still without results
+    waits for that batch, so a rerun only submits the requests no batch holds yet"""
+    BATCH_PATTERN = re.compile(r'batch_(\d+)\.jsonl$')
+
+    class Submitted(Exception):
+        """The requests were written to a batch file and batch_wait is off"""
+
+    __config: OpenAiApiWrapperConfig
+    __results: Optional[dict[str, dict]]
+    __submitted: Optional[dict[str, str]]
+    __pending: dict[str, tuple[str, dict, asyncio.Future]]
+    __last_added: float
+    __flusher: Optional[asyncio.Task]
+    __collectors: set[asyncio.Task]
+    __logger: Optional[logging.Logger]
+
+    @inject
+    def __init__(self, config: OpenAiApiWrapperConfig, logger: Optional[logging.Logger]) -> None:
+        if not config:
+            raise ValueError("config is missing or empty")
+        if not isinstance(config, OpenAiApiWrapperConfig):
+            raise TypeError("config must be an instance of OpenAiApiWrapperConfig")
+        if logger and not isinstance(logger, logging.Logger):
+            raise TypeError("logger must be an instance of Logger")
+        self.__config = config
+        self.__results = None
+        self.__submitted = None
+        self.__pending = {}
+        self.__last_added = 0.0
+        self.__flusher = None
+        self.__collectors = set()
+        self.__logger = logger
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self.__config.batch_dir)
+
+    @staticmethod
+    def custom_id(url: str, body: dict) -> str:
+        return hashlib.sha1(f"{url} {json.dumps(body, sort_keys=True)}".encode('utf-8')).hexdigest()
+
+    @staticmethod
+    def results_path(batch_path: str) -> str:
+        return batch_path[:-len('.jsonl')] + '.results.jsonl'
+
+    @staticmethod
+    def read_results(results_path: str) -> dict[str, dict]:
+        with open(results_path, 'r', encoding='utf-8') as file:
+            return {line['custom_id']: line for line in map(json.loads, filter(str.strip, file))}
+
+    def __load_results(self) -> dict[str, dict]:
+        if self.__results is None:
+            self.__results = {}
+            for results_path in sorted(glob.glob(os.path.join(self.__config.batch_dir, 'batch_*.results.jsonl'))):
+                # Failed requests of earlier runs are submitted again
+                results = self.read_results(results_path)
+                self.__results.update((custom_id, result) for custom_id, result in results.items()
+                                      if self.succeeded(result))
+            if self.__logger and self.__results:
+                self.__logger.info(f"Read {len(self.__results)} batch results from {self.__config.batch_dir}")
+        return self.__results
+
+    def __load_submitted(self) -> dict[str, str]:
+        """The batch file of every request written to a batch that has no results yet, by custom_id"""
+        if self.__submitted is None:
+            self.__submitted = {}
+            for batch_path in sorted(glob.glob(os.path.join(self.__config.batch_dir, 'batch_*.jsonl'))):
+                if (not self.BATCH_PATTERN.match(os.path.basename(batch_path))
+                        or os.path.exists(self.results_path(batch_path))):
+                    continue
+                with open(batch_path, 'r', encoding='utf-8') as file:
+                    self.__submitted.update((line['custom_id'], batch_path)
+                                            for line in map(json.loads, filter(str.strip, file)))
+            if self.__logger and self.__submitted:
+                self.__logger.info(f"Found {len(self.__submitted)} requests in batches still without results")
+        return self.__submitted
+
+    @staticmethod
+    def succeeded(result: dict) -> bool:
+        return not result.get('error') and (result.get('response') or {}).get('status_code') == 200
+
+    @staticmethod
+    def __body(custom_id: str, result: dict) -> dict:
+        response = result.get('response') or {}
+        if not BatchFileExchange.succeeded(result):
+            raise ValueError(f"Batch request {custom_id} failed: {result.get('error') or response.get('body')}")
+        return response['body']
+
+    async def request(self, url: str, body: dict) -> dict:
+        """The response body of the request, once a results file has it"""
+        if not url:
+            raise ValueError("url is missing or empty")
+        if not isinstance(body, dict):
+            raise TypeError("body must be a dictionary")
+        custom_id = self.custom_id(url, body)
+        result = self.__load_results().get(custom_id)
+        if result is not None:
+            return self.__body(custom_id, result)
+        if custom_id not in self.__pending:
+            self.__pending[custom_id] = (url, body, asyncio.get_running_loop().create_future())
+        future = self.__pending[custom_id][2]
+        self.__last_added = time.monotonic()
+        if self.__flusher is None or self.__flusher.done():
+            self.__flusher = asyncio.create_task(self.__flush_when_quiet())
+        return await asyncio.shield(future)
+
+    def __next_batch_path(self) -> str:
+        numbers = [int(found.group(1)) for name in os.listdir(self.__config.batch_dir)
+                   if (found := self.BATCH_PATTERN.match(name))]
+        return os.path.join(self.__config.batch_dir, f"batch_{max(numbers, default=0) + 1:04d}.jsonl")
+
+    async def __flush_when_quiet(self) -> None:
+        while (wait := self.__last_added + self.__config.batch_collect_seconds - time.monotonic()) > 0:
+            await asyncio.sleep(wait)
+        pending, self.__pending = self.__pending, {}
+        try:
+            # A request an unanswered batch already holds waits for that batch instead of being billed twice
+            submitted = self.__load_submitted()
+            batches: dict[str, dict[str, tuple[str, dict, asyncio.Future]]] = {}
+            for custom_id, request in pending.items():
+                if custom_id in submitted:
+                    batches.setdefault(submitted[custom_id], {})[custom_id] = request
+            fresh = {custom_id: request for custom_id, request in pending.items() if custom_id not in submitted}
+            if self.__logger and len(fresh) < len(pending):
+                self.__logger.info(f"{len(pending) - len(fresh)} requests wait for batches written earlier")
+            if fresh:
+                os.makedirs(self.__config.batch_dir, exist_ok=True)
+                batch_path = self.__next_batch_path()
+                temp_path = utils.temp_path_beside(batch_path)
+                with open(temp_path, 'w', encoding='utf-8') as file:
+                    file.writelines(json.dumps({'custom_id': custom_id, 'method': 'POST', 'url': url, 'body': body})
+                                    + "\n" for custom_id, (url, body, _) in fresh.items())
+                os.replace(temp_path, batch_path)
+                submitted.update((custom_id, batch_path) for custom_id in fresh)
+                batches[batch_path] = fresh
+                if self.__logger:
+                    self.__logger.info(f"Wrote {len(fresh)} requests to {batch_path}")
+            if not self.__config.batch_wait:
+                batch_paths = sorted(batches)
+                raise BatchFileExchange.Submitted(f"{len(pending)} requests wait for {', '.join(batch_paths)}, "
+                                                  f"run the batches, save their output as "
+                                                  f"{', '.join(map(self.results_path, batch_paths))} and run again")
+        except BaseException as e:
+            # The requests waiting for the batch get the error
+            self.__fail(pending, e)
+            if isinstance(e, asyncio.CancelledError):
+                raise
+            return
+        for batch_path, requests in batches.items():
+            # Collected apart from the flush, so the requests of other stages are written meanwhile
+            collector = asyncio.create_task(self.__collect(batch_path, requests))
+            self.__collectors.add(collector)
+            collector.add_done_callback(self.__collectors.discard)
+
+    @staticmethod
+    def __fail(pending: dict[str, tuple[str, dict, asyncio.Future]], error: BaseException) -> None:
+        for _, _, future in pending.values():
+            if future.done():
+                continue
+            if isinstance(error, asyncio.CancelledError):
+                future.cancel()
+            else:
+                future.set_exception(error)
+                # Marks the exception as retrieved when nobody waits for the request any more
+                future.exception()
+
+    async def __collect(self, batch_path: str, pending: dict[str, tuple[str, dict, asyncio.Future]]) -> None:
+        results_path = self.results_path(batch_path)
+        if self.__logger:
+            self.__logger.info(f"Waiting for {results_path}")
+        try:
+            while True:
+                while not os.path.exists(results_path):
+                    await asyncio.sleep(self.__config.batch_poll_seconds)
+                try:
+                    results = self.read_results(results_path)
+                    break
+                except ValueError:
+                    # Still being written
+                    await asyncio.sleep(self.__config.batch_poll_seconds)
+        except BaseException as e:
+            # The requests waiting for the batch get the error
+            self.__fail(pending, e)
+            if isinstance(e, asyncio.CancelledError):
+                raise
+            return
+        self.__load_results().update((custom_id, result) for custom_id, result in results.items()
+                                     if self.succeeded(result))
+        # Answered, a request it failed is written to a new batch when asked for again
+        submitted = self.__load_submitted()
+        for custom_id in [custom_id for custom_id, path in submitted.items() if path == batch_path]:
+            del submitted[custom_id]
+        for custom_id, (_, _, future) in pending.items():
+            if future.done():
+                continue
+            try:
+                if custom_id not in results:
+                    raise ValueError(f"{results_path} has no result for {custom_id}")
+                future.set_result(self.__body(custom_id, results[custom_id]))
+            except ValueError as e:
+                future.set_exception(e)
+                future.exception()
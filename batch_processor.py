@@ -0,0 +1,113 @@
+import asyncio
+import getopt
+import glob
+import json
+import os
+import sys
+from typing import Optional
+import httpx
+from batch_file_exchange import BatchFileExchange
+import utils
+
+USAGE = 'batch_processor.py -s <server url> [-k <api key>] (-b <batchfile> | -d <batchdir>) [-n <concurrency>]'
+
+
+class BatchProcessor:
+    """Stand-in for the OpenAI Batch API: sends every request of a batch file to a server and writes the results
+    file the way the Batch API output looks. In a directory, processes every batch file still without results,
+    and keeps watching for new ones"""
+    __server: str
+    __api_key: str
+    __concurrency: int
+
+    def __init__(self, server: str, api_key: str, concurrency: int = 8) -> None:
+        if not server:
+            raise ValueError("server is missing or empty")
+        if concurrency < 1:
+            raise ValueError("concurrency must be positive")
+        # The urls of a batch file start with /v1, as the server urls of a config do
+        self.__server = server.rstrip('/').removesuffix('/v1')
+        self.__api_key = api_key
+        self.__concurrency = concurrency
+
+    async def __send(self, client: httpx.AsyncClient, semaphore: asyncio.Semaphore, request: dict) -> dict:
+        async with semaphore:
+            try:
+                response = await client.post(self.__server + request['url'], json=request['body'],
+                                             headers={'Authorization': f"Bearer {self.__api_key}"}
+                                             if self.__api_key else {})
+                body, error = response.json(), None
+            except (httpx.HTTPError, ValueError) as e:
+                response, body, error = None, None, {'message': str(e)}
+        return {'id': f"batch_req_{request['custom_id']}",
+                'custom_id': request['custom_id'],
+                'response': {'status_code': response.status_code, 'body': body} if response is not None else None,
+                'error': error}
+
+    async def process(self, batch_path: str) -> str:
+        """Writes the results file of the batch file and returns its path"""
+        with open(batch_path, 'r', encoding='utf-8') as file:
+            requests = [json.loads(line) for line in file if line.strip()]
+        semaphore = asyncio.Semaphore(self.__concurrency)
+        with utils.Timer() as timer:
+            async with httpx.AsyncClient(timeout=600) as client:
+                results = await asyncio.gather(*[self.__send(client, semaphore, request) for request in requests])
+        results_path = BatchFileExchange.results_path(batch_path)
+        temp_path = utils.temp_path_beside(results_path)
+        with open(temp_path, 'w', encoding='utf-8') as file:
+            file.writelines(json.dumps(result) + "\n" for result in results)
+        os.replace(temp_path, results_path)
+        failed = sum(1 for result in results if result['error'] or result['response']['status_code'] != 200)
+        print(f"Processed {len(results)} requests of {batch_path} for {float(timer):.2f}s, {failed} failed")
+        return results_path
+
+    async def watch(self, batch_dir: str, poll_seconds: float = 1.0) -> None:
+        while True:
+            for batch_path in sorted(glob.glob(os.path.join(batch_dir, 'batch_*.jsonl'))):
+                if (BatchFileExchange.BATCH_PATTERN.match(os.path.basename(batch_path))
+                        and not os.path.exists(BatchFileExchange.results_path(batch_path))):
+                    await self.process(batch_path)
+            await asyncio.sleep(poll_seconds)
+
+
+def main(argv):
+    server: Optional[str] = None
+    api_key: str = os.environ.get('OPENAI_API_KEY', '')
+    batch_path: Optional[str] = None
+    batch_dir: Optional[str] = None
+    concurrency: int = 8
+    try:
+        opts, args = getopt.getopt(argv, "hs:k:b:d:n:", ["server=", "key=", "batch=", "dir=", "concurrency="])
+    except getopt.GetoptError:
+        print(USAGE)
+        sys.exit(2)
+    for opt, arg in opts:
+        if opt == '-h':
+            print(USAGE)
+            sys.exit()
+        elif opt in ("-s", "--server"):
+            server = arg
+        elif opt in ("-k", "--key"):
+            api_key = arg
+        elif opt in ("-b", "--batch"):
+            batch_path = arg
+        elif opt in ("-d", "--dir"):
+            batch_dir = arg
+        elif opt in ("-n", "--concurrency"):
+            concurrency = int(arg)
+    if not server or bool(batch_path) == bool(batch_dir) or concurrency < 1:
+        print(USAGE)
+        sys.exit(2)
+    processor = BatchProcessor(server, api_key, concurrency)
+    try:
+        if batch_path:
+            asyncio.run(processor.process(batch_path))
+        else:
+            print(f"Watching {batch_dir}")
+            asyncio.run(processor.watch(batch_dir))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -1,8 +1,8 @@
-import utils
 import numpy as np
 from embeddings_provider import EmbeddingsProvider
 from source_item import SourceItem
 from open_ai_api_wrapper import OpenAiApiWrapper
+from token_batcher import TokenBatcher
 from typing import TypeVar, Generic, Iterable
 
 P = TypeVar('P', bound=SourceItem)
@@ -12,10 +12,12 @@ class CompletionEmbeddingsProvider(Generic[P], EmbeddingsProvider[P, np.ndarray]
     __wrapper: OpenAiApiWrapper
     __completion_template: str
     __batch_size: int
+    __batch_max_tokens: int
 
     def __init__(self, completion_template: str,
                  wrapper: OpenAiApiWrapper,
-                 batch_size: int = 100) -> None:
+                 batch_size: int = 100,
+                 batch_max_tokens: int = 50000) -> None:
         if not completion_template:
             raise ValueError("completion_template is missing or empty")
         if not isinstance(completion_template, str):
@@ -28,22 +30,24 @@ class CompletionEmbeddingsProvider(Generic[P], EmbeddingsProvider[P, np.ndarray]
             raise ValueError("batch_size is missing or empty")
         if not isinstance(batch_size, int):
             raise TypeError("batch_size must be an integer")
+        if not batch_max_tokens:
+            raise ValueError("batch_max_tokens is missing or empty")
+        if not isinstance(batch_max_tokens, int):
+            raise TypeError("batch_max_tokens must be an integer")
         self.__wrapper = wrapper
         self.__completion_template = completion_template
         self.__batch_size = batch_size
+        self.__batch_max_tokens = batch_max_tokens
 
     async def complete(self, texts: list[str]) -> list[str]:
         return await self.__wrapper.complete(self.__completion_template, [(text,) for text in texts])
 
     async def get_embeddings(self, items: Iterable[P]) -> np.ndarray:
         self.raise_when_bad_items(items)
-        batches = utils.batch_list(list([item.text_to_match for item in items]), self.__batch_size)
-        embeddings = None
+        texts = [item.text_to_match for item in items]
+        batches = TokenBatcher(self.__batch_max_tokens, self.__batch_size, self.__wrapper.chars_per_token).batch(texts)
+        results = []
         for batch in batches:
-            completed = await self.complete(batch)
-            result = await self.__wrapper.embed_normalize(completed)
-            if embeddings is None:
-                embeddings = result
-            else:
-                embeddings = np.concatenate((embeddings, result))
-        return embeddings
+            completed = await self.complete([texts[i] for i in batch])
+            results.append(await self.__wrapper.embed_normalize(completed))
+        return TokenBatcher.restore_rows(batches, results)
@@ -0,0 +1,54 @@
+import asyncio
+import functools
+from collections.abc import Callable
+from concurrent.futures import Executor, ThreadPoolExecutor
+from typing import Optional, Any
+from injector import inject
+from matching_strategy_config import MatchingStrategyConfig
+import logging
+
+
+class ComputeExecutor:
+    """Runs CPU bound FAISS and NumPy work on dedicated threads, so the event loop keeps handling API responses
+    meanwhile. Both release the GIL in their heavy parts"""
+    __config: MatchingStrategyConfig
+    __executor: Optional[Executor]
+    __logger: Optional[logging.Logger]
+
+    @inject
+    def __init__(self, config: MatchingStrategyConfig, logger: Optional[logging.Logger]) -> None:
+        if not config:
+            raise ValueError("config is missing or empty")
+        if not isinstance(config, MatchingStrategyConfig):
+            raise TypeError("config must be an instance of MatchingStrategyConfig")
+        if logger and not isinstance(logger, logging.Logger):
+            raise TypeError("logger must be an instance of Logger")
+        self.__config = config
+        self.__executor = None
+        self.__logger = logger
+
+    @property
+    def search_chunk_size(self) -> int:
+        return self.__config.search_chunk_size
+
+    def __get_executor(self) -> Executor:
+        if self.__executor is None:
+            if self.__config.faiss_threads:
+                from faiss import omp_set_num_threads
+                omp_set_num_threads(self.__config.faiss_threads)
+            self.__executor = ThreadPoolExecutor(max_workers=self.__config.compute_workers,
+                                                 thread_name_prefix='compute')
+            if self.__logger:
+                self.__logger.debug(f"Started {self.__config.compute_workers} compute threads, "
+                                    f"FAISS threads: {self.__config.faiss_threads or 'default'}")
+        return self.__executor
+
+    async def run(self, function: Callable[..., Any], *args, **kwargs) -> Any:
+        return await asyncio.get_running_loop().run_in_executor(self.__get_executor(),
+                                                                functools.partial(function, *args, **kwargs))
+
+    def close(self) -> None:
+        """Stops the compute threads, the next run starts them again"""
+        if self.__executor is not None:
+            self.__executor.shutdown(wait=True)
+            self.__executor = None
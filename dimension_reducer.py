@@ -0,0 +1,84 @@
+from typing import Optional
+import numpy as np
+from matching_strategy_config import MatchingStrategyConfig
+
+
+class DimensionReducer:
+    """Shrinks normalized embeddings to reduced_dimension before they are indexed, either with a PCA fitted on the
+    left embeddings or by truncation for models trained Matryoshka-style. The results are normalized again"""
+    __config: MatchingStrategyConfig
+    __pca: Optional[object]
+    __input_dimension: Optional[int]
+
+    def __init__(self, config: MatchingStrategyConfig) -> None:
+        if not config:
+            raise ValueError("config is missing or empty")
+        if not isinstance(config, MatchingStrategyConfig):
+            raise TypeError("config must be an instance of MatchingStrategyConfig")
+        if config.dimension_reduction not in (MatchingStrategyConfig.REDUCTION_PCA,
+                                              MatchingStrategyConfig.REDUCTION_TRUNCATE):
+            raise ValueError("config does not enable dimension reduction")
+        self.__config = config
+        self.__pca = None
+        self.__input_dimension = None
+
+    @property
+    def input_dimension(self) -> Optional[int]:
+        return self.__input_dimension
+
+    @property
+    def output_dimension(self) -> Optional[int]:
+        if self.__input_dimension is None:
+            return None
+        if self.__pca is not None:
+            return self.__pca.d_out
+        return min(self.__config.reduced_dimension, self.__input_dimension)
+
+    @property
+    def report_sample(self) -> int:
+        return self.__config.reduction_report_sample
+
+    def fit(self, embeddings: np.ndarray) -> None:
+        if not isinstance(embeddings, np.ndarray) or embeddings.ndim != 2:
+            raise TypeError("embeddings must be a two-dimensional array")
+        self.__pca = None
+        self.__input_dimension = embeddings.shape[1]
+        if self.__config.dimension_reduction == MatchingStrategyConfig.REDUCTION_PCA:
+            from faiss import PCAMatrix
+            # PCA cannot find more components than there are samples
+            output_dimension = min(self.__config.reduced_dimension, *embeddings.shape)
+            self.__pca = PCAMatrix(embeddings.shape[1], output_dimension)
+            # noinspection PyArgumentList
+            self.__pca.train(np.ascontiguousarray(embeddings, dtype=np.float32))
+
+    def transform(self, embeddings: np.ndarray) -> np.ndarray:
+        if self.__input_dimension is None:
+            raise ValueError("fit must be called before transform")
+        if embeddings.shape[1] != self.__input_dimension:
+            raise ValueError(f"embeddings must have {self.__input_dimension} dimensions")
+        from faiss import normalize_L2
+        if self.__pca is not None:
+            # noinspection PyArgumentList
+            reduced = self.__pca.apply(np.ascontiguousarray(embeddings, dtype=np.float32))
+        else:
+            reduced = np.array(embeddings[:, :self.__config.reduced_dimension], dtype=np.float32)
+        normalize_L2(reduced)
+        return reduced
+
+    def agreement(self, left_embeddings: np.ndarray, right_embeddings: np.ndarray) -> tuple[float, float]:
+        """Shares of the right embeddings whose best left neighbour, and whose pair of the two best ones,
+        stay the same after the reduction"""
+        from faiss import IndexFlatIP
+
+        def top2(left: np.ndarray, right: np.ndarray) -> np.ndarray:
+            index = IndexFlatIP(left.shape[1])
+            # noinspection PyArgumentList
+            index.add(left)
+            # noinspection PyArgumentList
+            return index.search(right, 2)[1]
+
+        full = top2(left_embeddings, right_embeddings)
+        reduced = top2(self.transform(left_embeddings), self.transform(right_embeddings))
+        first = float(np.mean(full[:, 0] == reduced[:, 0]))
+        both = float(np.mean((np.sort(full, axis=1) == np.sort(reduced, axis=1)).all(axis=1)))
+        return first, both
@@ -1,6 +1,7 @@
 import abc
 from typing import TypeVar, Generic, Iterable
 from source_item import SourceItem
+import utils
 
 R = TypeVar('R')
 P = TypeVar('P', bound=SourceItem)
@@ -21,5 +22,5 @@ class EmbeddingsProvider(Generic[P, R], metaclass=abc.ABCMeta):
     def raise_when_bad_items(items: Iterable[P]) -> None:
         if not items:
             raise ValueError("items is missing or empty")
-        if not isinstance(items, Iterable) or not all(issubclass(item.__class__, SourceItem) for item in items):
+        if not isinstance(items, Iterable) or not utils.all_instances_of(items, SourceItem):
             raise TypeError("items must be a Iterable of AISearchableItem")
@@ -0,0 +1,282 @@
+import asyncio
+import csv
+import getopt
+import hashlib
+import itertools
+import json
+import logging
+import os
+import sys
+import tempfile
+from collections import Counter
+from typing import Optional, NamedTuple
+import yaml
+from utils import Timer
+
+USAGE = ('evaluation.py -s <skillsfile> -p <packagesfile> -g <goldenfile> -c <configfile> [-x <gridfile>] '
+         '[-r <recordingsfile> [-u <upstream url>]]')
+
+
+class Outcome(NamedTuple):
+    name: str
+    packages: int
+    precision: float
+    recall: float
+    f1: float
+    requests: int
+    tokens: int
+    seconds: float
+
+
+class ResponseRecorder:
+    """Stand-in OpenAI server answering from recorded responses. A request without a recording is sent to the
+    upstream server and its response recorded when an upstream is given, otherwise it fails with 404.
+    Needs aiohttp, and httpx for the upstream"""
+    __path: str
+    __upstream: Optional[str]
+    __recordings: dict[str, tuple[int, str]]
+    __stats: Counter
+    __runner: Optional[object]
+    __client: Optional[object]
+
+    def __init__(self, path: str, upstream: Optional[str] = None) -> None:
+        if not path:
+            raise ValueError("path is missing or empty")
+        self.__path = path
+        self.__upstream = upstream.rstrip('/') if upstream else None
+        self.__recordings = {}
+        self.__stats = Counter()
+        self.__runner = None
+        self.__client = None
+        if os.path.exists(path):
+            with open(path, 'r', encoding='utf-8') as file:
+                for line in file:
+                    if line.strip():
+                        recording = json.loads(line)
+                        self.__recordings[recording['key']] = (recording['status'], recording['body'])
+
+    @property
+    def stats(self) -> dict[str, int]:
+        return dict(self.__stats)
+
+    @staticmethod
+    def key(path: str, body: bytes) -> str:
+        try:
+            canonical = json.dumps(json.loads(body), sort_keys=True)
+        except ValueError:
+            canonical = body.decode('utf-8', 'replace')
+        return hashlib.sha1(f"{path} {canonical}".encode('utf-8')).hexdigest()
+
+    async def __record(self, key: str, path: str, body: bytes, authorization: str) -> tuple[int, str]:
+        if self.__client is None:
+            import httpx
+            self.__client = httpx.AsyncClient(timeout=600)
+        response = await self.__client.post(self.__upstream + path, content=body,
+                                            headers={'Content-Type': 'application/json',
+                                                     'Authorization': authorization})
+        if response.status_code == 200:
+            self.__recordings[key] = (response.status_code, response.text)
+            with open(self.__path, 'a', encoding='utf-8') as file:
+                file.write(json.dumps({'key': key, 'status': response.status_code, 'body': response.text}) + "\n")
+        return response.status_code, response.text
+
+    async def __handle(self, request):
+        from aiohttp import web
+        body = await request.read()
+        key = self.key(request.path, body)
+        if key in self.__recordings:
+            self.__stats['replayed'] += 1
+            status, text = self.__recordings[key]
+        elif self.__upstream:
+            self.__stats['recorded'] += 1
+            status, text = await self.__record(key, request.path, body, request.headers.get('Authorization', ''))
+        else:
+            self.__stats['missing'] += 1
+            status, text = 404, json.dumps({'error': {'message': 'No recorded response', 'type': 'not_found'}})
+        return web.Response(status=status, text=text, content_type='application/json')
+
+    async def start(self, host: str = '127.0.0.1') -> str:
+        """Starts serving on a free port and returns the base URL for the servers of a config"""
+        from aiohttp import web
+        app = web.Application()
+        app.add_routes([web.post('/{tail:.*}', self.__handle)])
+        self.__runner = web.AppRunner(app)
+        await self.__runner.setup()
+        site = web.TCPSite(self.__runner, host, 0)
+        await site.start()
+        port = self.__runner.addresses[0][1]
+        return f"http://{host}:{port}/v1"
+
+    async def stop(self) -> None:
+        if self.__client is not None:
+            await self.__client.aclose()
+            self.__client = None
+        if self.__runner is not None:
+            await self.__runner.cleanup()
+            self.__runner = None
+
+
+def read_golden(golden_path: str) -> dict[int, Optional[int]]:
+    """The expected skill id of every package, None for the packages that should stay unmatched"""
+    with open(golden_path, 'r', encoding='utf-8') as file:
+        return {int(row['package_id']): int(row['skill_id']) if (row.get('skill_id') or '').strip() else None
+                for row in csv.DictReader(file)}
+
+
+def read_grid(grid_path: Optional[str]) -> list[dict]:
+    """Every combination of the values listed per config key"""
+    if not grid_path:
+        return [{}]
+    with open(grid_path, 'r', encoding='utf-8') as file:
+        grid = yaml.safe_load(file) or {}
+    if not isinstance(grid, dict) or not all(isinstance(values, list) and values for values in grid.values()):
+        raise ValueError("The grid must map config keys to non-empty lists of values")
+    return [dict(zip(grid.keys(), values)) for values in itertools.product(*grid.values())]
+
+
+def score(golden: dict[int, Optional[int]], packages: list[int], predicted: dict[int, int]
+          ) -> tuple[float, float, float]:
+    correct = sum(1 for package, skill in predicted.items() if golden.get(package) == skill)
+    expected = sum(1 for package in packages if golden[package] is not None)
+    precision = correct / len(predicted) if predicted else 0.0
+    recall = correct / expected if expected else 0.0
+    f1 = 2 * precision * recall / (precision + recall) if precision + recall else 0.0
+    return precision, recall, f1
+
+
+# Paths a run writes its state to. A configuration reusing the state of another would not be measured on its own
+STATE_PATHS = ('skill_index_path', 'filter_deferred_path')
+
+
+def isolated(settings: dict, state_dir: str) -> dict:
+    """The settings with the state of the run moved into state_dir. Batch mode is left out, every configuration
+    needs its answers within the run"""
+    settings = {key: value for key, value in settings.items() if key != 'batch_dir'}
+    for key in STATE_PATHS:
+        if settings.get(key):
+            settings[key] = os.path.join(state_dir, key)
+    return settings
+
+
+async def evaluate(name: str, settings: dict, skills_path: str, packages_path: str,
+                   golden: dict[int, Optional[int]]) -> Outcome:
+    from injector import Injector
+    from app_module import AppModule
+    from compute_executor import ComputeExecutor
+    from matching_strategy import MatchingStrategy
+    from open_ai_api_wrapper import OpenAiApiWrapper
+    from package import Package
+    from skill import Skill
+
+    # AppModule reads its configs from a file, so every configuration of the grid gets one
+    with tempfile.NamedTemporaryFile('w', suffix='.yaml', delete=False, encoding='utf-8') as file:
+        yaml.safe_dump(settings, file)
+    try:
+        injector = Injector(AppModule(skills_path, packages_path, 'sqlite://', file.name, logging.WARNING))
+    finally:
+        os.remove(file.name)
+    skills = injector.get(dict[int, Skill])
+    packages = [package for package in injector.get(list[Package]) if package.key in golden]
+    if not packages:
+        raise ValueError("None of the golden packages is in the packages file")
+    wrapper = injector.get(OpenAiApiWrapper)
+    predicted = {}
+    try:
+        with Timer() as timer:
+            async for portion in injector.get(MatchingStrategy).match(skills, packages):
+                predicted.update({package.key: skill.key for package, skill in portion.matches.items()})
+    finally:
+        await wrapper.close()
+        injector.get(ComputeExecutor).close()
+        injector.get(MatchingStrategy).close()
+    usage = wrapper.usage_stats
+    return Outcome(name, len(packages), *score(golden, [package.key for package in packages], predicted),
+                   sum(count for key, count in usage.items() if key.endswith('.requests')),
+                   sum(count for key, count in usage.items() if key.endswith('tokens')),
+                   float(timer))
+
+
+def pareto_front(outcomes: list[Outcome]) -> set[str]:
+    """Names of the outcomes no other outcome beats on F1 without costing more tokens or time"""
+    def dominates(a: Outcome, b: Outcome) -> bool:
+        return (a.f1 >= b.f1 and a.tokens <= b.tokens and a.seconds <= b.seconds
+                and (a.f1, a.tokens, a.seconds) != (b.f1, b.tokens, b.seconds))
+    return {outcome.name for outcome in outcomes if not any(dominates(other, outcome) for other in outcomes)}
+
+
+def print_table(outcomes: list[Outcome]) -> None:
+    front = pareto_front(outcomes)
+    print(f"{'':<2}{'configuration':<50} {'pkgs':>5} {'P':>6} {'R':>6} {'F1':>6} {'requests':>9} {'tokens':>9} "
+          f"{'seconds':>8}")
+    for outcome in sorted(outcomes, key=lambda o: (-o.f1, o.tokens, o.seconds)):
+        print(f"{'*' if outcome.name in front else '':<2}{outcome.name[:50]:<50} {outcome.packages:>5} "
+              f"{outcome.precision:>6.3f} {outcome.recall:>6.3f} {outcome.f1:>6.3f} {outcome.requests:>9} "
+              f"{outcome.tokens:>9} {outcome.seconds:>8.2f}")
+    print("* on the Pareto front of F1 against tokens and seconds")
+
+
+async def run(skills_path: str, packages_path: str, golden_path: str, config_path: str, grid_path: Optional[str],
+              recordings_path: Optional[str], upstream: Optional[str]) -> None:
+    golden = read_golden(golden_path)
+    with open(config_path, 'r', encoding='utf-8') as file:
+        base = yaml.safe_load(file)
+    recorder = ResponseRecorder(recordings_path, upstream) if recordings_path else None
+    stand_in = await recorder.start() if recorder else None
+    outcomes = []
+    try:
+        for overrides in read_grid(grid_path):
+            settings = dict(base, **overrides)
+            if stand_in:
+                # As many clients as configured servers, so the parallelism stays the same
+                settings['servers'] = [stand_in] * len(base.get('servers') or [stand_in])
+            name = ', '.join(f"{key}={value}" for key, value in overrides.items()) or 'base'
+            try:
+                with tempfile.TemporaryDirectory() as state_dir:
+                    outcomes.append(await evaluate(name, isolated(settings, state_dir), skills_path, packages_path,
+                                                   golden))
+            except Exception as e:
+                print(f"{name} failed: {e}")
+    finally:
+        if recorder:
+            await recorder.stop()
+    if outcomes:
+        print_table(outcomes)
+    if recorder:
+        print(f"Responses: {recorder.stats}")
+
+
+def main(argv):
+    skills_path = packages_path = golden_path = config_path = None
+    grid_path = recordings_path = upstream = None
+    try:
+        opts, args = getopt.getopt(argv, "hs:p:g:c:x:r:u:", ["skills=", "packages=", "golden=", "config=",
+                                                              "grid=", "recordings=", "upstream="])
+    except getopt.GetoptError:
+        print(USAGE)
+        sys.exit(2)
+    for opt, arg in opts:
+        if opt == '-h':
+            print(USAGE)
+            sys.exit()
+        elif opt in ("-s", "--skills"):
+            skills_path = arg
+        elif opt in ("-p", "--packages"):
+            packages_path = arg
+        elif opt in ("-g", "--golden"):
+            golden_path = arg
+        elif opt in ("-c", "--config"):
+            config_path = arg
+        elif opt in ("-x", "--grid"):
+            grid_path = arg
+        elif opt in ("-r", "--recordings"):
+            recordings_path = arg
+        elif opt in ("-u", "--upstream"):
+            upstream = arg
+    if not skills_path or not packages_path or not golden_path or not config_path or (upstream and not recordings_path):
+        print(USAGE)
+        sys.exit(2)
+    asyncio.run(run(skills_path, packages_path, golden_path, config_path, grid_path, recordings_path, upstream))
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
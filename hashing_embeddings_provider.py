@@ -0,0 +1,87 @@
+import asyncio
+import re
+import zlib
+from concurrent.futures import Executor, ProcessPoolExecutor
+from typing import Generic, TypeVar, Iterable, Optional
+import numpy as np
+from injector import inject
+from embeddings_provider import EmbeddingsProvider
+from matching_strategy_config import MatchingStrategyConfig
+from source_item import SourceItem
+import logging
+
+P = TypeVar('P', bound=SourceItem)
+
+_WORD = re.compile(r'\w+')
+
+
+def hash_embed(texts: list[str], dimension: int, ngrams: tuple[int, int] = (3, 5)) -> np.ndarray:
+    """Embeds texts with signed feature hashing of words and character n-grams, L2-normalized.
+    Kept at module level so it can run in a worker process"""
+    rows, columns, values = [], [], []
+    for row, text in enumerate(texts):
+        text = text.casefold()
+        features = _WORD.findall(text)
+        for word in features[:]:
+            padded = f" {word} "
+            for n in range(ngrams[0], ngrams[1] + 1):
+                features.extend(padded[i:i + n] for i in range(len(padded) - n + 1))
+        for feature in features:
+            hashed = zlib.crc32(feature.encode('utf-8'))
+            rows.append(row)
+            columns.append(hashed % dimension)
+            values.append(1.0 if hashed & 0x80000000 else -1.0)
+    embeddings = np.zeros((len(texts), dimension), dtype=np.float32)
+    np.add.at(embeddings, (np.asarray(rows, dtype=np.int64), np.asarray(columns, dtype=np.int64)),
+              np.asarray(values, dtype=np.float32))
+    # Sublinear term frequency keeps long descriptions from being dominated by repeated n-grams
+    embeddings = np.sign(embeddings) * np.log1p(np.abs(embeddings))
+    norms = np.linalg.norm(embeddings, axis=1, keepdims=True)
+    np.divide(embeddings, norms, out=embeddings, where=norms > 0)
+    return embeddings
+
+
+class HashingEmbeddingsProvider(Generic[P], EmbeddingsProvider[P, np.ndarray]):
+    """In-process CPU embeddings of the raw item text. Needs no server, but its vectors live in their own space,
+    so left and right items of one iteration must both be embedded by it"""
+    __config: MatchingStrategyConfig
+    __executor: Optional[Executor]
+    __logger: Optional[logging.Logger]
+
+    @inject
+    def __init__(self, config: MatchingStrategyConfig, logger: Optional[logging.Logger]) -> None:
+        if not config:
+            raise ValueError("config is missing or empty")
+        if not isinstance(config, MatchingStrategyConfig):
+            raise TypeError("config must be an instance of MatchingStrategyConfig")
+        if logger and not isinstance(logger, logging.Logger):
+            raise TypeError("logger must be an instance of Logger")
+        self.__config = config
+        self.__executor = None
+        self.__logger = logger
+
+    def __get_executor(self) -> Executor:
+        if self.__executor is None:
+            self.__executor = ProcessPoolExecutor(max_workers=self.__config.local_embedding_workers)
+        return self.__executor
+
+    def close(self) -> None:
+        """Stops the worker processes, the next embeddings start them again"""
+        if self.__executor is not None:
+            self.__executor.shutdown(wait=True, cancel_futures=True)
+            self.__executor = None
+
+    async def get_embeddings(self, items: Iterable[P]) -> np.ndarray:
+        if self.__logger:
+            self.__logger.info("Getting local hashing embeddings for items")
+        self.raise_when_bad_items(items)
+        texts = [item.text_to_match for item in items]
+        batch_size = self.__config.batch_size
+        loop = asyncio.get_running_loop()
+        tasks = [loop.run_in_executor(self.__get_executor(), hash_embed,
+                                      texts[i:i + batch_size], self.__config.local_embedding_dimension)
+                 for i in range(0, len(texts), batch_size)]
+        embeddings = np.concatenate(await asyncio.gather(*tasks), axis=0)
+        if self.__logger:
+            self.__logger.debug(f"Local hashing embeddings obtained for {len(embeddings)} items")
+        return embeddings
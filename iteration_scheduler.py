@@ -0,0 +1,149 @@
+import time
+from collections import Counter
+from typing import Optional, NamedTuple
+from matching_strategy_config import MatchingStrategyConfig
+
+
+class IterationScheduler:
+    """Decides what every matching iteration does and when matching stops.
+    The fixed schedule alternates skill and package completions until an iteration yields fewer than
+    stop_matching_matches_num matches. The adaptive schedule tries every step once and then repeats the step
+    with the best observed yield in matches per 1000 tokens, counting every second as
+    scheduler_tokens_per_second tokens. Both stop when the token or time budget is spent. Tokens are read from
+    the usage scope of the run, see OpenAiApiWrapper.usage_scope"""
+    LOCAL = 'local'
+    RAW = 'raw'
+    RECOMPLETE_SKILLS = 'recomplete_skills'
+    RECOMPLETE_PACKAGES = 'recomplete_packages'
+    WIDEN = 'widen'
+
+    class Step(NamedTuple):
+        name: str
+        iteration: int
+        window: int
+
+    __config: MatchingStrategyConfig
+    __usage: Counter
+    __max_window: int
+    __iteration: int
+    __window: int
+    __stopped: bool
+    __estimates: dict[str, float]
+    __spent_tokens: int
+    __spent_seconds: float
+    __step_started: Optional[tuple[int, float]]
+    __running: Optional[str]
+
+    def __init__(self, config: MatchingStrategyConfig, usage: Counter, max_window: int = 0) -> None:
+        if not config:
+            raise ValueError("config is missing or empty")
+        if not isinstance(config, MatchingStrategyConfig):
+            raise TypeError("config must be an instance of MatchingStrategyConfig")
+        if usage is None:
+            raise ValueError("usage is missing")
+        if not isinstance(usage, Counter):
+            raise TypeError("usage must be a Counter")
+        if not isinstance(max_window, int) or max_window < 0:
+            raise ValueError("max_window must be a non-negative integer")
+        self.__config = config
+        self.__usage = usage
+        self.__max_window = min(max_window, config.scheduler_max_window)
+        self.__iteration = 0
+        self.__window = 0
+        self.__stopped = False
+        self.__estimates = {}
+        self.__spent_tokens = 0
+        self.__spent_seconds = 0.0
+        self.__step_started = None
+        self.__running = None
+
+    @property
+    def spent_tokens(self) -> int:
+        return self.__spent_tokens
+
+    @property
+    def spent_seconds(self) -> float:
+        return self.__spent_seconds
+
+    @property
+    def estimates(self) -> dict[str, float]:
+        return dict(self.__estimates)
+
+    def __tokens(self) -> int:
+        return sum(value for key, value in self.__usage.items() if key.endswith('_tokens'))
+
+    def __over_budget(self) -> bool:
+        max_tokens, max_seconds = self.__config.max_tokens_budget, self.__config.max_seconds_budget
+        return bool((max_tokens and self.__spent_tokens >= max_tokens)
+                    or (max_seconds and self.__spent_seconds >= max_seconds))
+
+    def __fixed_step(self, i: int) -> str:
+        if i in self.__config.local_embedding_iterations:
+            return IterationScheduler.LOCAL
+        if i == 0:
+            return IterationScheduler.RAW
+        return IterationScheduler.RECOMPLETE_SKILLS if i % 2 == 1 else IterationScheduler.RECOMPLETE_PACKAGES
+
+    def __adaptive_step(self, running: Optional[str] = None) -> Optional[str]:
+        candidates = [IterationScheduler.RECOMPLETE_SKILLS, IterationScheduler.RECOMPLETE_PACKAGES]
+        if self.__window < self.__max_window:
+            candidates.append(IterationScheduler.WIDEN)
+        untried = [name for name in candidates if name not in self.__estimates and name != running]
+        if untried:
+            return untried[0]
+        best = max(candidates, key=lambda name: self.__estimates.get(name, 0.0))
+        return best if self.__estimates.get(best, 0.0) >= self.__config.scheduler_min_yield else None
+
+    def next_step(self) -> Optional[Step]:
+        """Returns the step of the next iteration or None when matching should stop"""
+        if self.__stopped or self.__over_budget():
+            self.__stopped = True
+            return None
+        i = self.__iteration
+        initial = i == 0 or i in self.__config.local_embedding_iterations
+        if self.__config.scheduler == MatchingStrategyConfig.SCHEDULER_ADAPTIVE and not initial:
+            name = self.__adaptive_step()
+            if name is None:
+                self.__stopped = True
+                return None
+        else:
+            name = self.__fixed_step(i)
+        self.__window = self.__window + 1 if name == IterationScheduler.WIDEN else 0
+        self.__step_started = (self.__tokens(), time.monotonic())
+        self.__running = name
+        return IterationScheduler.Step(name, i, self.__window)
+
+    def predict_next(self) -> Optional[str]:
+        """Guesses the name of the step following the running one from what is known before it is recorded"""
+        if self.__stopped:
+            return None
+        i = self.__iteration + (1 if self.__step_started else 0)
+        if (self.__config.scheduler == MatchingStrategyConfig.SCHEDULER_ADAPTIVE
+                and i not in self.__config.local_embedding_iterations):
+            return self.__adaptive_step(self.__running)
+        return self.__fixed_step(i)
+
+    def record(self, step: Step, matches: int) -> None:
+        if not isinstance(step, IterationScheduler.Step):
+            raise TypeError("step must be an instance of IterationScheduler.Step")
+        if self.__step_started is None:
+            raise ValueError("record must follow next_step")
+        tokens = self.__tokens() - self.__step_started[0]
+        seconds = time.monotonic() - self.__step_started[1]
+        self.__step_started = None
+        self.__running = None
+        self.__spent_tokens += tokens
+        self.__spent_seconds += seconds
+        self.__iteration += 1
+        cost = max(tokens + seconds * self.__config.scheduler_tokens_per_second, 1.0)
+        observed = matches * 1000.0 / cost
+        previous = self.__estimates.get(step.name)
+        self.__estimates[step.name] = observed if previous is None else (previous + observed) / 2
+        if step.name == IterationScheduler.LOCAL:
+            return
+        if (self.__config.scheduler == MatchingStrategyConfig.SCHEDULER_FIXED
+                and matches < self.__config.stop_matching_matches_num):
+            self.__stopped = True
+
+    def stop(self) -> None:
+        self.__stopped = True
@@ -0,0 +1,18 @@
+import json
+import logging
+
+
+class JsonLogFormatter(logging.Formatter):
+    """Formats a record as one JSON object, with the fields passed through extra next to the message"""
+    STANDARD_ATTRIBUTES = frozenset(vars(logging.LogRecord('', 0, '', 0, '', None, None))) | {'message', 'asctime',
+                                                                                              'taskName'}
+
+    def format(self, record):
+        entry = {'time': self.formatTime(record),
+                 'level': record.levelname,
+                 'message': record.getMessage(),
+                 'location': f"{record.filename}:{record.lineno}"}
+        entry.update((key, value) for key, value in vars(record).items() if key not in self.STANDARD_ATTRIBUTES)
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
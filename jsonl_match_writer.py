@@ -0,0 +1,94 @@
+import json
+import os
+import shutil
+from typing import Optional, TextIO, Iterable
+from match_writer import MatchWriter
+from matching_strategy_config import MatchingStrategyConfig
+import utils
+
+
+class JsonlMatchWriter(MatchWriter):
+    """Streams the matches as JSON lines into a file beside the output, which replaces the output on finalize.
+    An existing output is copied first, so the run appends to it. Portions are flushed to the temporary file, but a
+    run that fails or is killed before finalize leaves the output as it was and its matches are computed again"""
+    SCHEME = 'jsonl://'
+
+    __path: str
+    __temp_path: Optional[str]
+    __file: Optional[TextIO]
+    __removed: set[tuple[Optional[str], int]]
+
+    def __init__(self, path: str, config: MatchingStrategyConfig):
+        if not path:
+            raise ValueError("path cannot be empty")
+        if not isinstance(path, str):
+            raise TypeError("path must be a string")
+        super().__init__(config)
+        self.__path = path
+        self.__temp_path = None
+        self.__file = None
+        self.__removed = set()
+
+    def __enter__(self):
+        if self.__file:
+            return self
+        self.__temp_path = utils.temp_path_beside(self.__path)
+        if os.path.exists(self.__path) and not self.__removed:
+            shutil.copyfile(self.__path, self.__temp_path)
+        self.__file = open(self.__temp_path, 'a', encoding='utf-8')
+        if self.__removed and os.path.exists(self.__path):
+            with open(self.__path, 'r', encoding='utf-8') as existing:
+                self.__file.writelines(line for line in existing if line.strip() and
+                                       self.__key(json.loads(line)) not in self.__removed)
+        return self
+
+    @staticmethod
+    def __key(row: dict) -> tuple[Optional[str], int]:
+        return row.get('programming_language_name'), row.get('package_id')
+
+    def read_records(self) -> Iterable[MatchWriter.Record]:
+        if not os.path.exists(self.__path):
+            return []
+        with open(self.__path, 'r', encoding='utf-8') as file:
+            rows = [json.loads(line) for line in file if line.strip()]
+        return [MatchWriter.Record(*(row.get(field) for field in MatchWriter.Record._fields)) for row in rows]
+
+    def remove_records(self, keys: set[tuple[Optional[str], int]]) -> None:
+        if not isinstance(keys, set):
+            raise TypeError("keys must be a set")
+        if self.__file:
+            raise ValueError("remove_records must be called before the first portion")
+        self.__removed |= keys
+
+    def write_records(self, records: list[MatchWriter.Record]) -> None:
+        if not records:
+            raise ValueError("records cannot be empty")
+        if not isinstance(records, list):
+            raise TypeError("records must be a list")
+        if not utils.all_instances_of(records, MatchWriter.Record):
+            raise TypeError("records must be a list of MatchWriter.Record")
+        self.__file.writelines(json.dumps(record._asdict(), ensure_ascii=False) + "\n" for record in records)
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if self.__file:
+            self.__file.flush()
+        return False
+
+    def finalize(self) -> None:
+        self.__enter__()
+        self.__file.flush()
+        os.fsync(self.__file.fileno())
+        self.__file.close()
+        self.__file = None
+        os.replace(self.__temp_path, self.__path)
+        self.__temp_path = None
+        self.__removed = set()
+
+    def abort(self) -> None:
+        self.__removed = set()
+        if self.__file:
+            self.__file.close()
+            self.__file = None
+        if self.__temp_path:
+            os.remove(self.__temp_path)
+            self.__temp_path = None
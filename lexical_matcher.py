@@ -0,0 +1,97 @@
+import re
+from typing import Optional
+from injector import inject
+from matching_strategy_config import MatchingStrategyConfig
+from package import Package
+from skill import Skill
+import logging
+
+
+class LexicalMatcher:
+    EXACT = 'exact'
+    ALIAS = 'alias'
+    # Shorter alias keys derived from skill names hit unrelated packages, configured aliases may be shorter
+    MIN_ALIAS_LENGTH = 3
+
+    __config: MatchingStrategyConfig
+    __indexes: Optional[tuple[dict[int, Skill], dict[str, Optional[Skill]], dict[str, Optional[Skill]]]]
+    __logger: Optional[logging.Logger]
+
+    @inject
+    def __init__(self, config: MatchingStrategyConfig, logger: Optional[logging.Logger]) -> None:
+        if not config:
+            raise ValueError("config is missing or empty")
+        if not isinstance(config, MatchingStrategyConfig):
+            raise TypeError("config must be an instance of MatchingStrategyConfig")
+        if logger and not isinstance(logger, logging.Logger):
+            raise TypeError("logger must be an instance of Logger")
+        self.__config = config
+        self.__indexes = None
+        self.__logger = logger
+
+    @staticmethod
+    def normalize(text: str) -> str:
+        return " ".join(text.casefold().split())
+
+    @staticmethod
+    def compact(text: str) -> str:
+        """Drops the separators between the parts of a name, so "Newtonsoft.Json" and "newtonsoft-json" meet.
+        Other symbols are kept, so "C#" and ".NET" do not turn into "c" and "net" and meet unrelated packages"""
+        return re.sub(r'(?<=\w)[\s_.\-/]+(?=\w)', '', " ".join(text.casefold().split()))
+
+    @staticmethod
+    def __add(index: dict[str, Optional[Skill]], key: str, skill: Skill, min_length: int = 1) -> None:
+        # A key shared by different skills is ambiguous and is left to the embeddings
+        if len(key) >= min_length and index.setdefault(key, skill) is not skill:
+            index[key] = None
+
+    def __get_indexes(self, skills: dict[int, Skill]
+                      ) -> tuple[dict[str, Optional[Skill]], dict[str, Optional[Skill]]]:
+        # Kept for the last skills snapshot, so a service matching batch after batch builds them once
+        if self.__indexes is None or self.__indexes[0] is not skills:
+            self.__indexes = (skills, *self.__build_indexes(skills))
+        return self.__indexes[1], self.__indexes[2]
+
+    def __build_indexes(self, skills: dict[int, Skill]
+                        ) -> tuple[dict[str, Optional[Skill]], dict[str, Optional[Skill]]]:
+        exact, alias = {}, {}
+        by_label = {}
+        for skill in skills.values():
+            names = [skill.label or '', skill.text_to_match.rsplit("\\", 1)[-1]]
+            for name in names:
+                self.__add(exact, self.normalize(name), skill)
+                self.__add(alias, self.compact(name), skill, LexicalMatcher.MIN_ALIAS_LENGTH)
+            if skill.label:
+                by_label.setdefault(self.normalize(skill.label), skill)
+        for name, label in self.__config.lexical_aliases.items():
+            skill = by_label.get(self.normalize(label))
+            if skill:
+                self.__add(alias, self.compact(name), skill)
+        return exact, alias
+
+    def match(self, skills: dict[int, Skill], packages: list[Package]) -> tuple[dict[Package, Skill],
+                                                                                 dict[Package, Skill],
+                                                                                 list[Package]]:
+        """Resolves packages whose title equals a skill name or the last segment of a skill path.
+        Returns exact hits, alias hits and the packages left for the embedding iterations"""
+        if not isinstance(skills, dict):
+            raise TypeError("skills must be a dictionary")
+        if not isinstance(packages, list):
+            raise TypeError("packages must be a list")
+        exact_index, alias_index = self.__get_indexes(skills)
+        exact, alias, remaining = {}, {}, []
+        for package in packages:
+            label = package.label or ''
+            skill = exact_index.get(self.normalize(label))
+            if skill:
+                exact[package] = skill
+                continue
+            skill = alias_index.get(self.compact(label))
+            if skill:
+                alias[package] = skill
+                continue
+            remaining.append(package)
+        if self.__logger:
+            self.__logger.info(f"Lexically matched {len(exact)} exact and {len(alias)} alias hits "
+                               f"out of {len(packages)} packages")
+        return exact, alias, remaining
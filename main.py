@@ -1,55 +1,210 @@
-from injector import inject
+from typing import Optional
+from injector import inject, ProviderOf
 from match_writer import MatchWriter
 from matching_strategy import MatchingStrategy
 from matching_strategy_config import MatchingStrategyConfig
+from memory_monitor import MemoryMonitor
+from multi_language_matching_strategy import MultiLanguageMatchingStrategy
+from open_ai_api_wrapper import OpenAiApiWrapper
 from package import Package
+from package_snapshot import PackageSnapshot
+from package_to_skill_matching_filter import PackageToSkillMatchingFilter
 from skill import Skill
+from skill_index_store import SkillIndexStore
 from utils import Timer
 
 
 class Main:
     __matching_strategy: MatchingStrategy
+    __multi_language_matching_strategy: MultiLanguageMatchingStrategy
     __matching_strategy_config: MatchingStrategyConfig
-    __skills: dict[int, Skill]
-    __packages: list[Package]
+    __skills: ProviderOf[dict[int, Skill]]
+    __packages: ProviderOf[list[Package]]
+    __jobs: ProviderOf[list[MultiLanguageMatchingStrategy.Job]]
     __match_writer: MatchWriter
+    __wrapper: OpenAiApiWrapper
+    __skill_index_store: SkillIndexStore
+    __memory_monitor: MemoryMonitor
+    __package_snapshot: PackageSnapshot
+    __matching_filter: PackageToSkillMatchingFilter
 
     @inject
     def __init__(self, matching_strategy: MatchingStrategy,
+                 multi_language_matching_strategy: MultiLanguageMatchingStrategy,
                  matching_strategy_config: MatchingStrategyConfig,
                  match_writer: MatchWriter,
-                 skills: dict[int, Skill],
-                 packages: list[Package]) -> None:
+                 skills: ProviderOf[dict[int, Skill]],
+                 packages: ProviderOf[list[Package]],
+                 jobs: ProviderOf[list[MultiLanguageMatchingStrategy.Job]],
+                 wrapper: OpenAiApiWrapper,
+                 skill_index_store: SkillIndexStore,
+                 memory_monitor: MemoryMonitor,
+                 package_snapshot: PackageSnapshot,
+                 matching_filter: PackageToSkillMatchingFilter) -> None:
         if not matching_strategy:
             raise ValueError("matching_strategy is missing or empty")
         if not isinstance(matching_strategy, MatchingStrategy):
             raise TypeError("matching_strategy must be an instance of MatchingStrategy")
+        if not multi_language_matching_strategy:
+            raise ValueError("multi_language_matching_strategy is missing or empty")
+        if not isinstance(multi_language_matching_strategy, MultiLanguageMatchingStrategy):
+            raise TypeError("multi_language_matching_strategy must be an instance of MultiLanguageMatchingStrategy")
         if not matching_strategy_config:
             raise ValueError("matching_strategy_config is missing or empty")
         if not isinstance(matching_strategy_config, MatchingStrategyConfig):
             raise TypeError("matching_strategy_config must be an instance of MatchingStrategyConfig")
         if not skills:
             raise ValueError("skills is missing or empty")
-        if not isinstance(skills, dict):
-            raise TypeError("skills must be a dictionary")
+        if not isinstance(skills, ProviderOf):
+            raise TypeError("skills must be a provider of a dictionary")
         if not packages:
             raise ValueError("packages is missing or empty")
-        if not isinstance(packages, list):
-            raise TypeError("packages must be a list")
+        if not isinstance(packages, ProviderOf):
+            raise TypeError("packages must be a provider of a list")
+        if not jobs:
+            raise ValueError("jobs is missing or empty")
+        if not isinstance(jobs, ProviderOf):
+            raise TypeError("jobs must be a provider of a list")
         if not match_writer:
             raise ValueError("match_writer is missing or empty")
         if not isinstance(match_writer, MatchWriter):
             raise TypeError("match_writer must be an instance of MatchWriter")
+        if not wrapper:
+            raise ValueError("wrapper is missing or empty")
+        if not isinstance(wrapper, OpenAiApiWrapper):
+            raise TypeError("wrapper must be an instance of OpenAiApiWrapper")
+        if not skill_index_store:
+            raise ValueError("skill_index_store is missing or empty")
+        if not isinstance(skill_index_store, SkillIndexStore):
+            raise TypeError("skill_index_store must be an instance of SkillIndexStore")
+        if not memory_monitor:
+            raise ValueError("memory_monitor is missing or empty")
+        if not isinstance(memory_monitor, MemoryMonitor):
+            raise TypeError("memory_monitor must be an instance of MemoryMonitor")
+        if not package_snapshot:
+            raise ValueError("package_snapshot is missing or empty")
+        if not isinstance(package_snapshot, PackageSnapshot):
+            raise TypeError("package_snapshot must be an instance of PackageSnapshot")
+        if not matching_filter:
+            raise ValueError("matching_filter is missing or empty")
+        if not isinstance(matching_filter, PackageToSkillMatchingFilter):
+            raise TypeError("matching_filter must be an instance of PackageToSkillMatchingFilter")
 
         self.__matching_strategy = matching_strategy
+        self.__multi_language_matching_strategy = multi_language_matching_strategy
         self.__matching_strategy_config = matching_strategy_config
         self.__skills = skills
         self.__packages = packages
+        self.__jobs = jobs
         self.__match_writer = match_writer
+        self.__wrapper = wrapper
+        self.__skill_index_store = skill_index_store
+        self.__memory_monitor = memory_monitor
+        self.__package_snapshot = package_snapshot
+        self.__matching_filter = matching_filter
+
+    @staticmethod
+    def __load_skills(skills: dict[int, Skill]) -> dict[int, Skill]:
+        if not skills:
+            raise ValueError("skills is missing or empty")
+        if not isinstance(skills, dict):
+            raise TypeError("skills must be a dictionary")
+        return skills
+
+    @staticmethod
+    def __load_packages(packages: list[Package]) -> list[Package]:
+        if not packages:
+            raise ValueError("packages is missing or empty")
+        if not isinstance(packages, list):
+            raise TypeError("packages must be a list")
+        return packages
+
+    async def __synchronize_skills(self, skills: dict[int, Skill]) -> Optional[SkillIndexStore.Diff]:
+        if not self.__skill_index_store.enabled:
+            return None
+        with self.__memory_monitor.stage('skill_index'):
+            return await self.__skill_index_store.synchronize(skills.values())
+
+    def __affected_packages(self, diff: Optional[SkillIndexStore.Diff], packages: list[Package],
+                            language: Optional[str] = None) -> list[Package]:
+        """Packages new or edited since the last run, packages matched to an edited or deleted skill, unmatched
+        packages once skills were added or edited and packages with deferred candidates. Their stored matches are
+        dropped, the other packages keep theirs"""
+        if diff is None or not self.__matching_strategy_config.rematch_affected_only:
+            return packages
+        stored = self.__match_writer.read_matches(language)
+        affected = self.__package_snapshot.affected(diff, packages, stored, language,
+                                                    self.__matching_filter.deferred_keys(language))
+        self.__match_writer.remove_matches([package.key for package in affected if package.key in stored],
+                                           language)
+        print(f"Re-matching {len(affected)} of {len(packages)} packages{f' ({language})' if language else ''}")
+        return affected
 
     async def run(self):
+        try:
+            await self.__run()
+        finally:
+            self.__matching_strategy.close()
+
+    async def __run(self):
         with Timer() as t:
-            async for match_portion in self.__matching_strategy.match(self.__skills, self.__packages):
-                with self.__match_writer as writer:
-                    writer.write_matches(match_portion)
+            try:
+                if self.__matching_strategy_config.jobs:
+                    await self.__run_jobs()
+                else:
+                    skills = self.__load_skills(self.__skills.get())
+                    packages = self.__load_packages(self.__packages.get())
+                    affected = self.__affected_packages(await self.__synchronize_skills(skills), packages)
+                    if affected:
+                        await self.__run_single(skills, affected)
+                    self.__package_snapshot.update(packages)
+            except BaseException:
+                self.__match_writer.abort()
+                raise
+            with self.__memory_monitor.stage('finalize'):
+                self.__match_writer.finalize()
+            # Saved only once the matches are published, a failed run matches the edited packages again
+            self.__package_snapshot.save()
         print(f"Elapsed time: {float(t):.2f} s")
+        print(f"Coalesced requests: {self.__wrapper.coalesce_stats}")
+        print(f"API usage: {self.__wrapper.usage_stats}")
+        print(f"Connections: {self.__wrapper.connection_stats}")
+        if self.__wrapper.hedge_stats.get('hedged'):
+            print(f"Hedged requests: {self.__wrapper.hedge_stats}")
+        self.__print_memory()
+
+    def __print_memory(self):
+        budget = self.__matching_strategy_config.memory_budget
+        print(f"Peak tracked arrays: {self.__memory_monitor.peak_tracked / 2 ** 20:.1f} MiB"
+              f"{f' of {budget.resident_bytes / 2 ** 20:.0f} MiB budgeted' if budget else ''}")
+        for stage in self.__memory_monitor.stages:
+            print(f"Peak RSS {stage.name:<20} {stage.peak_rss / 2 ** 20:>8.1f} MiB, "
+                  f"tracked arrays {stage.peak_tracked / 2 ** 20:.1f} MiB")
+
+    async def __run_single(self, skills: dict[int, Skill], packages: list[Package]):
+        async for portion in self.__matching_strategy.match(skills, packages):
+            if not portion.matches:
+                continue
+            with self.__match_writer as writer:
+                writer.write_matches(portion.matches, source=portion.source, iteration=portion.iteration,
+                                     distances=portion.distances, decision_tier=portion.decision_tier)
+
+    async def __run_jobs(self):
+        jobs = self.__jobs.get()
+        skills = {}
+        for job in jobs:
+            skills.update(self.__load_skills(job.skills))
+            self.__load_packages(job.packages)
+        diff = await self.__synchronize_skills(skills)
+        affected = [job._replace(packages=self.__affected_packages(diff, job.packages, job.programming_language))
+                    for job in jobs]
+        affected = [job for job in affected if job.packages]
+        if affected:
+            async for job, portion in self.__multi_language_matching_strategy.match(affected):
+                if not portion.matches:
+                    continue
+                with self.__match_writer as writer:
+                    writer.write_matches(portion.matches, job.programming_language, portion.source,
+                                         portion.iteration, portion.distances, portion.decision_tier)
+        for job in jobs:
+            self.__package_snapshot.update(job.packages, job.programming_language)
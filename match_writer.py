@@ -1,97 +1,112 @@
-from typing import Optional
-from sqlalchemy import Column, Integer, String, create_engine, Engine
-from sqlalchemy.orm import sessionmaker, declarative_base, Session
+import abc
+from typing import Optional, NamedTuple, Iterable
 from matching_strategy_config import MatchingStrategyConfig
 from package import Package
 from skill import Skill
+import utils
 
-Base = declarative_base()
 
+class MatchWriter(metaclass=abc.ABCMeta):
+    """Writes the matches of a run. Leaving the writer's context ends a portion; finalize publishes everything
+    written in the run and abort drops whatever has not been published yet. Only SqlMatchWriter publishes every
+    portion as it ends, so a crashed run keeps its matches; the file writers publish on finalize only"""
+
+    class Record(NamedTuple):
+        programming_language_name: Optional[str]
+        package_name: str
+        package_id: int
+        skill_name: str
+        skill_id: int
+        match_source: Optional[str]
+        decision_tier: Optional[str]
+        iteration: Optional[int]
+        first_distance: Optional[float]
+        second_distance: Optional[float]
 
-class MatchWriter:
-    __engine: Engine
-    __session_maker: sessionmaker[Session]
-    __session: Optional[Session]
     __config: MatchingStrategyConfig
 
-    def __init__(self, output_database: str, config: MatchingStrategyConfig):
-        if not output_database:
-            raise ValueError("output_database cannot be empty")
-        if not isinstance(output_database, str):
-            raise TypeError("output_database must be a string")
+    def __init__(self, config: MatchingStrategyConfig) -> None:
         if not config:
             raise ValueError("config cannot be empty")
         if not isinstance(config, MatchingStrategyConfig):
             raise TypeError("config must be an instance of MatchingStrategyConfig")
         self.__config = config
-        self.__engine = create_engine(output_database)
-        self.__session_maker = sessionmaker(bind=self.__engine)
-        self.__session = None
 
-    class Match(Base):
-        __tablename__ = 'package_to_skill_matches'
-        id = Column(Integer, primary_key=True)
-        programming_language_name = Column(String)
-        package_name = Column(String, nullable=False)
-        package_id = Column(Integer, nullable=False)
-        skill_name = Column(String, nullable=False)
-        skill_id = Column(Integer, nullable=False)
+    @abc.abstractmethod
+    def __enter__(self):
+        ...
 
-        @staticmethod
-        def from_skill_and_package(
-                package: Package,
-                skill: Skill,
-                language: Optional[str] = None) -> 'MatchWriter.Match':
-            if language and not isinstance(language, str):
-                raise TypeError("language must be a string")
-            if not skill:
-                raise ValueError("skill is missing or empty")
-            if not isinstance(skill, Skill):
-                raise TypeError("skill must be an instance of Skill")
-            if not package:
-                raise ValueError("package is missing or empty")
-            if not isinstance(package, Package):
-                raise TypeError("package must be an instance of Package")
-            return MatchWriter.Match(programming_language_name=language,
-                                     package_name=package.label,
-                                     package_id=package.key,
-                                     skill_name=skill.label,
-                                     skill_id=skill.key)
+    @abc.abstractmethod
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        ...
 
-    def __enter__(self):
-        if self.__session:
-            return self
-        Base.metadata.create_all(self.__engine)
-        self.__session = self.__session_maker()
-        return self
+    @abc.abstractmethod
+    def write_records(self, records: list[Record]) -> None:
+        """Writes the records as a part of the current portion"""
+        ...
 
-    def __write_matches(self, matches: list[Match]):
-        if not matches:
-            raise ValueError("matches cannot be empty")
-        if not isinstance(matches, list):
-            raise TypeError("matches must be a list")
-        if not all(isinstance(match, MatchWriter.Match) for match in matches):
-            raise TypeError("matches must be a list of MatchWriter.Match")
+    @abc.abstractmethod
+    def read_records(self) -> Iterable[Record]:
+        """Reads the records already published to the output"""
+        ...
+
+    @abc.abstractmethod
+    def remove_records(self, keys: set[tuple[Optional[str], int]]) -> None:
+        """Drops the published records of the (language, package id) keys when the run is published.
+        Must be called before the first portion"""
+        ...
+
+    @abc.abstractmethod
+    def finalize(self) -> None:
+        ...
 
-        self.__session.add_all(matches)
+    @abc.abstractmethod
+    def abort(self) -> None:
+        ...
 
-    def write_matches(self, matches: dict[Package, Skill]):
+    def write_matches(self, matches: dict[Package, Skill], language: Optional[str] = None,
+                      source: Optional[str] = None, iteration: Optional[int] = None,
+                      distances: Optional[dict[Package, tuple[float, float]]] = None,
+                      decision_tier: Optional[str] = None):
         if not matches:
             raise ValueError("matches cannot be empty")
         if not isinstance(matches, dict):
             raise TypeError("matches must be a dictionary")
-        if not all(isinstance(key, Package) for key in matches.keys()):
+        if not utils.all_instances_of(matches.keys(), Package):
             raise TypeError("matches keys must be instances of Package")
-        if not all(isinstance(value, Skill) for value in matches.values()):
+        if not utils.all_instances_of(matches.values(), Skill):
             raise TypeError("matches values must be instances of Skill")
-        self.__write_matches([MatchWriter.Match.from_skill_and_package(package, skill,
-                                                                       self.__config.programming_language)
-                              for package, skill in matches.items()])
+        if language and not isinstance(language, str):
+            raise TypeError("language must be a string")
+        if source and not isinstance(source, str):
+            raise TypeError("source must be a string")
+        if distances and not isinstance(distances, dict):
+            raise TypeError("distances must be a dictionary")
+        if decision_tier and not isinstance(decision_tier, str):
+            raise TypeError("decision_tier must be a string")
+        language = language or self.__config.programming_language
+        # Lexical hits are decided by their source
+        decision_tier = decision_tier or source
+        distances = distances or {}
+        self.write_records([MatchWriter.Record(language, package.label, package.key, skill.label, skill.key,
+                                               source, decision_tier, iteration,
+                                               *distances.get(package, (None, None)))
+                            for package, skill in matches.items()])
 
-    def __exit__(self, exc_type, exc_val, exc_tb):
-        if not self.__session:
-            return False
-        self.__session.commit()
-        self.__session.close()
-        self.__session = None
-        return False
+    def read_matches(self, language: Optional[str] = None) -> dict[int, int]:
+        """Skill ids of the packages already matched in the output, by package id"""
+        if language and not isinstance(language, str):
+            raise TypeError("language must be a string")
+        language = language or self.__config.programming_language
+        return {record.package_id: record.skill_id for record in self.read_records()
+                if record.programming_language_name == language}
+
+    def remove_matches(self, package_ids: Iterable[int], language: Optional[str] = None) -> None:
+        if not isinstance(package_ids, Iterable):
+            raise TypeError("package_ids must be an Iterable of integers")
+        if language and not isinstance(language, str):
+            raise TypeError("language must be a string")
+        language = language or self.__config.programming_language
+        keys = {(language, package_id) for package_id in package_ids}
+        if keys:
+            self.remove_records(keys)
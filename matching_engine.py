@@ -1,12 +1,16 @@
+import copy
+import weakref
+from collections.abc import AsyncIterator, Callable
 from typing import TypeVar, Generic, Optional
 import numpy as np
-from faiss import IndexIDMap, IndexFlatIP
 from injector import inject
+from compute_executor import ComputeExecutor
+from dimension_reducer import DimensionReducer
 from matching_filter import MatchingFilter
-from package import Package
-from skill import Skill
+from memory_monitor import MemoryMonitor
 from source_item import SourceItem
 from embeddings_provider import EmbeddingsProvider
+import utils
 import logging
 
 SI = TypeVar('SI', bound=SourceItem)
@@ -14,22 +18,47 @@ SNI = TypeVar('SNI', bound=SourceItem)
 
 
 class MatchingEngine(Generic[SI, SNI]):
+    # Decision tier of the matches taken as the nearest left item, without a filter
+    UNFILTERED = 'unfiltered'
+
     __left_items: Optional[dict[int, SI]] = None
+    __left_keys: Optional[np.ndarray] = None
     __right_items: Optional[list[SNI]] = None
-    __last_right_embeddings: Optional[np.ndarray] = None
+    __remaining: Optional[np.ndarray] = None
+    __right_embeddings: Optional[np.ndarray] = None
+    __index: Optional[object] = None
+    __last_distances: dict[SNI, tuple[float, float]]
+    __dimension_reducer: Optional[DimensionReducer] = None
+    __reducer: Optional[DimensionReducer] = None
+    __warm_left: dict[int, tuple[weakref.ref, object, Optional[DimensionReducer]]]
+    __compute_executor: ComputeExecutor
+    __memory_monitor: MemoryMonitor
     __logger: Optional[logging.Logger]
 
     @inject
-    def __init__(self, logger: Optional[logging.Logger]) -> None:
+    def __init__(self, compute_executor: ComputeExecutor, memory_monitor: MemoryMonitor,
+                 logger: Optional[logging.Logger]) -> None:
+        if not compute_executor:
+            raise ValueError("compute_executor is missing or empty")
+        if not isinstance(compute_executor, ComputeExecutor):
+            raise TypeError("compute_executor must be an instance of ComputeExecutor")
+        if not memory_monitor:
+            raise ValueError("memory_monitor is missing or empty")
+        if not isinstance(memory_monitor, MemoryMonitor):
+            raise TypeError("memory_monitor must be an instance of MemoryMonitor")
         if logger and not isinstance(logger, logging.Logger):
             raise TypeError("logger must be an instance of Logger")
+        self.__compute_executor = compute_executor
+        self.__memory_monitor = memory_monitor
+        self.__last_distances = {}
+        self.__warm_left = {}
         self.__logger = logger
 
     @property
     def right_items(self) -> list[SNI]:
         if not self.__right_items:
             raise ValueError("right_items is missing or empty")
-        return self.__right_items
+        return [self.__right_items[i] for i in self.__remaining]
 
     @right_items.setter
     def right_items(self, right_items: list[SNI]) -> None:
@@ -37,10 +66,11 @@ class MatchingEngine(Generic[SI, SNI]):
             raise ValueError("right_items is missing or empty")
         if not isinstance(right_items, list):
             raise TypeError("right_items must be a list")
-        if not all(issubclass(item.__class__, SourceItem) for item in right_items):
+        if not utils.all_instances_of(right_items, SourceItem):
             raise TypeError("right_items must be a list of SourceItem")
         self.__right_items = right_items
-        self.__last_right_embeddings = None
+        self.__remaining = np.arange(len(right_items), dtype=np.int64)
+        self.__right_embeddings = None
 
     @property
     def left_items(self) -> dict[int, SI]:
@@ -54,70 +84,251 @@ class MatchingEngine(Generic[SI, SNI]):
             raise ValueError("left_items is missing or empty")
         if not isinstance(left_items, dict):
             raise TypeError("left_items must be a dictionary")
-        if not all(isinstance(key, int) for key in left_items.keys()):
+        if not utils.all_instances_of(left_items.keys(), int):
             raise TypeError("left_items keys must be integers")
-        if not all(issubclass(value.__class__, SourceItem) for value in left_items.values()):
+        if not utils.all_instances_of(left_items.values(), SourceItem):
             raise TypeError("left_items values must be instances of SourceItem")
+        if left_items is self.__left_items:
+            return
         self.__left_items = left_items
+        self.__left_keys = np.fromiter(left_items.keys(), dtype=np.int64, count=len(left_items))
+        self.__index = None
+        self.__warm_left = {}
+
+    @property
+    def dimension_reducer(self) -> Optional[DimensionReducer]:
+        return self.__dimension_reducer
+
+    @dimension_reducer.setter
+    def dimension_reducer(self, dimension_reducer: Optional[DimensionReducer]) -> None:
+        if dimension_reducer and not isinstance(dimension_reducer, DimensionReducer):
+            raise TypeError("dimension_reducer must be an instance of DimensionReducer")
+        self.__dimension_reducer = dimension_reducer
+        self.__reducer = None
+        self.__index = None
+        self.__right_embeddings = None
+        self.__warm_left = {}
+
+    @property
+    def remaining_count(self) -> int:
+        return 0 if self.__remaining is None else len(self.__remaining)
+
+    @property
+    def last_distances(self) -> dict[SNI, tuple[float, float]]:
+        """Distances to the first and the second candidate of the matches accepted by the last search"""
+        return self.__last_distances
+
+    @property
+    def max_window(self) -> int:
+        """The widest candidate window the left items allow, see embed_and_search_right_in_left"""
+        return max(len(self.__left_items or ()) // 2 - 1, 0)
+
+    @staticmethod
+    def decision_tier(matching_filter: Optional[MatchingFilter[SNI, SI]]) -> str:
+        """The decision tier of the matches embed_and_search_right_in_left yields with the filter"""
+        return matching_filter.decision_tier if matching_filter else MatchingEngine.UNFILTERED
+
+    @staticmethod
+    def __build_index(embeddings: np.ndarray, keys: np.ndarray) -> object:
+        from faiss import IndexIDMap, IndexFlatIP
+        index = IndexIDMap(IndexFlatIP(embeddings.shape[1]))
+        # noinspection PyArgumentList
+        index.add_with_ids(embeddings, keys)
+        return index
+
+    @staticmethod
+    def __search_rows(index, embeddings: np.ndarray, rows: np.ndarray, k: int) -> tuple[np.ndarray, np.ndarray]:
+        # noinspection PyArgumentList
+        return index.search(embeddings[rows], k)
+
+    async def __reduce(self, left_embeddings: Optional[np.ndarray], right_embeddings: Optional[np.ndarray]
+                       ) -> tuple[Optional[np.ndarray], Optional[np.ndarray]]:
+        reducer, run = self.__reducer, self.__compute_executor.run
+        # The reduction is fitted again only when both sides are embedded anew,
+        # otherwise the kept side would be reduced differently from the new one
+        if left_embeddings is not None and (right_embeddings is not None or reducer is None
+                                            or reducer.input_dimension != left_embeddings.shape[1]):
+            # A fresh copy, as the warm indexes keep the reducers they were built with
+            reducer = copy.copy(self.__dimension_reducer)
+            await run(reducer.fit, left_embeddings)
+            self.__reducer = reducer
+            if right_embeddings is not None and reducer.report_sample and self.__logger:
+                rows = np.random.default_rng(0).choice(len(right_embeddings),
+                                                       min(reducer.report_sample, len(right_embeddings)),
+                                                       replace=False)
+                first, both = await run(reducer.agreement, left_embeddings, right_embeddings[rows])
+                self.__logger.info(f"Reduced {reducer.input_dimension} to {reducer.output_dimension} dimensions, "
+                                   f"the best match agrees with the full dimension for {first:.1%} and the two "
+                                   f"best for {both:.1%} of {len(rows)} sampled right items")
+        if left_embeddings is not None:
+            left_embeddings = await run(reducer.transform, left_embeddings)
+        if right_embeddings is not None:
+            right_embeddings = await run(reducer.transform, right_embeddings)
+        return left_embeddings, right_embeddings
+
+    def __warm_state(self, left_embeddings: np.ndarray) -> Optional[tuple[object, Optional[DimensionReducer]]]:
+        state = self.__warm_left.get(id(left_embeddings))
+        if state is None or state[0]() is not left_embeddings:
+            return None
+        return state[1], state[2]
+
+    def __keep_warm(self, left_embeddings: np.ndarray) -> None:
+        # The index lives as long as the embeddings it was built from, so an owner that keeps returning the same
+        # embeddings array, like a SharedEmbeddingsProvider kept across calls, gets its index without a rebuild
+        warm_left, key = self.__warm_left, id(left_embeddings)
+        warm_left[key] = (weakref.ref(left_embeddings, lambda _: warm_left.pop(key, None)),
+                          self.__index, self.__reducer)
+
+    async def __search(self, rows: np.ndarray, k: int) -> tuple[np.ndarray, np.ndarray]:
+        # Chunks give the event loop a turn between them, so a large search does not hold up the API responses
+        chunk_size = self.__compute_executor.search_chunk_size
+        parts = [await self.__compute_executor.run(self.__search_rows, self.__index, self.__right_embeddings,
+                                                   rows[i:i + chunk_size], k)
+                 for i in range(0, len(rows), chunk_size)]
+        if len(parts) == 1:
+            return parts[0]
+        return np.concatenate([part[0] for part in parts]), np.concatenate([part[1] for part in parts])
 
     async def embed_and_search_right_in_left(self,
-                                             left_embeddings_provider: EmbeddingsProvider[SNI, np.ndarray],
+                                             left_embeddings_provider: Optional[EmbeddingsProvider[SNI, np.ndarray]],
                                              right_embeddings_provider: Optional[EmbeddingsProvider[SI, np.ndarray]],
-                                             matching_filter: Optional[MatchingFilter[SNI, SI]] = None
+                                             matching_filter: Optional[MatchingFilter[SNI, SI]] = None,
+                                             window: int = 0,
+                                             on_candidates: Optional[
+                                                 Callable[[MatchingFilter.MatchBatch[SNI, SI]], None]] = None
                                              ) -> dict[SNI, SI]:
+        """Searches the remaining right items in the left items and keeps the matches the filter accepts.
+        A missing provider reuses the embeddings of the previous call. The filter is offered the neighbours
+        ranked 2 * window and 2 * window + 1, so a wider window offers candidates the previous calls did not.
+        on_candidates sees the search results before the filter runs"""
+        result = {}
+        async for matches in self.embed_and_stream_right_in_left(left_embeddings_provider, right_embeddings_provider,
+                                                                 matching_filter, window, on_candidates):
+            result.update(matches)
+        return result
+
+    async def embed_and_stream_right_in_left(self,
+                                             left_embeddings_provider: Optional[EmbeddingsProvider[SNI, np.ndarray]],
+                                             right_embeddings_provider: Optional[EmbeddingsProvider[SI, np.ndarray]],
+                                             matching_filter: Optional[MatchingFilter[SNI, SI]] = None,
+                                             window: int = 0,
+                                             on_candidates: Optional[
+                                                 Callable[[MatchingFilter.MatchBatch[SNI, SI]], None]] = None,
+                                             portion_size: int = 0
+                                             ) -> AsyncIterator[dict[SNI, SI]]:
+        """embed_and_search_right_in_left yielding the accepted matches in portions of portion_size as the filter
+        decides them, or in one portion when portion_size is 0. last_distances grows with every portion, and the
+        matches yielded are no longer remaining once the iteration ends, even when it ends early"""
         if not (self.__right_items and self.__left_items):
             raise ValueError(
                 "right_items and left_items should be set before calling embed_all_and_search_left_in_right")
 
-        if not right_embeddings_provider and (
-                self.__last_right_embeddings is None or not self.__last_right_embeddings.any()):
+        if not right_embeddings_provider and self.__right_embeddings is None:
             raise ValueError(
                 "You can't call this method without providing right_embeddings_provider for the first time")
 
         if right_embeddings_provider and not isinstance(right_embeddings_provider, EmbeddingsProvider):
             raise TypeError("right_embeddings_provider must be an instance of EmbeddingsProvider")
 
-        if not left_embeddings_provider:
-            raise ValueError("left_embeddings_provider is missing or empty")
+        if not left_embeddings_provider and self.__index is None:
+            raise ValueError(
+                "You can't call this method without providing left_embeddings_provider for the first time")
 
-        if not isinstance(left_embeddings_provider, EmbeddingsProvider):
+        if left_embeddings_provider and not isinstance(left_embeddings_provider, EmbeddingsProvider):
             raise TypeError("left_embeddings_provider must be an instance of EmbeddingsProvider")
 
+        if not isinstance(window, int) or window < 0 or window > self.max_window:
+            raise ValueError(f"window must be between 0 and {self.max_window}")
+
         if matching_filter and not isinstance(matching_filter, MatchingFilter):
             raise TypeError("search_filter must be an instance of SearchFilter")
 
+        if on_candidates and not callable(on_candidates):
+            raise TypeError("on_candidates must be callable")
+
+        if not isinstance(portion_size, int) or portion_size < 0:
+            raise ValueError("portion_size cannot be negative")
+
+        self.__last_distances = {}
+        remaining = self.__remaining
+        if not len(remaining):
+            return
+
         if self.__logger:
-            self.__logger.info(f"Getting embeddings and searching {len(self.__right_items)} "
+            self.__logger.info(f"Getting embeddings and searching {len(remaining)} "
                                f"right items in {len(self.__left_items)} left items")
 
-        left_embeddings = await left_embeddings_provider.get_embeddings(self.__left_items.values())
-        right_embeddings = await right_embeddings_provider.get_embeddings(
-            self.__right_items) if right_embeddings_provider else self.__last_right_embeddings
-
-        embedding_length = left_embeddings.shape[1]
-        index = IndexIDMap(IndexFlatIP(embedding_length))
-        # noinspection PyArgumentList
-        index.add_with_ids(left_embeddings, np.array(list(self.__left_items.keys()), dtype=np.int64))
+        left_embeddings = embeddings = None
+        if left_embeddings_provider:
+            left_embeddings = await left_embeddings_provider.get_embeddings(self.__left_items.values())
+        if right_embeddings_provider:
+            embeddings = await right_embeddings_provider.get_embeddings([self.__right_items[i] for i in remaining])
+        self.__memory_monitor.track('left embeddings', left_embeddings)
+        self.__memory_monitor.track('right embeddings', embeddings)
+        # A kept right side was reduced for the current index, so a warm index only helps along new right embeddings
+        warm = (self.__warm_state(left_embeddings)
+                if left_embeddings is not None and (embeddings is not None or not self.__dimension_reducer) else None)
+        if warm:
+            if self.__logger:
+                self.__logger.debug("Reusing the index built from the same left embeddings")
+            self.__index, self.__reducer = warm
+            if embeddings is not None and self.__reducer:
+                embeddings = await self.__compute_executor.run(self.__reducer.transform, embeddings)
+        else:
+            source = left_embeddings
+            if self.__dimension_reducer:
+                left_embeddings, embeddings = await self.__reduce(left_embeddings, embeddings)
+            if left_embeddings is not None:
+                self.__index = await self.__compute_executor.run(self.__build_index, left_embeddings,
+                                                                 self.__left_keys)
+                self.__memory_monitor.track('indexes', self.__index, left_embeddings.nbytes + self.__left_keys.nbytes)
+                self.__keep_warm(source)
+        if embeddings is not None:
+            if self.__right_embeddings is None or self.__right_embeddings.shape[1] != embeddings.shape[1]:
+                self.__right_embeddings = np.empty((len(self.__right_items), embeddings.shape[1]), dtype=np.float32)
+                self.__memory_monitor.track('right embeddings', self.__right_embeddings)
+            self.__right_embeddings[remaining] = embeddings
 
-        # noinspection PyArgumentList
-        dest, idx = index.search(right_embeddings, 2)
+        distances, keys = await self.__search(remaining, 2 * window + 2)
+        first, second = 2 * window, 2 * window + 1
+        # With a single left item there is no second neighbour, FAISS pads it with -1
+        padded = keys[:, second] < 0
+        if padded.any():
+            keys[padded, second], distances[padded, second] = keys[padded, first], distances[padded, first]
 
-        matches = [MatchingFilter.MatchEntry[Package, Skill](terms=self.__right_items[i],
-                                                             first_match=self.__left_items[idx[i][0]],
-                                                             first_distance=dest[i][0],
-                                                             second_match=self.__left_items[idx[i][1]],
-                                                             second_distance=dest[i][1]) for i in range(len(dest))]
+        batch = MatchingFilter.MatchBatch[SNI, SI](terms=self.__right_items,
+                                                   matches=self.__left_items,
+                                                   term_indexes=remaining,
+                                                   first_keys=keys[:, first],
+                                                   first_distances=distances[:, first],
+                                                   second_keys=keys[:, second],
+                                                   second_distances=distances[:, second])
 
-        best_matches = await matching_filter.choose_best_match_for_term(matches)
+        if on_candidates:
+            on_candidates(batch)
 
-        matched_indexes, result = [], {}
-        for i in range(len(best_matches)):
-            if best_matches[i]:
-                matched_indexes.append(i)
-                result[self.__right_items[i]] = best_matches[i]
-        if self.__logger:
-            self.__logger.info(f"Validated {len(best_matches)} matches")
+        if matching_filter:
+            decisions = matching_filter.stream_best_matches(batch, portion_size)
+        else:
+            decisions = self.__unfiltered(batch)
+        matched_rows = []
+        try:
+            async for best_matches in decisions:
+                if not best_matches:
+                    continue
+                matched_rows.extend(best_matches)
+                self.__last_distances.update((self.__right_items[remaining[row]], (float(distances[row, first]),
+                                                                                   float(distances[row, second])))
+                                             for row in best_matches)
+                yield {self.__right_items[remaining[row]]: match for row, match in best_matches.items()}
+        finally:
+            await decisions.aclose()
+            if self.__logger:
+                self.__logger.info(f"Validated {len(matched_rows)} matches")
+            if matched_rows:
+                keep = np.ones(len(remaining), dtype=bool)
+                keep[np.array(matched_rows, dtype=np.int64)] = False
+                self.__remaining = remaining[keep]
 
-        self.__right_items = np.delete(self.__right_items, matched_indexes).tolist()
-        self.__last_right_embeddings = np.delete(right_embeddings, matched_indexes, axis=0)
-        return result
+    async def __unfiltered(self, batch: MatchingFilter.MatchBatch[SNI, SI]) -> AsyncIterator[dict[int, SI]]:
+        yield {row: self.__left_items[int(batch.first_keys[row])] for row in range(batch.size)}
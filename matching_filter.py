@@ -1,5 +1,7 @@
 import abc
-from typing import TypeVar, Generic, Optional, NamedTuple
+from collections.abc import AsyncIterator, Mapping, Sequence
+from typing import TypeVar, Generic, NamedTuple
+import numpy as np
 
 from source_item import SourceItem
 
@@ -16,11 +18,44 @@ class MatchingFilter(Generic[P1, P2], metaclass=abc.ABCMeta):
         second_match: P2
         second_distance: float
 
+    class MatchBatch(Generic[P1, P2], NamedTuple):
+        """Search candidates in columnar form. Row i describes terms[term_indexes[i]] and its two nearest matches"""
+        terms: Sequence[P1]
+        matches: Mapping[int, P2]
+        term_indexes: np.ndarray
+        first_keys: np.ndarray
+        first_distances: np.ndarray
+        second_keys: np.ndarray
+        second_distances: np.ndarray
+
+        @property
+        def size(self) -> int:
+            return len(self.term_indexes)
+
+        def entry(self, row: int) -> 'MatchingFilter.MatchEntry[P1, P2]':
+            return MatchingFilter.MatchEntry(terms=self.terms[self.term_indexes[row]],
+                                             first_match=self.matches[int(self.first_keys[row])],
+                                             first_distance=float(self.first_distances[row]),
+                                             second_match=self.matches[int(self.second_keys[row])],
+                                             second_distance=float(self.second_distances[row]))
+
+    @property
+    def decision_tier(self) -> str:
+        """Recorded with the matches the filter decides"""
+        return 'filter'
+
     @abc.abstractmethod
-    async def choose_best_match_for_term(self, matches: list[MatchEntry[P1, P2]]) -> list[Optional[P2]]:
-        """Should return the best result between the two given results for the given search term"""
+    async def choose_best_matches(self, batch: MatchBatch[P1, P2]) -> dict[int, P2]:
+        """Should return the best result between the two given results for every row of the batch,
+        keyed by the row number. Rows without an acceptable result are left out"""
         ...
 
+    async def stream_best_matches(self, batch: MatchBatch[P1, P2], portion_size: int = 0
+                                  ) -> AsyncIterator[dict[int, P2]]:
+        """The results of choose_best_matches in portions of portion_size rows, yielded as they are decided.
+        Filters deciding the whole batch at once yield it as one portion"""
+        yield await self.choose_best_matches(batch)
+
     @classmethod
     def __subclasshook__(cls, subclass) -> bool:
-        return hasattr(subclass, 'choose_best_match_for_term') and callable(subclass.choose_best_match_for_term)
+        return hasattr(subclass, 'choose_best_matches') and callable(subclass.choose_best_matches)
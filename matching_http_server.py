@@ -0,0 +1,103 @@
+import asyncio
+import signal
+from typing import Optional
+from injector import inject
+from matching_service import MatchingService
+from package import Package
+import logging
+
+
+class MatchingHttpServer:
+    """HTTP/JSON front of the MatchingService.
+    POST /match takes one package {"id", "title", "description"} or {"packages": [...]} of them,
+    GET /health and GET /latency report the state of the service. Needs aiohttp"""
+    __service: MatchingService
+    __logger: Optional[logging.Logger]
+
+    @inject
+    def __init__(self, service: MatchingService, logger: Optional[logging.Logger]) -> None:
+        if not service:
+            raise ValueError("service is missing or empty")
+        if not isinstance(service, MatchingService):
+            raise TypeError("service must be an instance of MatchingService")
+        if logger and not isinstance(logger, logging.Logger):
+            raise TypeError("logger must be an instance of Logger")
+        self.__service = service
+        self.__logger = logger
+
+    @staticmethod
+    def __to_package(entry) -> Package:
+        if not isinstance(entry, dict):
+            raise TypeError("every package must be a JSON object")
+        if 'id' not in entry or not entry.get('title'):
+            raise ValueError("every package needs an id and a title")
+        return Package(int(entry['id']), str(entry['title']), str(entry.get('description') or ''))
+
+    @staticmethod
+    def __to_json(package: Package, result: Optional[MatchingService.Result]) -> dict:
+        if result is None:
+            return {'package_id': package.key, 'skill_id': None}
+        return {'package_id': package.key,
+                'skill_id': result.skill.key,
+                'skill_name': result.skill.label,
+                'source': result.source,
+                'iteration': result.iteration,
+                'first_distance': result.first_distance,
+                'second_distance': result.second_distance}
+
+    async def __match(self, request):
+        from aiohttp import web
+        try:
+            body = await request.json()
+            single = not (isinstance(body, dict) and 'packages' in body)
+            entries = [body] if single else body['packages']
+            if not isinstance(entries, list) or not entries:
+                raise ValueError("packages must be a non-empty list")
+            packages = [self.__to_package(entry) for entry in entries]
+        except (ValueError, TypeError) as e:
+            return web.json_response({'error': str(e)}, status=400)
+        results = await self.__service.match(packages)
+        matches = [self.__to_json(package, result) for package, result in zip(packages, results)]
+        return web.json_response(matches[0] if single else {'matches': matches})
+
+    async def __health(self, _):
+        from aiohttp import web
+        return web.json_response({'status': 'ok' if self.__service.running else 'stopped',
+                                  'skills': self.__service.skills_count,
+                                  'queued': self.__service.queued},
+                                 status=200 if self.__service.running else 503)
+
+    async def __latency(self, _):
+        from aiohttp import web
+        return web.json_response(self.__service.latency_stats)
+
+    async def serve(self, host: str, port: int) -> None:
+        """Serves until cancelled, interrupted or terminated"""
+        if not host:
+            raise ValueError("host is missing or empty")
+        if not isinstance(port, int):
+            raise TypeError("port must be an integer")
+        from aiohttp import web
+        app = web.Application()
+        app.add_routes([web.post('/match', self.__match),
+                        web.get('/health', self.__health),
+                        web.get('/latency', self.__latency)])
+        runner = web.AppRunner(app)
+        await runner.setup()
+        await self.__service.start()
+        stopped = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        for signal_number in (signal.SIGINT, signal.SIGTERM):
+            try:
+                loop.add_signal_handler(signal_number, stopped.set)
+            except (NotImplementedError, RuntimeError):
+                # Not supported on Windows, where KeyboardInterrupt still stops the loop
+                pass
+        try:
+            await web.TCPSite(runner, host, port).start()
+            if self.__logger:
+                self.__logger.info(f"Serving matches on http://{host}:{port}")
+            await stopped.wait()
+        finally:
+            await runner.cleanup()
+            await self.__service.stop()
@@ -0,0 +1,243 @@
+import asyncio
+import time
+from collections import deque
+from typing import Optional, NamedTuple
+import numpy as np
+from injector import inject, ProviderOf
+from compute_executor import ComputeExecutor
+from embeddings_provider import EmbeddingsProvider
+from match_writer import MatchWriter
+from matching_engine import MatchingEngine
+from matching_strategy import MatchingStrategy
+from matching_strategy_config import MatchingStrategyConfig
+from memory_monitor import MemoryMonitor
+from package import Package
+from package_to_skill_matching_filter import PackageToSkillMatchingFilter
+from shared_embeddings_provider import SharedEmbeddingsProvider
+from skill import Skill
+import logging
+
+
+class MatchingService:
+    """Matches packages as they are asked for. Lookups arriving within service_max_wait_ms of each other are
+    matched together, up to service_max_batch packages. The skill embeddings of every iteration and an engine of
+    its own are kept for the skills snapshot taken on start, so the indexes are reused from one batch to the next.
+    Every batch is a run of its own with the whole filter budget"""
+
+    class Result(NamedTuple):
+        skill: Skill
+        source: str
+        iteration: Optional[int]
+        first_distance: Optional[float]
+        second_distance: Optional[float]
+
+    __matching_strategy: MatchingStrategy
+    __matching_filter: PackageToSkillMatchingFilter
+    __skills_provider: ProviderOf[dict[int, Skill]]
+    __match_writer: MatchWriter
+    __compute_executor: ComputeExecutor
+    __memory_monitor: MemoryMonitor
+    __config: MatchingStrategyConfig
+    __logger: Optional[logging.Logger]
+    __skills: Optional[dict[int, Skill]]
+    __matching_engine: Optional[MatchingEngine[Skill, Package]]
+    __shared: dict[tuple[int, int], SharedEmbeddingsProvider[Skill]]
+    __queue: Optional[asyncio.Queue]
+    __worker: Optional[asyncio.Task]
+    __latencies: deque
+    __batch_sizes: deque
+    __batches: int
+
+    @inject
+    def __init__(self, matching_strategy: MatchingStrategy,
+                 matching_filter: PackageToSkillMatchingFilter,
+                 skills: ProviderOf[dict[int, Skill]],
+                 match_writer: MatchWriter,
+                 compute_executor: ComputeExecutor,
+                 memory_monitor: MemoryMonitor,
+                 config: MatchingStrategyConfig,
+                 logger: Optional[logging.Logger]) -> None:
+        if not matching_strategy:
+            raise ValueError("matching_strategy is missing or empty")
+        if not isinstance(matching_strategy, MatchingStrategy):
+            raise TypeError("matching_strategy must be an instance of MatchingStrategy")
+        if not matching_filter:
+            raise ValueError("matching_filter is missing or empty")
+        if not isinstance(matching_filter, PackageToSkillMatchingFilter):
+            raise TypeError("matching_filter must be an instance of PackageToSkillMatchingFilter")
+        if not skills:
+            raise ValueError("skills is missing or empty")
+        if not isinstance(skills, ProviderOf):
+            raise TypeError("skills must be a provider of a dictionary")
+        if not match_writer:
+            raise ValueError("match_writer is missing or empty")
+        if not isinstance(match_writer, MatchWriter):
+            raise TypeError("match_writer must be an instance of MatchWriter")
+        if not compute_executor:
+            raise ValueError("compute_executor is missing or empty")
+        if not isinstance(compute_executor, ComputeExecutor):
+            raise TypeError("compute_executor must be an instance of ComputeExecutor")
+        if not memory_monitor:
+            raise ValueError("memory_monitor is missing or empty")
+        if not isinstance(memory_monitor, MemoryMonitor):
+            raise TypeError("memory_monitor must be an instance of MemoryMonitor")
+        if not config:
+            raise ValueError("config is missing or empty")
+        if not isinstance(config, MatchingStrategyConfig):
+            raise TypeError("config must be an instance of MatchingStrategyConfig")
+        if logger and not isinstance(logger, logging.Logger):
+            raise TypeError("logger must be an instance of Logger")
+        self.__matching_strategy = matching_strategy
+        self.__matching_filter = matching_filter
+        self.__skills_provider = skills
+        self.__match_writer = match_writer
+        self.__compute_executor = compute_executor
+        self.__memory_monitor = memory_monitor
+        self.__config = config
+        self.__logger = logger
+        self.__skills = None
+        self.__matching_engine = None
+        self.__shared = {}
+        self.__queue = None
+        self.__worker = None
+        self.__latencies = deque(maxlen=config.service_latency_window)
+        self.__batch_sizes = deque(maxlen=config.service_latency_window)
+        self.__batches = 0
+
+    @property
+    def running(self) -> bool:
+        return self.__worker is not None and not self.__worker.done()
+
+    @property
+    def skills_count(self) -> int:
+        return len(self.__skills or {})
+
+    @property
+    def queued(self) -> int:
+        return self.__queue.qsize() if self.__queue else 0
+
+    @property
+    def latency_stats(self) -> dict[str, float]:
+        """Latency percentiles of the last service_latency_window lookups and the mean size of their batches"""
+        if not self.__latencies:
+            return {'lookups': 0, 'batches': self.__batches}
+        p50, p95, p99 = np.percentile(np.fromiter(self.__latencies, dtype=np.float64), [50, 95, 99]) * 1000
+        return {'lookups': len(self.__latencies),
+                'batches': self.__batches,
+                'p50_ms': round(float(p50), 2),
+                'p95_ms': round(float(p95), 2),
+                'p99_ms': round(float(p99), 2),
+                'max_ms': round(max(self.__latencies) * 1000, 2),
+                'mean_batch_size': round(sum(self.__batch_sizes) / len(self.__batch_sizes), 2)}
+
+    async def start(self) -> None:
+        if self.running:
+            return
+        skills = self.__skills_provider.get()
+        if not skills:
+            raise ValueError("skills is missing or empty")
+        if not isinstance(skills, dict):
+            raise TypeError("skills must be a dictionary")
+        if skills is not self.__skills:
+            # The shared embeddings and the engine's indexes belong to the snapshot they were built for
+            self.__skills = skills
+            self.__shared = {}
+            self.__matching_engine = MatchingEngine[Skill, Package](self.__compute_executor, self.__memory_monitor,
+                                                                    self.__logger)
+        self.__queue = asyncio.Queue()
+        self.__worker = asyncio.create_task(self.__serve())
+        if self.__logger:
+            self.__logger.info(f"Matching service started with {len(skills)} skills")
+
+    async def stop(self) -> None:
+        if self.__worker:
+            self.__worker.cancel()
+            try:
+                await self.__worker
+            except asyncio.CancelledError:
+                pass
+            self.__worker = None
+        while self.__queue and not self.__queue.empty():
+            _, future, _ = self.__queue.get_nowait()
+            future.cancel()
+        self.__match_writer.finalize()
+        self.__matching_strategy.close()
+        if self.__logger:
+            self.__logger.info("Matching service stopped")
+
+    async def match(self, packages: list[Package]) -> list[Optional[Result]]:
+        """Returns the match of every package, None for the ones left unmatched"""
+        if not packages:
+            raise ValueError("packages is missing or empty")
+        if not isinstance(packages, list) or not all(isinstance(package, Package) for package in packages):
+            raise TypeError("packages must be a list of Package")
+        if not self.running:
+            raise ValueError("The matching service is not running")
+        loop = asyncio.get_running_loop()
+        futures = []
+        for package in packages:
+            future = loop.create_future()
+            self.__queue.put_nowait((package, future, time.monotonic()))
+            futures.append(future)
+        return list(await asyncio.gather(*futures))
+
+    def __share(self, provider: EmbeddingsProvider, iteration: int) -> EmbeddingsProvider:
+        key = (id(provider), iteration)
+        if key not in self.__shared:
+            self.__shared[key] = SharedEmbeddingsProvider[Skill](provider, self.__skills)
+        return self.__shared[key]
+
+    async def __next_batch(self) -> dict[Package, list[tuple[asyncio.Future, float]]]:
+        package, future, started = await self.__queue.get()
+        batch = {package: [(future, started)]}
+        deadline = time.monotonic() + self.__config.service_max_wait_ms / 1000
+        while len(batch) < self.__config.service_max_batch:
+            timeout = deadline - time.monotonic()
+            if self.__queue.empty() and timeout <= 0:
+                break
+            try:
+                package, future, started = (self.__queue.get_nowait() if not self.__queue.empty()
+                                            else await asyncio.wait_for(self.__queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+            batch.setdefault(package, []).append((future, started))
+        return batch
+
+    async def __serve(self) -> None:
+        while True:
+            batch = await self.__next_batch()
+            try:
+                results = await self.__match_batch(list(batch))
+            except Exception as e:
+                if self.__logger:
+                    self.__logger.error(f"Matching a batch of {len(batch)} packages failed: {e}")
+                for waiters in batch.values():
+                    for future, _ in waiters:
+                        if not future.done():
+                            future.set_exception(e)
+                continue
+            finished = time.monotonic()
+            self.__batches += 1
+            self.__batch_sizes.append(len(batch))
+            for package, waiters in batch.items():
+                for future, started in waiters:
+                    if not future.done():
+                        future.set_result(results.get(package))
+                    self.__latencies.append(finished - started)
+
+    async def __match_batch(self, packages: list[Package]) -> dict[Package, Result]:
+        results = {}
+        # A long-running service would otherwise defer every candidate once the first batches spent the budget
+        self.__matching_filter.reset_budget()
+        async for portion in self.__matching_strategy.match(self.__skills, packages, self.__matching_engine,
+                                                            self.__share):
+            if not portion.matches:
+                continue
+            distances = portion.distances or {}
+            for package, skill in portion.matches.items():
+                results[package] = MatchingService.Result(skill, portion.source, portion.iteration,
+                                                          *distances.get(package, (None, None)))
+            with self.__match_writer as writer:
+                writer.write_matches(portion.matches, source=portion.source, iteration=portion.iteration,
+                                     distances=portion.distances, decision_tier=portion.decision_tier)
+        return results
@@ -1,24 +1,51 @@
-from collections.abc import AsyncIterable
-from typing import Optional
+from collections.abc import AsyncIterable, Callable
+from typing import Optional, NamedTuple
 
+import numpy as np
 from injector import inject
+from dimension_reducer import DimensionReducer
+from embeddings_provider import EmbeddingsProvider
+from hashing_embeddings_provider import HashingEmbeddingsProvider
+from iteration_scheduler import IterationScheduler
+from lexical_matcher import LexicalMatcher
 from matching_engine import MatchingEngine
+from matching_filter import MatchingFilter
 from matching_strategy_config import MatchingStrategyConfig
+from memory_monitor import MemoryMonitor
+from open_ai_api_wrapper import OpenAiApiWrapper
 from package import Package
 from package_completion_embeddings_provider import PackageCompletionEmbeddingsProvider
 from package_to_skill_matching_filter import PackageToSkillMatchingFilter
+from prefetching_embeddings_provider import PrefetchingEmbeddingsProvider
 from raw_embeddings_provider import RawEmbeddingsProvider
 from skill import Skill
 from skill_completion_embeddings_provider import SkillCompletionEmbeddingsProvider
+from skill_index_store import SkillIndexStore
 import logging
 
 
 class MatchingStrategy:
+    EMBEDDING = 'embedding'
+    LEXICAL = 'lexical'
+    DEFERRED = 'deferred'
+
+    class Portion(NamedTuple):
+        source: str
+        iteration: Optional[int]
+        matches: dict[Package, Skill]
+        distances: Optional[dict[Package, tuple[float, float]]] = None
+        decision_tier: Optional[str] = None
+
     __skills_embed_provider: SkillCompletionEmbeddingsProvider
     __packages_embed_provider: PackageCompletionEmbeddingsProvider
     __raw_embed_provider: RawEmbeddingsProvider
+    __local_embed_provider: HashingEmbeddingsProvider
+    __skill_index_store: SkillIndexStore
     __matching_engine: MatchingEngine[Skill, Package]
     __matching_filter: PackageToSkillMatchingFilter
+    __lexical_matcher: LexicalMatcher
+    __wrapper: OpenAiApiWrapper
+    __memory_monitor: MemoryMonitor
     __config: MatchingStrategyConfig
     __logger: Optional[logging.Logger]
 
@@ -27,8 +54,13 @@ class MatchingStrategy:
                  skills_embed_provider: SkillCompletionEmbeddingsProvider,
                  packages_embed_provider: PackageCompletionEmbeddingsProvider,
                  raw_embed_provider: RawEmbeddingsProvider,
+                 local_embed_provider: HashingEmbeddingsProvider,
+                 skill_index_store: SkillIndexStore,
                  matching_engine: MatchingEngine[Skill, Package],
                  matching_filter: PackageToSkillMatchingFilter,
+                 lexical_matcher: LexicalMatcher,
+                 wrapper: OpenAiApiWrapper,
+                 memory_monitor: MemoryMonitor,
                  config: MatchingStrategyConfig,
                  logger: Optional[logging.Logger]) -> None:
         if not skills_embed_provider:
@@ -43,6 +75,14 @@ class MatchingStrategy:
             raise ValueError("raw_embed_provider is missing or empty")
         if not isinstance(raw_embed_provider, RawEmbeddingsProvider):
             raise TypeError("raw_embed_provider must be an instance of RawEmbeddingsProvider")
+        if not local_embed_provider:
+            raise ValueError("local_embed_provider is missing or empty")
+        if not isinstance(local_embed_provider, HashingEmbeddingsProvider):
+            raise TypeError("local_embed_provider must be an instance of HashingEmbeddingsProvider")
+        if not skill_index_store:
+            raise ValueError("skill_index_store is missing or empty")
+        if not isinstance(skill_index_store, SkillIndexStore):
+            raise TypeError("skill_index_store must be an instance of SkillIndexStore")
         if not matching_engine:
             raise ValueError("matching_engine is missing or empty")
         if not isinstance(matching_engine, MatchingEngine):
@@ -51,6 +91,18 @@ class MatchingStrategy:
             raise ValueError("matching_filter is missing or empty")
         if not isinstance(matching_filter, PackageToSkillMatchingFilter):
             raise TypeError("matching_filter must be an instance of PackageToSkillMatchingFilter")
+        if not lexical_matcher:
+            raise ValueError("lexical_matcher is missing or empty")
+        if not isinstance(lexical_matcher, LexicalMatcher):
+            raise TypeError("lexical_matcher must be an instance of LexicalMatcher")
+        if not wrapper:
+            raise ValueError("wrapper is missing or empty")
+        if not isinstance(wrapper, OpenAiApiWrapper):
+            raise TypeError("wrapper must be an instance of OpenAiApiWrapper")
+        if not memory_monitor:
+            raise ValueError("memory_monitor is missing or empty")
+        if not isinstance(memory_monitor, MemoryMonitor):
+            raise TypeError("memory_monitor must be an instance of MemoryMonitor")
         if not config:
             raise ValueError("config is missing or empty")
         if not isinstance(config, MatchingStrategyConfig):
@@ -60,29 +112,137 @@ class MatchingStrategy:
         self.__skills_embed_provider = skills_embed_provider
         self.__packages_embed_provider = packages_embed_provider
         self.__raw_embed_provider = raw_embed_provider
+        self.__local_embed_provider = local_embed_provider
+        self.__skill_index_store = skill_index_store
         self.__matching_engine = matching_engine
         self.__matching_filter = matching_filter
+        self.__lexical_matcher = lexical_matcher
+        self.__wrapper = wrapper
+        self.__memory_monitor = memory_monitor
         self.__config = config
         self.__logger = logger
 
+    def close(self) -> None:
+        """Stops the worker processes of the local embeddings"""
+        self.__local_embed_provider.close()
+
+    def __select_embed_providers(self, step: IterationScheduler.Step, right_is_local: bool,
+                                 packages_embed_provider: EmbeddingsProvider
+                                 ) -> tuple[Optional[EmbeddingsProvider], Optional[EmbeddingsProvider]]:
+        match step.name:
+            case IterationScheduler.LOCAL:
+                return self.__local_embed_provider, self.__local_embed_provider
+            case IterationScheduler.RAW:
+                if self.__skill_index_store.enabled:
+                    return self.__skill_index_store, self.__raw_embed_provider
+                return self.__raw_embed_provider, self.__raw_embed_provider
+            case IterationScheduler.RECOMPLETE_PACKAGES:
+                return self.__skills_embed_provider, packages_embed_provider
+            case IterationScheduler.RECOMPLETE_SKILLS:
+                # The right embeddings kept from a local iteration are not comparable with remote ones
+                return self.__skills_embed_provider, self.__raw_embed_provider if right_is_local else None
+            case _:
+                return None, None
+
+    async def __match_deferred(self, skills: dict[int, Skill], packages: list[Package],
+                               language: Optional[str]) -> AsyncIterable[Portion]:
+        """Decides the candidates an earlier run deferred over the filter budget before anything is embedded"""
+        batch = self.__matching_filter.deferred_batch(skills, packages, language)
+        if not batch:
+            return
+        if self.__logger:
+            self.__logger.info(f"Filtering {batch.size} candidates deferred by an earlier run")
+        async for best_matches in self.__matching_filter.stream_best_matches(batch, self.__config.portion_size,
+                                                                             language):
+            rows = {batch.terms[batch.term_indexes[row]]: row for row in best_matches}
+            yield MatchingStrategy.Portion(MatchingStrategy.DEFERRED, None,
+                                           {package: best_matches[row] for package, row in rows.items()},
+                                           {package: (float(batch.first_distances[row]),
+                                                      float(batch.second_distances[row]))
+                                            for package, row in rows.items()},
+                                           self.__matching_filter.decision_tier)
+
     async def match(self,
                     skills: dict[int, Skill],
-                    packages: list[Package]) -> AsyncIterable[dict[Package, Skill]]:
-        self.__matching_engine.left_items = skills
-        self.__matching_engine.right_items = packages
-        i = 0
-        while True:
-            if self.__logger:
-                self.__logger.info(f"Matching iteration {i}")
-            left_embed_provider = self.__raw_embed_provider if i == 0 else self.__skills_embed_provider
-            right_embed_provider = self.__raw_embed_provider if i == 0 else (
-                self.__packages_embed_provider if i % 2 == 0 else None)
-            results = await self.__matching_engine.embed_and_search_right_in_left(left_embed_provider,
-                                                                                  right_embed_provider,
-                                                                                  self.__matching_filter)
-            yield results
-            if len(results) < self.__config.stop_matching_matches_num:
-                break
-            i += 1
+                    packages: list[Package],
+                    matching_engine: Optional[MatchingEngine[Skill, Package]] = None,
+                    share_left_embed_provider: Optional[
+                        Callable[[EmbeddingsProvider, int], EmbeddingsProvider]] = None,
+                    language: Optional[str] = None) -> AsyncIterable[Portion]:
+        """Matches the packages of one programming language, the candidates the filter defers are kept per
+        language"""
+        if matching_engine and not isinstance(matching_engine, MatchingEngine):
+            raise TypeError("matching_engine must be an instance of MatchingEngine")
+        if share_left_embed_provider and not callable(share_left_embed_provider):
+            raise TypeError("share_left_embed_provider must be callable")
+        if self.__config.lexical_matching:
+            with self.__memory_monitor.stage(MatchingStrategy.LEXICAL):
+                exact, alias, packages = self.__lexical_matcher.match(skills, packages)
+            yield MatchingStrategy.Portion(LexicalMatcher.EXACT, None, exact)
+            yield MatchingStrategy.Portion(LexicalMatcher.ALIAS, None, alias)
+            if not packages:
+                return
+        deferred = set()
+        async for portion in self.__match_deferred(skills, packages, language):
+            deferred.update(portion.matches)
+            yield portion
+        if deferred:
+            packages = [package for package in packages if package not in deferred]
+            if not packages:
+                self.__matching_filter.save_deferred()
+                return
+        matching_engine = matching_engine or self.__matching_engine
+        matching_filter = self.__matching_filter.for_language(language)
+        matching_engine.left_items = skills
+        matching_engine.right_items = packages
+        # An engine matching several batches keeps its reducer, so its warm indexes stay valid
+        if (matching_engine.dimension_reducer is None
+                and self.__config.dimension_reduction != MatchingStrategyConfig.REDUCTION_NONE):
+            matching_engine.dimension_reducer = DimensionReducer(self.__config)
+        # Tokens spent by concurrent jobs sharing the wrapper are not counted against this one
+        with self.__wrapper.usage_scope() as usage:
+            scheduler = IterationScheduler(self.__config, usage, matching_engine.max_window)
+            prefetcher = PrefetchingEmbeddingsProvider[Package](self.__packages_embed_provider, self.__logger)
+
+            def prefetch(batch: MatchingFilter.MatchBatch[Package, Skill]) -> None:
+                # Packages the filter rejects for their distance alone will need new completions next iteration,
+                # so they are embedded while the filter is still busy with the rest
+                if scheduler.predict_next() != IterationScheduler.RECOMPLETE_PACKAGES:
+                    return
+                threshold = self.__config.min_distance_to_consider + self.__config.prefetch_distance_margin
+                rows = np.flatnonzero(batch.first_distances < threshold)
+                prefetcher.prefetch(batch.terms[batch.term_indexes[row]] for row in rows)
+
+            right_is_local = False
+            try:
+                while matching_engine.remaining_count and (step := scheduler.next_step()):
+                    if self.__logger:
+                        self.__logger.info(f"Matching iteration {step.iteration}: {step.name}"
+                                           f"{f' (window {step.window})' if step.window else ''}")
+                    left_embed_provider, right_embed_provider = self.__select_embed_providers(step, right_is_local,
+                                                                                              prefetcher)
+                    if right_embed_provider:
+                        right_is_local = right_embed_provider is self.__local_embed_provider
+                    if share_left_embed_provider and left_embed_provider:
+                        left_embed_provider = share_left_embed_provider(left_embed_provider, step.iteration)
+                    matched = 0
+                    with self.__memory_monitor.stage(step.name):
+                        # Portions are yielded as the filter decides them, so they are written while it still runs
+                        async for results in matching_engine.embed_and_stream_right_in_left(
+                                left_embed_provider, right_embed_provider, matching_filter, step.window,
+                                prefetch if self.__config.prefetch_packages else None, self.__config.portion_size):
+                            prefetcher.discard(results.keys())
+                            matched += len(results)
+                            distances = matching_engine.last_distances
+                            yield MatchingStrategy.Portion(MatchingStrategy.EMBEDDING, step.iteration, results,
+                                                           {package: distances[package] for package in results},
+                                                           MatchingEngine.decision_tier(matching_filter))
+                    scheduler.record(step, matched)
+            finally:
+                prefetcher.discard_all()
+                self.__matching_filter.save_deferred()
         if self.__logger:
-            self.__logger.info("Matching completed")
+            self.__logger.info(f"Matching completed, spent {scheduler.spent_tokens} tokens "
+                               f"and {scheduler.spent_seconds:.2f}s in the iterations")
+            if prefetcher.stats:
+                self.__logger.info(f"Package prefetch: {prefetcher.stats}")
@@ -1,15 +1,87 @@
-from typing import Optional
+from typing import Optional, NamedTuple
 import yaml
+from memory_budget import MemoryBudget
+from skill import Skill
 
 
 class MatchingStrategyConfig:
+    FILTER_MODE_COMPLETION = 'completion'
+    FILTER_MODE_LOGPROBS = 'logprobs'
+    SCHEDULER_FIXED = 'fixed'
+    SCHEDULER_ADAPTIVE = 'adaptive'
+    REDUCTION_NONE = 'none'
+    REDUCTION_PCA = 'pca'
+    REDUCTION_TRUNCATE = 'truncate'
+    PRIORITY_NONE = 'none'
+    PRIORITY_DISTANCE = 'distance'
+    PRIORITY_MARGIN = 'margin'
+    LOG_FORMAT_TEXT = 'text'
+    LOG_FORMAT_JSON = 'json'
+
+    class Job(NamedTuple):
+        programming_language: str
+        skills_filter: tuple[str, ...]
+        packages_path: str
+
+        @classmethod
+        def from_dict(cls, job: dict) -> 'MatchingStrategyConfig.Job':
+            if not isinstance(job, dict):
+                raise TypeError("job must be a dictionary")
+            programming_language = job.get('programming_language', '')
+            skills_filter = job.get('skills_filter', '')
+            packages_path = job.get('packages', '')
+            if not programming_language or not skills_filter or not packages_path:
+                raise ValueError("Every job needs programming_language, skills_filter and packages")
+            return cls(programming_language, Skill.path_patterns(skills_filter), packages_path)
+
     __stop_matching_matches_num: int
     __min_distance_to_consider: float
     __skill_template: str
     __package_template: str
     __filter_template: str
     __batch_size: int
+    __batch_max_tokens: int
     __programming_language: Optional[str]
+    __skills_filter: tuple[str, ...]
+    __jobs: list[Job]
+    __lexical_matching: bool
+    __lexical_aliases: dict[str, str]
+    __local_embedding_iterations: list[int]
+    __local_embedding_dimension: int
+    __local_embedding_workers: Optional[int]
+    __filter_mode: str
+    __filter_min_confidence: float
+    __scheduler: str
+    __scheduler_min_yield: float
+    __scheduler_tokens_per_second: float
+    __scheduler_max_window: int
+    __max_tokens_budget: Optional[int]
+    __max_seconds_budget: Optional[float]
+    __prefetch_packages: bool
+    __prefetch_distance_margin: float
+    __compute_workers: int
+    __faiss_threads: Optional[int]
+    __search_chunk_size: int
+    __output_row_group_size: int
+    __dimension_reduction: str
+    __reduced_dimension: int
+    __reduction_report_sample: int
+    __service_max_batch: int
+    __service_max_wait_ms: float
+    __service_latency_window: int
+    __skill_index_path: Optional[str]
+    __rematch_affected_only: bool
+    __embedding_dimension: int
+    __filter_max_in_flight: Optional[int]
+    __memory_budget: Optional[MemoryBudget]
+    __filter_priority: str
+    __filter_max_requests_per_iteration: Optional[int]
+    __filter_max_requests: Optional[int]
+    __filter_max_tokens: Optional[int]
+    __filter_deferred_path: Optional[str]
+    __log_format: str
+    __log_sample_rate: float
+    __portion_size: int
 
     @property
     def stop_matching_matches_num(self) -> int:
@@ -35,29 +107,334 @@ class MatchingStrategyConfig:
     def batch_size(self) -> int:
         return self.__batch_size
 
+    @property
+    def batch_max_tokens(self) -> int:
+        return self.__batch_max_tokens
+
     @property
     def programming_language(self) -> Optional[str]:
         return self.__programming_language
 
-    def __init__(self, config: dict) -> None:
+    @property
+    def skills_filter(self) -> tuple[str, ...]:
+        """LIKE patterns of the skill paths to read, a pattern or a list of them, e.g. ['%.NET%', '%C#%'].
+        It is no longer an SQL condition, a condition written for the earlier key matches no skill path"""
+        return self.__skills_filter
+
+    @property
+    def jobs(self) -> list[Job]:
+        return self.__jobs
+
+    @property
+    def lexical_matching(self) -> bool:
+        return self.__lexical_matching
+
+    @property
+    def lexical_aliases(self) -> dict[str, str]:
+        return self.__lexical_aliases
+
+    @property
+    def local_embedding_iterations(self) -> list[int]:
+        return self.__local_embedding_iterations
+
+    @property
+    def local_embedding_dimension(self) -> int:
+        return self.__local_embedding_dimension
+
+    @property
+    def local_embedding_workers(self) -> Optional[int]:
+        return self.__local_embedding_workers
+
+    @property
+    def filter_mode(self) -> str:
+        return self.__filter_mode
+
+    @property
+    def filter_min_confidence(self) -> float:
+        return self.__filter_min_confidence
+
+    @property
+    def scheduler(self) -> str:
+        return self.__scheduler
+
+    @property
+    def scheduler_min_yield(self) -> float:
+        return self.__scheduler_min_yield
+
+    @property
+    def scheduler_tokens_per_second(self) -> float:
+        return self.__scheduler_tokens_per_second
+
+    @property
+    def scheduler_max_window(self) -> int:
+        return self.__scheduler_max_window
+
+    @property
+    def max_tokens_budget(self) -> Optional[int]:
+        return self.__max_tokens_budget
+
+    @property
+    def max_seconds_budget(self) -> Optional[float]:
+        return self.__max_seconds_budget
+
+    @property
+    def prefetch_packages(self) -> bool:
+        return self.__prefetch_packages
+
+    @property
+    def prefetch_distance_margin(self) -> float:
+        return self.__prefetch_distance_margin
+
+    @property
+    def compute_workers(self) -> int:
+        return self.__compute_workers
+
+    @property
+    def faiss_threads(self) -> Optional[int]:
+        return self.__faiss_threads
+
+    @property
+    def search_chunk_size(self) -> int:
+        return self.__search_chunk_size
+
+    @property
+    def output_row_group_size(self) -> int:
+        return self.__output_row_group_size
+
+    @property
+    def dimension_reduction(self) -> str:
+        return self.__dimension_reduction
+
+    @property
+    def reduced_dimension(self) -> int:
+        return self.__reduced_dimension
+
+    @property
+    def reduction_report_sample(self) -> int:
+        return self.__reduction_report_sample
+
+    @property
+    def service_max_batch(self) -> int:
+        return self.__service_max_batch
+
+    @property
+    def service_max_wait_ms(self) -> float:
+        return self.__service_max_wait_ms
+
+    @property
+    def service_latency_window(self) -> int:
+        return self.__service_latency_window
+
+    @property
+    def skill_index_path(self) -> Optional[str]:
+        return self.__skill_index_path
+
+    @property
+    def rematch_affected_only(self) -> bool:
+        return self.__rematch_affected_only
+
+    @property
+    def embedding_dimension(self) -> int:
+        return self.__embedding_dimension
+
+    @property
+    def filter_max_in_flight(self) -> Optional[int]:
+        return self.__filter_max_in_flight
+
+    @property
+    def memory_budget(self) -> Optional[MemoryBudget]:
+        return self.__memory_budget
+
+    @property
+    def filter_priority(self) -> str:
+        return self.__filter_priority
+
+    @property
+    def filter_max_requests_per_iteration(self) -> Optional[int]:
+        return self.__filter_max_requests_per_iteration
+
+    @property
+    def filter_max_requests(self) -> Optional[int]:
+        return self.__filter_max_requests
+
+    @property
+    def filter_max_tokens(self) -> Optional[int]:
+        return self.__filter_max_tokens
+
+    @property
+    def filter_deferred_path(self) -> Optional[str]:
+        return self.__filter_deferred_path
+
+    @property
+    def log_format(self) -> str:
+        return self.__log_format
+
+    @property
+    def log_sample_rate(self) -> float:
+        """The share of the per-decision log records that is written"""
+        return self.__log_sample_rate
+
+    @property
+    def portion_size(self) -> int:
+        """Matches written together while an iteration is still filtering, 0 to write every iteration at once.
+        Only a database output commits each portion, file outputs are published when the run finishes"""
+        return self.__portion_size
+
+    def __init__(self, config: dict, memory_budget: Optional[int] = None) -> None:
         self.__stop_matching_matches_num = config.get('stop_matching_matches_num', 0)
         self.__min_distance_to_consider = config.get('min_distance_to_consider', 0.75)
         self.__skill_template = config.get('skill_template', '')
         self.__package_template = config.get('package_template', '')
         self.__filter_template = config.get('filter_template', '')
         self.__batch_size = config.get('batch_size', 100)
+        self.__batch_max_tokens = config.get('batch_max_tokens', 50000)
         self.__programming_language = config.get('programming_language', None)
+        self.__skills_filter = Skill.path_patterns(config.get('skills_filter', Skill.DEFAULT_PATH_PATTERNS))
+        self.__jobs = [self.Job.from_dict(job) for job in config.get('jobs', None) or []]
+        self.__lexical_matching = config.get('lexical_matching', True)
+        self.__lexical_aliases = config.get('lexical_aliases', None) or {}
+        self.__local_embedding_iterations = config.get('local_embedding_iterations', None) or []
+        self.__local_embedding_dimension = config.get('local_embedding_dimension', 1024)
+        self.__local_embedding_workers = config.get('local_embedding_workers', None)
+        self.__filter_mode = config.get('filter_mode', self.FILTER_MODE_COMPLETION)
+        self.__filter_min_confidence = config.get('filter_min_confidence', 0.0)
+        self.__scheduler = config.get('scheduler', self.SCHEDULER_FIXED)
+        self.__scheduler_min_yield = config.get('scheduler_min_yield', 1.0)
+        self.__scheduler_tokens_per_second = config.get('scheduler_tokens_per_second', 100.0)
+        self.__scheduler_max_window = config.get('scheduler_max_window', 2)
+        self.__max_tokens_budget = config.get('max_tokens_budget', None)
+        self.__max_seconds_budget = config.get('max_seconds_budget', None)
+        self.__prefetch_packages = config.get('prefetch_packages', True)
+        self.__prefetch_distance_margin = config.get('prefetch_distance_margin', 0.0)
+        self.__compute_workers = config.get('compute_workers', 1)
+        self.__faiss_threads = config.get('faiss_threads', None)
+        self.__search_chunk_size = config.get('search_chunk_size', 4096)
+        self.__output_row_group_size = config.get('output_row_group_size', 100000)
+        self.__dimension_reduction = config.get('dimension_reduction', self.REDUCTION_NONE)
+        self.__reduced_dimension = config.get('reduced_dimension', 256)
+        self.__reduction_report_sample = config.get('reduction_report_sample', 500)
+        self.__service_max_batch = config.get('service_max_batch', 256)
+        self.__service_max_wait_ms = config.get('service_max_wait_ms', 20.0)
+        self.__service_latency_window = config.get('service_latency_window', 1000)
+        self.__skill_index_path = config.get('skill_index_path', None)
+        self.__rematch_affected_only = config.get('rematch_affected_only', False)
+        self.__embedding_dimension = config.get('embedding_dimension', 1536)
+        self.__filter_max_in_flight = config.get('filter_max_in_flight', None)
+        self.__memory_budget = None
+        self.__filter_priority = config.get('filter_priority', self.PRIORITY_NONE)
+        self.__filter_max_requests_per_iteration = config.get('filter_max_requests_per_iteration', None)
+        self.__filter_max_requests = config.get('filter_max_requests', None)
+        self.__filter_max_tokens = config.get('filter_max_tokens', None)
+        self.__filter_deferred_path = config.get('filter_deferred_path', None)
+        self.__log_format = config.get('log_format', self.LOG_FORMAT_TEXT)
+        self.__log_sample_rate = config.get('log_sample_rate', 1.0)
+        self.__portion_size = config.get('portion_size', 256)
 
         if (not self.__stop_matching_matches_num or not self.__min_distance_to_consider or not self.__skill_template
-                or not self.__package_template or not self.__filter_template or not self.__batch_size):
+                or not self.__package_template or not self.__filter_template or not self.__batch_size
+                or not self.__batch_max_tokens):
             raise ValueError("One or more required config fields are missing or empty")
         if self.__min_distance_to_consider < 0.5 or self.__min_distance_to_consider > 0.99:
             raise ValueError("min_distance_to_consider must be between 0.5 and 0.99")
+        if len({job.programming_language for job in self.__jobs}) != len(self.__jobs):
+            raise ValueError("jobs must have distinct programming languages")
+        if not isinstance(self.__lexical_matching, bool):
+            raise TypeError("lexical_matching must be a boolean")
+        if not isinstance(self.__lexical_aliases, dict) or not all(
+                isinstance(key, str) and isinstance(value, str) for key, value in self.__lexical_aliases.items()):
+            raise TypeError("lexical_aliases must be a mapping of alias to skill name")
+        if not isinstance(self.__local_embedding_iterations, list) or not all(
+                isinstance(i, int) and i >= 0 for i in self.__local_embedding_iterations):
+            raise TypeError("local_embedding_iterations must be a list of non-negative integers")
+        if not isinstance(self.__local_embedding_dimension, int) or self.__local_embedding_dimension < 1:
+            raise ValueError("local_embedding_dimension must be a positive integer")
+        if self.__local_embedding_workers is not None and (
+                not isinstance(self.__local_embedding_workers, int) or self.__local_embedding_workers < 1):
+            raise ValueError("local_embedding_workers must be a positive integer")
+        if self.__filter_mode not in (self.FILTER_MODE_COMPLETION, self.FILTER_MODE_LOGPROBS):
+            raise ValueError(f"filter_mode must be '{self.FILTER_MODE_COMPLETION}' or '{self.FILTER_MODE_LOGPROBS}'")
+        if not isinstance(self.__filter_min_confidence, (int, float)) or not 0 <= self.__filter_min_confidence <= 1:
+            raise ValueError("filter_min_confidence must be between 0 and 1")
+        if self.__scheduler not in (self.SCHEDULER_FIXED, self.SCHEDULER_ADAPTIVE):
+            raise ValueError(f"scheduler must be '{self.SCHEDULER_FIXED}' or '{self.SCHEDULER_ADAPTIVE}'")
+        if self.__scheduler_min_yield < 0 or self.__scheduler_tokens_per_second < 0:
+            raise ValueError("scheduler_min_yield and scheduler_tokens_per_second cannot be negative")
+        if not isinstance(self.__scheduler_max_window, int) or self.__scheduler_max_window < 0:
+            raise ValueError("scheduler_max_window must be a non-negative integer")
+        if self.__max_tokens_budget is not None and self.__max_tokens_budget <= 0:
+            raise ValueError("max_tokens_budget must be positive")
+        if self.__max_seconds_budget is not None and self.__max_seconds_budget <= 0:
+            raise ValueError("max_seconds_budget must be positive")
+        if not isinstance(self.__prefetch_packages, bool):
+            raise TypeError("prefetch_packages must be a boolean")
+        if (not isinstance(self.__prefetch_distance_margin, (int, float))
+                or not 0 <= self.__prefetch_distance_margin <= 0.5):
+            raise ValueError("prefetch_distance_margin must be between 0 and 0.5")
+        if not isinstance(self.__compute_workers, int) or self.__compute_workers < 1:
+            raise ValueError("compute_workers must be a positive integer")
+        if self.__faiss_threads is not None and (not isinstance(self.__faiss_threads, int) or self.__faiss_threads < 1):
+            raise ValueError("faiss_threads must be a positive integer")
+        if not isinstance(self.__search_chunk_size, int) or self.__search_chunk_size < 1:
+            raise ValueError("search_chunk_size must be a positive integer")
+        if not isinstance(self.__output_row_group_size, int) or self.__output_row_group_size < 1:
+            raise ValueError("output_row_group_size must be a positive integer")
+        if self.__dimension_reduction not in (self.REDUCTION_NONE, self.REDUCTION_PCA, self.REDUCTION_TRUNCATE):
+            raise ValueError(f"dimension_reduction must be '{self.REDUCTION_NONE}', '{self.REDUCTION_PCA}' "
+                             f"or '{self.REDUCTION_TRUNCATE}'")
+        if not isinstance(self.__reduced_dimension, int) or self.__reduced_dimension < 1:
+            raise ValueError("reduced_dimension must be a positive integer")
+        if not isinstance(self.__reduction_report_sample, int) or self.__reduction_report_sample < 0:
+            raise ValueError("reduction_report_sample must be a non-negative integer")
+        if not isinstance(self.__service_max_batch, int) or self.__service_max_batch < 1:
+            raise ValueError("service_max_batch must be a positive integer")
+        if not isinstance(self.__service_max_wait_ms, (int, float)) or self.__service_max_wait_ms < 0:
+            raise ValueError("service_max_wait_ms cannot be negative")
+        if not isinstance(self.__service_latency_window, int) or self.__service_latency_window < 1:
+            raise ValueError("service_latency_window must be a positive integer")
+        if self.__skill_index_path is not None and not isinstance(self.__skill_index_path, str):
+            raise TypeError("skill_index_path must be a string")
+        if not isinstance(self.__rematch_affected_only, bool):
+            raise TypeError("rematch_affected_only must be a boolean")
+        if self.__rematch_affected_only and not self.__skill_index_path:
+            raise ValueError("rematch_affected_only needs skill_index_path")
+        if not isinstance(self.__embedding_dimension, int) or self.__embedding_dimension < 1:
+            raise ValueError("embedding_dimension must be a positive integer")
+        if self.__filter_max_in_flight is not None and (
+                not isinstance(self.__filter_max_in_flight, int) or self.__filter_max_in_flight < 1):
+            raise ValueError("filter_max_in_flight must be a positive integer")
+        # Any other priority names the scorer function as module:function
+        if not isinstance(self.__filter_priority, str) or (
+                self.__filter_priority not in (self.PRIORITY_NONE, self.PRIORITY_DISTANCE, self.PRIORITY_MARGIN)
+                and ':' not in self.__filter_priority):
+            raise ValueError(f"filter_priority must be '{self.PRIORITY_NONE}', '{self.PRIORITY_DISTANCE}', "
+                             f"'{self.PRIORITY_MARGIN}' or module:function")
+        for name, value in (('filter_max_requests_per_iteration', self.__filter_max_requests_per_iteration),
+                            ('filter_max_requests', self.__filter_max_requests),
+                            ('filter_max_tokens', self.__filter_max_tokens)):
+            if value is not None and (not isinstance(value, int) or value < 0):
+                raise ValueError(f"{name} must be a non-negative integer")
+        if self.__filter_deferred_path is not None and not isinstance(self.__filter_deferred_path, str):
+            raise TypeError("filter_deferred_path must be a string")
+        if self.__log_format not in (self.LOG_FORMAT_TEXT, self.LOG_FORMAT_JSON):
+            raise ValueError(f"log_format must be '{self.LOG_FORMAT_TEXT}' or '{self.LOG_FORMAT_JSON}'")
+        if not isinstance(self.__log_sample_rate, (int, float)) or not 0 <= self.__log_sample_rate <= 1:
+            raise ValueError("log_sample_rate must be between 0 and 1")
+        if not isinstance(self.__portion_size, int) or self.__portion_size < 0:
+            raise ValueError("portion_size must be a non-negative integer")
+
+        if memory_budget is not None:
+            # The budget only lowers the configured sizes, a smaller value set in the config is kept
+            self.__memory_budget = MemoryBudget(memory_budget, max(self.__embedding_dimension,
+                                                                   self.__local_embedding_dimension))
+            self.__batch_size = min(self.__batch_size, self.__memory_budget.batch_size)
+            self.__search_chunk_size = min(self.__search_chunk_size, self.__memory_budget.search_chunk_size)
+            self.__filter_max_in_flight = min(self.__filter_max_in_flight or self.__memory_budget.filter_max_in_flight,
+                                              self.__memory_budget.filter_max_in_flight)
 
     @classmethod
-    def read_config(cls, file_name: str) -> 'MatchingStrategyConfig':
+    def read_config(cls, file_name: str, memory_budget: Optional[int] = None) -> 'MatchingStrategyConfig':
         if not file_name:
             raise ValueError("File name cannot be empty")
         with open(file_name, 'r', encoding='utf-8') as file:
             config = yaml.safe_load(file)
-            return cls(config)
+            return cls(config, memory_budget)
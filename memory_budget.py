@@ -0,0 +1,60 @@
+import re
+
+
+class MemoryBudget:
+    """Sizes the batches, chunks and in-flight limits of a run from a memory budget and the embedding dimension.
+    The embedding responses, the search chunks and the filter requests in flight get fixed shares of the budget,
+    the embeddings and indexes kept for the whole run get the rest"""
+    EMBEDDING_SHARE = 0.10
+    SEARCH_SHARE = 0.05
+    FILTER_SHARE = 0.05
+    # An embedding arrives as JSON text, is parsed into Python floats and ends up as float32
+    EMBEDDING_BYTES_PER_DIMENSION = 48
+    # The row copied for the search and the distances and ids found for it
+    SEARCH_RESULT_BYTES = 1024
+    # Prompt strings, the response object and the coroutine of a filter request
+    FILTER_REQUEST_BYTES = 16 * 1024
+    UNITS = {'': 1, 'k': 2 ** 10, 'm': 2 ** 20, 'g': 2 ** 30, 't': 2 ** 40}
+
+    __budget: int
+    __dimension: int
+
+    def __init__(self, budget: int, dimension: int) -> None:
+        if not isinstance(budget, int) or budget < 1:
+            raise ValueError("budget must be a positive integer")
+        if not isinstance(dimension, int) or dimension < 1:
+            raise ValueError("dimension must be a positive integer")
+        self.__budget = budget
+        self.__dimension = dimension
+
+    @classmethod
+    def parse_size(cls, size: str) -> int:
+        """Bytes of a size like 512M, 4G or 1.5GiB"""
+        if not size:
+            raise ValueError("size is missing or empty")
+        found = re.fullmatch(r'\s*(\d+(?:\.\d+)?)\s*([kmgt]?)(?:i?b)?\s*', size.lower())
+        if not found:
+            raise ValueError(f"{size} is not a size like 512M or 4G")
+        return int(float(found.group(1)) * cls.UNITS[found.group(2)])
+
+    @property
+    def budget(self) -> int:
+        return self.__budget
+
+    @property
+    def resident_bytes(self) -> int:
+        """The part of the budget left for the embeddings and indexes kept during the run"""
+        return int(self.__budget * (1 - self.EMBEDDING_SHARE - self.SEARCH_SHARE - self.FILTER_SHARE))
+
+    @property
+    def batch_size(self) -> int:
+        return max(1, int(self.__budget * self.EMBEDDING_SHARE)
+                   // (self.__dimension * self.EMBEDDING_BYTES_PER_DIMENSION))
+
+    @property
+    def search_chunk_size(self) -> int:
+        return max(64, int(self.__budget * self.SEARCH_SHARE) // (self.__dimension * 4 + self.SEARCH_RESULT_BYTES))
+
+    @property
+    def filter_max_in_flight(self) -> int:
+        return max(1, int(self.__budget * self.FILTER_SHARE) // self.FILTER_REQUEST_BYTES)
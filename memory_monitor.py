@@ -0,0 +1,131 @@
+import contextlib
+import os
+import sys
+import threading
+import weakref
+from collections import Counter
+from typing import Optional, NamedTuple
+from injector import inject
+from matching_strategy_config import MatchingStrategyConfig
+import logging
+
+
+class MemoryMonitor:
+    """Accounts the big arrays and indexes alive at once and samples the resident set size of the process while
+    named stages run. With a memory budget, tracked arrays outgrowing their share of it are logged once"""
+
+    class Stage(NamedTuple):
+        name: str
+        peak_rss: int
+        peak_tracked: int
+
+    __config: MatchingStrategyConfig
+    __lock: threading.Lock
+    __live: Counter
+    __tracked: set[int]
+    __peak_tracked: int
+    __active: Counter
+    __stages: dict[str, list[int]]
+    __warned: bool
+    __logger: Optional[logging.Logger]
+
+    @inject
+    def __init__(self, config: MatchingStrategyConfig, logger: Optional[logging.Logger]) -> None:
+        if not config:
+            raise ValueError("config is missing or empty")
+        if not isinstance(config, MatchingStrategyConfig):
+            raise TypeError("config must be an instance of MatchingStrategyConfig")
+        if logger and not isinstance(logger, logging.Logger):
+            raise TypeError("logger must be an instance of Logger")
+        self.__config = config
+        # Tracked objects may be collected on the compute threads
+        self.__lock = threading.Lock()
+        self.__live = Counter()
+        self.__tracked = set()
+        self.__peak_tracked = 0
+        self.__active = Counter()
+        self.__stages = {}
+        self.__warned = False
+        self.__logger = logger
+
+    @staticmethod
+    def rss() -> int:
+        """The resident set size of the process, or its peak where the current one cannot be read"""
+        try:
+            with open('/proc/self/statm', 'r') as file:
+                return int(file.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+        except (OSError, ValueError, IndexError, AttributeError):
+            pass
+        try:
+            import resource
+        except ImportError:
+            return 0
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # Reported in bytes on macOS and in kilobytes elsewhere
+        return peak if sys.platform == 'darwin' else peak * 1024
+
+    @property
+    def live_tracked(self) -> dict[str, int]:
+        return {label: size for label, size in self.__live.items() if size}
+
+    @property
+    def peak_tracked(self) -> int:
+        return self.__peak_tracked
+
+    @property
+    def stages(self) -> list[Stage]:
+        return [MemoryMonitor.Stage(name, *peaks) for name, peaks in self.__stages.items()]
+
+    def __release(self, key: int, label: str, size: int) -> None:
+        with self.__lock:
+            self.__tracked.discard(key)
+            self.__live[label] -= size
+
+    def track(self, label: str, value: object, size: Optional[int] = None) -> None:
+        """Counts size bytes, the nbytes of an array by default, under label until value is collected"""
+        if not label:
+            raise ValueError("label is missing or empty")
+        if value is None:
+            return
+        size = getattr(value, 'nbytes', 0) if size is None else size
+        key = id(value)
+        with self.__lock:
+            if key in self.__tracked:
+                return
+            self.__tracked.add(key)
+            self.__live[label] += size
+            total = sum(self.__live.values())
+            self.__peak_tracked = max(self.__peak_tracked, total)
+        weakref.finalize(value, self.__release, key, label, size)
+        budget = self.__config.memory_budget
+        if budget and total > budget.resident_bytes and not self.__warned:
+            self.__warned = True
+            if self.__logger:
+                self.__logger.warning(f"Tracked arrays take {total / 2 ** 20:.0f} MiB, more than the "
+                                      f"{budget.resident_bytes / 2 ** 20:.0f} MiB the memory budget leaves them: "
+                                      f"{self.live_tracked}")
+        self.sample()
+
+    def sample(self) -> None:
+        """Records the current resident set size for every running stage"""
+        if not self.__active:
+            return
+        rss, tracked = self.rss(), sum(self.__live.values())
+        for name in self.__active:
+            peaks = self.__stages.setdefault(name, [0, 0])
+            peaks[0], peaks[1] = max(peaks[0], rss), max(peaks[1], tracked)
+
+    @contextlib.contextmanager
+    def stage(self, name: str):
+        if not name:
+            raise ValueError("name is missing or empty")
+        # Stages of concurrent jobs share the process, so a stage of the same name may already be running
+        self.__active[name] += 1
+        self.sample()
+        try:
+            yield self
+        finally:
+            self.sample()
+            self.__active[name] -= 1
+            if not self.__active[name]:
+                del self.__active[name]
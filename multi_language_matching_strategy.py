@@ -0,0 +1,108 @@
+import asyncio
+from collections.abc import AsyncIterable
+from typing import Optional, NamedTuple
+from injector import inject
+from compute_executor import ComputeExecutor
+from embeddings_provider import EmbeddingsProvider
+from matching_engine import MatchingEngine
+from memory_monitor import MemoryMonitor
+from matching_strategy import MatchingStrategy
+from package import Package
+from shared_embeddings_provider import SharedEmbeddingsProvider
+from skill import Skill
+import logging
+
+
+class MultiLanguageMatchingStrategy:
+    class Job(NamedTuple):
+        programming_language: str
+        skills: dict[int, Skill]
+        packages: list[Package]
+
+    __matching_strategy: MatchingStrategy
+    __compute_executor: ComputeExecutor
+    __memory_monitor: MemoryMonitor
+    __logger: Optional[logging.Logger]
+
+    @inject
+    def __init__(self, matching_strategy: MatchingStrategy, compute_executor: ComputeExecutor,
+                 memory_monitor: MemoryMonitor, logger: Optional[logging.Logger]) -> None:
+        if not matching_strategy:
+            raise ValueError("matching_strategy is missing or empty")
+        if not isinstance(matching_strategy, MatchingStrategy):
+            raise TypeError("matching_strategy must be an instance of MatchingStrategy")
+        if not compute_executor:
+            raise ValueError("compute_executor is missing or empty")
+        if not isinstance(compute_executor, ComputeExecutor):
+            raise TypeError("compute_executor must be an instance of ComputeExecutor")
+        if not memory_monitor:
+            raise ValueError("memory_monitor is missing or empty")
+        if not isinstance(memory_monitor, MemoryMonitor):
+            raise TypeError("memory_monitor must be an instance of MemoryMonitor")
+        if logger and not isinstance(logger, logging.Logger):
+            raise TypeError("logger must be an instance of Logger")
+        self.__matching_strategy = matching_strategy
+        self.__compute_executor = compute_executor
+        self.__memory_monitor = memory_monitor
+        self.__logger = logger
+
+    async def match(self, jobs: list[Job]) -> AsyncIterable[tuple[Job, MatchingStrategy.Portion]]:
+        """Runs all jobs concurrently. Skills are embedded once per iteration for the union of the jobs' skills
+        and every job searches its packages in an index built from its own subset of them"""
+        if not jobs:
+            raise ValueError("jobs is missing or empty")
+        if not isinstance(jobs, list) or not all(isinstance(job, MultiLanguageMatchingStrategy.Job) for job in jobs):
+            raise TypeError("jobs must be a list of MultiLanguageMatchingStrategy.Job")
+
+        union: dict[int, Skill] = {}
+        for job in jobs:
+            union.update(job.skills)
+        if self.__logger:
+            self.__logger.info(f"Matching {len(jobs)} languages against {len(union)} shared skills")
+
+        shared: dict[tuple[int, int], SharedEmbeddingsProvider[Skill]] = {}
+        iterations: dict[str, int] = {job.programming_language: 0 for job in jobs}
+
+        def prune() -> None:
+            # Embeddings of an iteration are dropped once every running job has moved past it
+            oldest = min(iterations.values(), default=None)
+            for key in [key for key in shared if oldest is None or key[1] < oldest]:
+                del shared[key]
+
+        def share(job: MultiLanguageMatchingStrategy.Job):
+            def share_left_embed_provider(provider: EmbeddingsProvider, iteration: int) -> EmbeddingsProvider:
+                iterations[job.programming_language] = iteration
+                prune()
+                key = (id(provider), iteration)
+                if key not in shared:
+                    shared[key] = SharedEmbeddingsProvider[Skill](provider, union)
+                return shared[key]
+            return share_left_embed_provider
+
+        results: asyncio.Queue = asyncio.Queue()
+
+        async def run(job: MultiLanguageMatchingStrategy.Job) -> None:
+            matching_engine = MatchingEngine[Skill, Package](self.__compute_executor, self.__memory_monitor,
+                                                             self.__logger)
+            try:
+                async for portion in self.__matching_strategy.match(job.skills, job.packages, matching_engine,
+                                                                    share(job), job.programming_language):
+                    results.put_nowait((job, portion))
+            finally:
+                del iterations[job.programming_language]
+                prune()
+                results.put_nowait((job, None))
+
+        tasks = [asyncio.create_task(run(job)) for job in jobs]
+        try:
+            finished = 0
+            while finished < len(tasks):
+                job, portion = await results.get()
+                if portion is None:
+                    finished += 1
+                    continue
+                yield job, portion
+            await asyncio.gather(*tasks)
+        finally:
+            for task in tasks:
+                task.cancel()
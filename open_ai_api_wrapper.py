@@ -1,57 +1,285 @@
 import asyncio
-from typing import Optional
+import contextlib
+import contextvars
+import importlib.util
+import math
+from collections import Counter, deque
+from collections.abc import Awaitable, Callable, Iterator
+from typing import Optional, Any
 import numpy as np
-from faiss import normalize_L2
 from injector import inject
-from openai import AsyncOpenAI
+from batch_file_exchange import BatchFileExchange
+from compute_executor import ComputeExecutor
 from open_ai_api_wrapper_config import OpenAiApiWrapperConfig
+from pooled_http_transport import PooledHttpTransport
+from token_batcher import TokenBatcher
 import utils
 import logging
 
 
 class OpenAiApiWrapper:
+    BATCH_URLS = {'chat.completions': '/v1/chat/completions', 'embeddings': '/v1/embeddings'}
+    # Latencies kept per server and endpoint for the hedging percentile
+    LATENCY_WINDOW = 256
+    # The usage scopes the requests of the running task count into, see usage_scope
+    __usage_scopes = contextvars.ContextVar('usage_scopes', default=())
+
     __config: OpenAiApiWrapperConfig
     __clients_queue: asyncio.Queue
+    __batch: Optional[BatchFileExchange]
+    __latencies: dict[tuple[str, str], deque]
+    __hedge_stats: Counter
+    __transports: dict[str, PooledHttpTransport]
+    __http_clients: list
+    __in_flight: dict[tuple, asyncio.Future]
+    __coalesce_stats: Counter
+    __usage_stats: Counter
+    __compute_executor: ComputeExecutor
     __logger: Optional[logging.Logger]
 
     @property
     def parallelism(self) -> int:
         return len(self.__config.servers)
 
+    @property
+    def chars_per_token(self) -> float:
+        return self.__config.chars_per_token
+
+    @property
+    def coalesce_stats(self) -> dict[str, int]:
+        """Requests answered by an identical in-flight request or removed as duplicates of an embedding batch"""
+        return dict(self.__coalesce_stats)
+
+    @property
+    def hedge_stats(self) -> dict[str, int]:
+        """Requests sent to a server, duplicates sent to another server after the hedging percentile, and
+        duplicates answering first"""
+        return dict(self.__hedge_stats)
+
+    @property
+    def connection_stats(self) -> dict[str, int]:
+        """Requests that opened a connection or reused a pooled one, by HTTP version, and the gzipped ones"""
+        stats = Counter()
+        for transport in self.__transports.values():
+            stats.update(transport.stats)
+        return dict(stats)
+
+    @property
+    def usage_stats(self) -> dict[str, int]:
+        """Requests sent and tokens reported by the servers, per endpoint. Hedges that lost are counted apart,
+        with the prompt tokens they were estimated to cost when they were cancelled before an answer"""
+        return dict(self.__usage_stats)
+
+    @contextlib.contextmanager
+    def usage_scope(self) -> Iterator[Counter]:
+        """Counts the usage of the requests sent by the current task, and the tasks it starts, while it is entered.
+        Concurrent runs sharing the wrapper each see only their own usage"""
+        scope = Counter()
+        token = self.__usage_scopes.set(self.__usage_scopes.get() + (scope,))
+        try:
+            yield scope
+        finally:
+            try:
+                self.__usage_scopes.reset(token)
+            except ValueError:
+                # An async generator closed by the garbage collector runs its finally in another context
+                pass
+
+    def __count_usage(self, endpoint: str, usage) -> None:
+        counts = Counter({f"{endpoint}.requests": 1})
+        if usage is not None:
+            counts[f"{endpoint}.prompt_tokens"] += getattr(usage, 'prompt_tokens', 0) or 0
+            counts[f"{endpoint}.completion_tokens"] += getattr(usage, 'completion_tokens', 0) or 0
+        self.__count(counts)
+
+    def __count_lost_hedge(self, endpoint: str, task: asyncio.Future, body: dict) -> None:
+        """Counts the request of a hedge that did not win. The servers may bill it even when it was cancelled"""
+        usage = None
+        if task.done() and not task.cancelled() and task.exception() is None:
+            usage = getattr(task.result(), 'usage', None)
+        counts = Counter({f"{endpoint}.hedged_requests": 1})
+        if usage is not None:
+            counts[f"{endpoint}.hedged_prompt_tokens"] += getattr(usage, 'prompt_tokens', 0) or 0
+            counts[f"{endpoint}.hedged_completion_tokens"] += getattr(usage, 'completion_tokens', 0) or 0
+        else:
+            texts = body.get('input') or [message['content'] for message in body.get('messages', [])]
+            estimate = self.token_batcher().estimate_tokens
+            counts[f"{endpoint}.hedged_prompt_tokens"] += sum(estimate(text) for text in
+                                                              ([texts] if isinstance(texts, str) else texts))
+        self.__count(counts)
+
+    def __count(self, counts: Counter) -> None:
+        self.__usage_stats.update(counts)
+        for scope in self.__usage_scopes.get():
+            scope.update(counts)
+
+    def token_batcher(self, max_items_per_request: Optional[int] = None) -> TokenBatcher:
+        max_items = self.__config.max_items_per_request
+        if max_items_per_request:
+            max_items = min(max_items, max_items_per_request)
+        return TokenBatcher(self.__config.max_tokens_per_request, max_items, self.__config.chars_per_token)
+
     @inject
     def __init__(self,
-                 config: OpenAiApiWrapperConfig, logger: Optional[logging.Logger]) -> None:
+                 config: OpenAiApiWrapperConfig, compute_executor: ComputeExecutor,
+                 logger: Optional[logging.Logger]) -> None:
         if not config:
             raise ValueError("config cannot be empty")
         if not isinstance(config, OpenAiApiWrapperConfig):
             raise TypeError("config must be a AiWrapperConfig")
+        if not compute_executor:
+            raise ValueError("compute_executor is missing or empty")
+        if not isinstance(compute_executor, ComputeExecutor):
+            raise TypeError("compute_executor must be an instance of ComputeExecutor")
         if logger and not isinstance(logger, logging.Logger):
             raise TypeError("logger must be an instance of Logger")
+        from openai import AsyncOpenAI
+        import httpx
         self.__config = config
         self.__clients_queue = asyncio.Queue()
+        self.__in_flight = {}
+        self.__coalesce_stats = Counter()
+        self.__usage_stats = Counter()
+        self.__compute_executor = compute_executor
+        timeout = httpx.Timeout(config.read_timeout, connect=config.connect_timeout)
+        http2 = config.http2 and importlib.util.find_spec('h2') is not None
+        if config.http2 and not http2 and logger:
+            logger.debug("HTTP/2 needs the h2 package, using HTTP/1.1")
+        self.__transports = {}
+        http_clients = {}
+        for server in dict.fromkeys(config.servers):
+            # A server listed n times runs up to n requests at once, so the pool keeps n connections open
+            connections = config.max_connections or config.servers.count(server)
+            limits = httpx.Limits(max_connections=connections, max_keepalive_connections=connections,
+                                  keepalive_expiry=config.keepalive_expiry)
+            self.__transports[server] = PooledHttpTransport(httpx.AsyncHTTPTransport(http2=http2, limits=limits),
+                                                            config.gzip_min_bytes)
+            http_clients[server] = httpx.AsyncClient(transport=self.__transports[server], timeout=timeout)
         for server in config.servers:
-            self.__clients_queue.put_nowait(AsyncOpenAI(base_url=server, api_key=config.api_key))
+            # The clients of a server share its pool
+            self.__clients_queue.put_nowait((server, AsyncOpenAI(base_url=server, api_key=config.api_key,
+                                                                 timeout=timeout,
+                                                                 http_client=http_clients[server])))
+        self.__http_clients = list(http_clients.values())
+        self.__batch = BatchFileExchange(config, logger) if config.batch_dir else None
+        self.__latencies = {}
+        self.__hedge_stats = Counter()
         self.__logger = logger
 
-    async def __complete_core(self,  template: str, texts_parts: tuple[str, ...]) -> str:
-        client = await self.__clients_queue.get()
+    async def close(self) -> None:
+        """Closes the connection pools of the servers"""
+        for http_client in self.__http_clients:
+            await http_client.aclose()
+
+    async def __create(self, endpoint: str, body: dict):
+        """The response of the endpoint for the request body, read from the batch files in batch mode"""
+        if self.__batch:
+            from openai.types import CreateEmbeddingResponse
+            from openai.types.chat import ChatCompletion
+            response = await self.__batch.request(self.BATCH_URLS[endpoint], body)
+            return (CreateEmbeddingResponse if endpoint == 'embeddings' else ChatCompletion).model_validate(response)
+        server, client = await self.__clients_queue.get()
+        self.__hedge_stats['requests'] += 1
+        tasks = [asyncio.ensure_future(self.__timed_create(server, client, endpoint, body, True))]
+        winner = None
+        try:
+            delay = self.__hedge_delay(server, endpoint)
+            if delay is not None:
+                done, _ = await asyncio.wait(tasks, timeout=delay)
+                if not done and (other := self.__hedge_client(server)):
+                    self.__hedge_stats['hedged'] += 1
+                    tasks.append(asyncio.ensure_future(self.__timed_create(*other, endpoint, body, False)))
+            # The first answer wins, a failure waits for the other request
+            pending = set(tasks)
+            while True:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                succeeded = [task for task in done if task.exception() is None]
+                if succeeded:
+                    winner = succeeded[0]
+                    if winner is not tasks[0]:
+                        self.__hedge_stats['hedges_won'] += 1
+                    return winner.result()
+                if not pending:
+                    winner = done.pop()
+                    return winner.result()
+        finally:
+            for task in tasks:
+                if not task.done():
+                    task.cancel()
+            # A primary cancelled with its caller is not a hedge, a primary beaten by its hedge is
+            for task in tasks[1:] if winner is None else tasks if len(tasks) > 1 else ():
+                if task is not winner:
+                    self.__count_lost_hedge(endpoint, task, body)
+
+    async def __timed_create(self, server: str, client, endpoint: str, body: dict, primary: bool):
+        latencies = self.__latencies.setdefault((server, endpoint), deque(maxlen=self.LATENCY_WINDOW))
+        timer = utils.Timer()
         try:
-            # noinspection PyArgumentList
-            with utils.Timer() as timer:
-                result = await client.chat.completions.create(
-                    model=self.__config.completion_model,
-                    temperature=self.__config.temperature,
-                    messages=[
-                        {"role": "system", "content": self.__config.system_message},
-                        {"role": "user", "content": template.format(*texts_parts)}
-                    ],
-                    stream=False)
-                completed = result.choices[0].message.content
-            if self.__logger:
-                self.__logger.debug(f"Completed template for {float(timer):.2f}s")
-            return completed
+            with timer:
+                api = client.embeddings if endpoint == 'embeddings' else client.chat.completions
+                result = await api.create(**body)
+            latencies.append(float(timer))
+            return result
+        except asyncio.CancelledError:
+            # A cancelled primary took at least this long, leaving it out would pull the percentile down. A cancelled
+            # hedge only lost the race, its time says nothing about its server
+            if primary:
+                latencies.append(float(timer))
+            raise
         finally:
-            self.__clients_queue.put_nowait(client)
+            self.__clients_queue.put_nowait((server, client))
+
+    def __hedge_delay(self, server: str, endpoint: str) -> Optional[float]:
+        """Seconds after which a request to the server is hedged, None when it is not"""
+        if self.__config.hedge_percentile is None:
+            return None
+        latencies = self.__latencies.get((server, endpoint))
+        if not latencies or len(latencies) < self.__config.hedge_min_samples:
+            return None
+        if self.__hedge_stats['hedged'] >= self.__config.hedge_max_rate * self.__hedge_stats['requests']:
+            return None
+        return float(np.percentile(latencies, self.__config.hedge_percentile))
+
+    def __hedge_client(self, server: str) -> Optional[tuple[str, Any]]:
+        """An idle client of another server, so hedges only use spare capacity"""
+        for _ in range(self.__clients_queue.qsize()):
+            entry = self.__clients_queue.get_nowait()
+            if entry[0] != server:
+                return entry
+            self.__clients_queue.put_nowait(entry)
+        return None
+
+    async def __single_flight(self, key: tuple, request: Callable[[], Awaitable[Any]]) -> Any:
+        future = self.__in_flight.get(key)
+        if future is not None:
+            self.__coalesce_stats[key[0]] += 1
+        else:
+            future = asyncio.ensure_future(request())
+            self.__in_flight[key] = future
+            future.add_done_callback(lambda _: self.__in_flight.pop(key, None))
+        # Cancelling one waiter must not cancel the request the other waiters share
+        return await asyncio.shield(future)
+
+    async def __complete_core(self, template: str, texts_parts: tuple[str, ...]) -> str:
+        key = ('chat.completions', self.__config.completion_model, self.__config.temperature,
+               self.__config.system_message, template.format(*texts_parts))
+        return await self.__single_flight(key, lambda: self.__complete_request(template, texts_parts))
+
+    async def __complete_request(self, template: str, texts_parts: tuple[str, ...]) -> str:
+        with utils.Timer() as timer:
+            result = await self.__create('chat.completions', {
+                'model': self.__config.completion_model,
+                'temperature': self.__config.temperature,
+                'messages': [
+                    {"role": "system", "content": self.__config.system_message},
+                    {"role": "user", "content": template.format(*texts_parts)}
+                ],
+                'stream': False})
+            completed = result.choices[0].message.content
+        self.__count_usage('chat.completions', result.usage)
+        if self.__logger:
+            self.__logger.debug("Completed template for %.2fs", float(timer))
+        return completed
 
     async def complete(self, template: str, texts: list[tuple[str, ...]]) -> list[str]:
         if not template:
@@ -65,15 +293,61 @@ class OpenAiApiWrapper:
         tasks = [asyncio.create_task(self.__complete_core(template, tpl)) for tpl in texts]
         return list(await asyncio.gather(*tasks))
 
+    async def __score_request(self, template: str, texts_parts: tuple[str, ...],
+                              choices: tuple[str, ...]) -> tuple[Optional[str], float]:
+        with utils.Timer() as timer:
+            result = await self.__create('chat.completions', {
+                'model': self.__config.completion_model,
+                'temperature': self.__config.temperature,
+                'messages': [
+                    {"role": "system", "content": self.__config.system_message},
+                    {"role": "user", "content": template.format(*texts_parts)}
+                ],
+                'max_tokens': 1,
+                'logprobs': True,
+                'top_logprobs': min(20, max(5, len(choices))),
+                'stream': False})
+        self.__count_usage('chat.completions.logprobs', result.usage)
+        if self.__logger:
+            self.__logger.debug("Scored template for %.2fs", float(timer))
+        logprobs = result.choices[0].logprobs
+        if not logprobs or not logprobs.content:
+            return None, 0.0
+        probabilities = {}
+        for candidate in logprobs.content[0].top_logprobs:
+            token = candidate.token.strip()
+            if token in choices:
+                probabilities[token] = max(probabilities.get(token, 0.0), math.exp(candidate.logprob))
+        if not probabilities:
+            return None, 0.0
+        best = max(probabilities, key=probabilities.get)
+        return best, probabilities[best] / sum(probabilities.values())
+
+    async def score(self, template: str, texts_parts: tuple[str, ...],
+                    choices: list[str]) -> tuple[Optional[str], float]:
+        """Asks for a single token and returns the most probable of the allowed choices with its probability
+        among them. Returns None when none of the choices is among the most probable tokens"""
+        if not template:
+            raise ValueError("template cannot be empty")
+        if not isinstance(template, str):
+            raise TypeError("template must be a string")
+        if not isinstance(texts_parts, tuple):
+            raise TypeError("texts_parts must be a tuple")
+        if not choices:
+            raise ValueError("choices cannot be empty")
+        if not isinstance(choices, list) or not all(isinstance(choice, str) for choice in choices):
+            raise TypeError("choices must be a list of strings")
+        choices = tuple(choices)
+        key = ('chat.completions.logprobs', self.__config.completion_model, self.__config.temperature,
+               self.__config.system_message, template.format(*texts_parts), choices)
+        return await self.__single_flight(key, lambda: self.__score_request(template, texts_parts, choices))
+
     async def __embed_core(self, texts: list[str]) -> list[list[float]]:
-        client = await self.__clients_queue.get()
-        try:
-            results = await client.embeddings.create(
-                input=[text.replace("\n", " ").replace("\t", " ") for text in texts],
-                model=self.__config.embed_model)
-            return [result.embedding for result in results.data]
-        finally:
-            self.__clients_queue.put_nowait(client)
+        results = await self.__create('embeddings', {
+            'input': [text.replace("\n", " ").replace("\t", " ") for text in texts],
+            'model': self.__config.embed_model})
+        self.__count_usage('embeddings', results.usage)
+        return [result.embedding for result in results.data]
 
     async def embed_normalize(self,
                               texts: list[str]) -> np.ndarray:
@@ -82,12 +356,53 @@ class OpenAiApiWrapper:
         if not isinstance(texts, list) or not all(isinstance(item, str) for item in texts):
             raise TypeError("texts must be a list of strings")
         with utils.Timer() as timer:
-            batches = utils.batch_list(texts, len(texts) // self.parallelism + 1)
-            tasks = [asyncio.create_task(self.__embed_core(batch)) for batch in batches]
-            results = await asyncio.gather(*tasks)
-            # noinspection PyTypeChecker
-            embeddings = np.concatenate(results, axis=0, dtype='float32')
-            normalize_L2(embeddings)
+            unique = list(dict.fromkeys(texts))
+            self.__coalesce_stats['embeddings.duplicates'] += len(texts) - len(unique)
+            vectors = await self.__embed_unique(unique)
+            embeddings = await self.__compute_executor.run(self.__normalized, [vectors[text] for text in texts])
         if self.__logger:
-            self.__logger.debug(f"Embedded {len(embeddings)} sentences for {float(timer):.2f}s")
+            self.__logger.debug("Embedded %d sentences (%d unique) for %.2fs", len(embeddings), len(unique),
+                                float(timer))
         return embeddings
+
+    @staticmethod
+    def __normalized(vectors: list[list[float]]) -> np.ndarray:
+        from faiss import normalize_L2
+        embeddings = np.array(vectors, dtype='float32')
+        normalize_L2(embeddings)
+        return embeddings
+
+    async def __embed_unique(self, texts: list[str]) -> dict[str, list[float]]:
+        keys = {text: ('embeddings', self.__config.embed_model, text) for text in texts}
+        waiting = {text: self.__in_flight[key] for text, key in keys.items() if key in self.__in_flight}
+        self.__coalesce_stats['embeddings'] += len(waiting)
+        to_send = [text for text in texts if text not in waiting]
+        loop = asyncio.get_running_loop()
+        sent = {text: loop.create_future() for text in to_send}
+        for text, future in sent.items():
+            self.__in_flight[keys[text]] = future
+        try:
+            if to_send:
+                batches = self.token_batcher(len(to_send) // self.parallelism + 1).batch(to_send)
+                tasks = [asyncio.create_task(self.__embed_core([to_send[i] for i in batch])) for batch in batches]
+                results = TokenBatcher.restore_order(batches, await asyncio.gather(*tasks))
+                for text, result in zip(to_send, results):
+                    sent[text].set_result(result)
+        except BaseException as e:
+            for future in sent.values():
+                if future.done():
+                    continue
+                if isinstance(e, asyncio.CancelledError):
+                    future.cancel()
+                else:
+                    future.set_exception(e)
+                    # Marks the exception as retrieved when no other call waits for it
+                    future.exception()
+            raise
+        finally:
+            for text in to_send:
+                self.__in_flight.pop(keys[text], None)
+        vectors = {text: future.result() for text, future in sent.items()}
+        for text, future in waiting.items():
+            vectors[text] = await asyncio.shield(future)
+        return vectors
@@ -1,3 +1,4 @@
+from typing import Optional
 import yaml
 
 
@@ -8,6 +9,22 @@ class OpenAiApiWrapperConfig:
     __api_key: str
     __system_message: str
     __temperature: float
+    __max_tokens_per_request: int
+    __max_items_per_request: int
+    __chars_per_token: float
+    __batch_dir: Optional[str]
+    __batch_wait: bool
+    __batch_collect_seconds: float
+    __batch_poll_seconds: float
+    __hedge_percentile: Optional[float]
+    __hedge_max_rate: float
+    __hedge_min_samples: int
+    __max_connections: Optional[int]
+    __keepalive_expiry: float
+    __http2: bool
+    __connect_timeout: float
+    __read_timeout: float
+    __gzip_min_bytes: Optional[int]
 
     @property
     def servers(self) -> list[str]:
@@ -33,6 +50,75 @@ class OpenAiApiWrapperConfig:
     def temperature(self) -> float:
         return self.__temperature
 
+    @property
+    def max_tokens_per_request(self) -> int:
+        return self.__max_tokens_per_request
+
+    @property
+    def max_items_per_request(self) -> int:
+        return self.__max_items_per_request
+
+    @property
+    def chars_per_token(self) -> float:
+        return self.__chars_per_token
+
+    @property
+    def batch_dir(self) -> Optional[str]:
+        return self.__batch_dir
+
+    @property
+    def batch_wait(self) -> bool:
+        return self.__batch_wait
+
+    @property
+    def batch_collect_seconds(self) -> float:
+        return self.__batch_collect_seconds
+
+    @property
+    def batch_poll_seconds(self) -> float:
+        return self.__batch_poll_seconds
+
+    @property
+    def hedge_percentile(self) -> Optional[float]:
+        """Latency percentile of a server after which a request is also sent to another server, None to never hedge"""
+        return self.__hedge_percentile
+
+    @property
+    def hedge_max_rate(self) -> float:
+        """The largest share of the requests that may be hedged"""
+        return self.__hedge_max_rate
+
+    @property
+    def hedge_min_samples(self) -> int:
+        return self.__hedge_min_samples
+
+    @property
+    def max_connections(self) -> Optional[int]:
+        """Connections kept per server, None for as many as the server has entries in servers"""
+        return self.__max_connections
+
+    @property
+    def keepalive_expiry(self) -> float:
+        return self.__keepalive_expiry
+
+    @property
+    def http2(self) -> bool:
+        """Used only where the h2 package is installed"""
+        return self.__http2
+
+    @property
+    def connect_timeout(self) -> float:
+        return self.__connect_timeout
+
+    @property
+    def read_timeout(self) -> float:
+        return self.__read_timeout
+
+    @property
+    def gzip_min_bytes(self) -> Optional[int]:
+        """Request bodies of at least this size are sent gzipped, None to never compress"""
+        return self.__gzip_min_bytes
+
     def __init__(self, config: dict) -> None:
         self.__servers = config.get('servers', [])
         self.__completion_model = config.get('completion_model', '')
@@ -40,10 +126,50 @@ class OpenAiApiWrapperConfig:
         self.__api_key = config.get('api_key', '')
         self.__system_message = config.get('system_message', '')
         self.__temperature = config.get('temperature', 0.7)
+        self.__max_tokens_per_request = config.get('max_tokens_per_request', 8000)
+        self.__max_items_per_request = config.get('max_items_per_request', 256)
+        self.__chars_per_token = config.get('chars_per_token', 4.0)
+        self.__batch_dir = config.get('batch_dir', None)
+        self.__batch_wait = config.get('batch_wait', True)
+        self.__batch_collect_seconds = config.get('batch_collect_seconds', 1.0)
+        self.__batch_poll_seconds = config.get('batch_poll_seconds', 10.0)
+        self.__hedge_percentile = config.get('hedge_percentile', None)
+        self.__hedge_max_rate = config.get('hedge_max_rate', 0.05)
+        self.__hedge_min_samples = config.get('hedge_min_samples', 20)
+        self.__max_connections = config.get('max_connections', None)
+        self.__keepalive_expiry = config.get('keepalive_expiry', 30.0)
+        self.__http2 = config.get('http2', True)
+        self.__connect_timeout = config.get('connect_timeout', 5.0)
+        self.__read_timeout = config.get('read_timeout', 600.0)
+        self.__gzip_min_bytes = config.get('gzip_min_bytes', None)
 
         if (not self.__servers or len(self.__servers) == 0 or not self.__completion_model or not self.__embed_model
                 or not self.__api_key or not self.__system_message or not self.__temperature):
             raise ValueError("One or more required config fields are missing or empty")
+        if self.__max_tokens_per_request < 1 or self.__max_items_per_request < 1 or self.__chars_per_token <= 0:
+            raise ValueError("max_tokens_per_request, max_items_per_request and chars_per_token must be positive")
+        if self.__batch_dir is not None and not isinstance(self.__batch_dir, str):
+            raise TypeError("batch_dir must be a string")
+        if not isinstance(self.__batch_wait, bool):
+            raise TypeError("batch_wait must be a boolean")
+        if self.__batch_collect_seconds < 0 or self.__batch_poll_seconds <= 0:
+            raise ValueError("batch_collect_seconds cannot be negative and batch_poll_seconds must be positive")
+        if self.__hedge_percentile is not None and not 0 < self.__hedge_percentile < 100:
+            raise ValueError("hedge_percentile must be between 0 and 100")
+        if not 0 <= self.__hedge_max_rate <= 1:
+            raise ValueError("hedge_max_rate must be between 0 and 1")
+        if self.__hedge_min_samples < 1:
+            raise ValueError("hedge_min_samples must be positive")
+        if self.__max_connections is not None and (not isinstance(self.__max_connections, int)
+                                                   or self.__max_connections < 1):
+            raise ValueError("max_connections must be a positive integer")
+        if not isinstance(self.__http2, bool):
+            raise TypeError("http2 must be a boolean")
+        if self.__keepalive_expiry < 0 or self.__connect_timeout <= 0 or self.__read_timeout <= 0:
+            raise ValueError("keepalive_expiry cannot be negative, connect_timeout and read_timeout must be positive")
+        if self.__gzip_min_bytes is not None and (not isinstance(self.__gzip_min_bytes, int)
+                                                  or self.__gzip_min_bytes < 0):
+            raise ValueError("gzip_min_bytes must be a non-negative integer")
 
     @classmethod
     def read_config(cls, file_name: str) -> 'OpenAiApiWrapperConfig':
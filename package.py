@@ -4,13 +4,15 @@ from source_item import SourceItem
 
 
 class Package(SourceItem):
+    __slots__ = ('__identity', '__title', '__text_to_match', '__hash')
     __identity: int
     __title: str
-    __description: str
+    __text_to_match: str
+    __hash: int
 
     @property
     def text_to_match(self) -> str:
-        return f"{self.__title} {self.__description}"
+        return self.__text_to_match
 
     @property
     def text_to_filter(self) -> str:
@@ -27,7 +29,11 @@ class Package(SourceItem):
     def __init__(self, identity: int, title: str, description: str) -> None:
         self.__identity = identity
         self.__title = title
-        self.__description = description
+        self.__text_to_match = f"{title} {description}"
+        self.__hash = hash((identity, title, self.__text_to_match, title))
+
+    def __hash__(self):
+        return self.__hash
 
     @classmethod
     def read_csv(cls, csv_path: str) -> list['Package']:
@@ -25,7 +25,8 @@ class PackageCompletionEmbeddingsProvider(CompletionEmbeddingsProvider[Package])
         super().__init__(
             config.package_template,
             wrapper,
-            config.batch_size
+            config.batch_size,
+            config.batch_max_tokens
         )
 
     async def get_embeddings(self, items: Iterable[Package]) -> np.ndarray:
@@ -0,0 +1,78 @@
+import hashlib
+import json
+import os
+from typing import Optional, Iterable
+from injector import inject
+from matching_strategy_config import MatchingStrategyConfig
+from package import Package
+from skill_index_store import SkillIndexStore
+import utils
+
+
+class PackageSnapshot:
+    """Keeps the content hash of every package matched by the last run beside the skill index, per language,
+    so a package edited in the packages source since then is matched again"""
+    SNAPSHOT_FILE = 'packages.json'
+
+    __path: Optional[str]
+    __digests: Optional[dict[str, dict[int, str]]]
+
+    @inject
+    def __init__(self, config: MatchingStrategyConfig) -> None:
+        if not config:
+            raise ValueError("config is missing or empty")
+        if not isinstance(config, MatchingStrategyConfig):
+            raise TypeError("config must be an instance of MatchingStrategyConfig")
+        self.__path = None
+        if config.skill_index_path:
+            self.__path = os.path.join(config.skill_index_path, PackageSnapshot.SNAPSHOT_FILE)
+        self.__digests = None
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self.__path)
+
+    @staticmethod
+    def digest(package: Package) -> str:
+        return hashlib.sha1(f"{package.label}\n{package.text_to_match}".encode('utf-8')).hexdigest()
+
+    def __load(self) -> dict[str, dict[int, str]]:
+        if self.__digests is None:
+            self.__digests = {}
+            if self.__path and os.path.exists(self.__path):
+                with open(self.__path, 'r', encoding='utf-8') as file:
+                    self.__digests = {language: {int(key): value for key, value in digests.items()}
+                                      for language, digests in json.load(file).items()}
+        return self.__digests
+
+    def changed(self, packages: Iterable[Package], language: Optional[str] = None) -> set[int]:
+        """Ids of the packages whose content differs from the snapshot. Packages it does not know are left out"""
+        digests = self.__load().get(language or '', {})
+        return {package.key for package in packages
+                if package.key in digests and digests[package.key] != self.digest(package)}
+
+    def affected(self, diff: Optional[SkillIndexStore.Diff], packages: list[Package], stored: dict[int, int],
+                 language: Optional[str] = None, pending: Iterable[int] = ()) -> list[Package]:
+        """Packages new since the snapshot, packages edited since then, packages matched to a skill the skill diff
+        changed or removed, unmatched packages once skills were added or changed, and the pending ones"""
+        known = self.__load().get(language or '', {})
+        edited = self.changed(packages, language) | set(pending)
+        affected_skills = set(diff.changed) | set(diff.removed) if diff is not None else set()
+        # An unmatched package only finds a match again when there are skills it has not been matched against
+        new_skills = diff is not None and bool(diff.added or diff.changed)
+        return [package for package in packages
+                if package.key not in known or package.key in edited
+                or (stored[package.key] in affected_skills if package.key in stored else new_skills)]
+
+    def update(self, packages: Iterable[Package], language: Optional[str] = None) -> None:
+        self.__load()[language or ''] = {package.key: self.digest(package) for package in packages}
+
+    def save(self) -> None:
+        if not self.__path or self.__digests is None:
+            return
+        os.makedirs(os.path.dirname(self.__path), exist_ok=True)
+        temp_path = utils.temp_path_beside(self.__path)
+        with open(temp_path, 'w', encoding='utf-8') as file:
+            json.dump({language: {str(key): value for key, value in digests.items()}
+                       for language, digests in self.__digests.items()}, file)
+        os.replace(temp_path, self.__path)
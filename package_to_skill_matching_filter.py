@@ -1,17 +1,56 @@
 import asyncio
+import importlib
+import itertools
+import json
+import os
+from collections.abc import AsyncIterator, Callable
 from typing import Optional
+import numpy as np
 from injector import inject
 from matching_strategy_config import MatchingStrategyConfig
 from open_ai_api_wrapper import OpenAiApiWrapper
 from package import Package
 from matching_filter import MatchingFilter
 from skill import Skill
+import utils
 import logging
 
 
 class PackageToSkillMatchingFilter(MatchingFilter[Package, Skill]):
+    """Asks the completion model to pick between the two nearest skills of every candidate above
+    min_distance_to_consider. Candidates go out in filter_priority order while the request and token budgets
+    of the run last; the rest are deferred, and kept in filter_deferred_path for the next run"""
+    # Decisions running at once per server when filter_max_in_flight is not set
+    IN_FLIGHT_PER_SERVER = 4
+
+    class ForLanguage(MatchingFilter[Package, Skill]):
+        """The filter deciding the candidates of the packages of one programming language"""
+        __filter: 'PackageToSkillMatchingFilter'
+        __language: Optional[str]
+
+        def __init__(self, matching_filter: 'PackageToSkillMatchingFilter', language: Optional[str]) -> None:
+            self.__filter = matching_filter
+            self.__language = language
+
+        @property
+        def decision_tier(self) -> str:
+            return self.__filter.decision_tier
+
+        async def choose_best_matches(self, batch: MatchingFilter.MatchBatch[Package, Skill]) -> dict[int, Skill]:
+            return await self.__filter.choose_best_matches(batch, self.__language)
+
+        def stream_best_matches(self, batch: MatchingFilter.MatchBatch[Package, Skill], portion_size: int = 0
+                                ) -> AsyncIterator[dict[int, Skill]]:
+            return self.__filter.stream_best_matches(batch, portion_size, self.__language)
+
     __wrapper: OpenAiApiWrapper
     __config: MatchingStrategyConfig
+    __in_flight: Optional[asyncio.Semaphore]
+    __scorer: Optional[Callable[[MatchingFilter.MatchBatch[Package, Skill], np.ndarray], np.ndarray]]
+    __spent_requests: int
+    __spent_tokens: int
+    __exhausted: bool
+    __deferred: Optional[dict[tuple[str, int], dict]]
     __logger: Optional[logging.Logger]
 
     @inject
@@ -30,17 +69,174 @@ class PackageToSkillMatchingFilter(MatchingFilter[Package, Skill]):
             raise TypeError("logger must be an instance of Logger")
         self.__wrapper = wrapper
         self.__config = config
+        # Shared by every batch, so concurrent jobs stay within the limit together
+        self.__in_flight = asyncio.Semaphore(config.filter_max_in_flight) if config.filter_max_in_flight else None
+        self.__scorer = None
+        if config.filter_priority not in (MatchingStrategyConfig.PRIORITY_NONE,
+                                          MatchingStrategyConfig.PRIORITY_DISTANCE,
+                                          MatchingStrategyConfig.PRIORITY_MARGIN):
+            module_name, _, function_name = config.filter_priority.partition(':')
+            self.__scorer = getattr(importlib.import_module(module_name), function_name)
+            if not callable(self.__scorer):
+                raise TypeError("filter_priority must name a function")
+        self.__spent_requests = 0
+        self.__spent_tokens = 0
+        self.__exhausted = False
+        self.__deferred = None
         self.__logger = logger
 
-    def log_match(self, package: Package, skill1: Skill, skill2: Skill, match: Optional[Skill]) -> None:
-        if self.__logger:
-            self.__logger.info(f"Matched {package.label[:50]:<40} with {skill1.label[:50]:<40} "
-                               f"and {skill2.label[:50]:<40} as {match.label[:50] if match else 'None'}")
+    @property
+    def decision_tier(self) -> str:
+        return self.__config.filter_mode
+
+    def for_language(self, language: Optional[str]) -> MatchingFilter[Package, Skill]:
+        return PackageToSkillMatchingFilter.ForLanguage(self, language) if language else self
+
+    @property
+    def spent_requests(self) -> int:
+        return self.__spent_requests
+
+    @property
+    def spent_tokens(self) -> int:
+        """Estimated from the length of the prompts"""
+        return self.__spent_tokens
+
+    @property
+    def deferred_count(self) -> int:
+        return len(self.__load_deferred())
+
+    def reset_budget(self) -> None:
+        """Starts a new run with the whole request and token budget"""
+        self.__spent_requests = 0
+        self.__spent_tokens = 0
+        self.__exhausted = False
+
+    def __load_deferred(self) -> dict[tuple[str, int], dict]:
+        if self.__deferred is None:
+            self.__deferred = {}
+            path = self.__config.filter_deferred_path
+            if path and os.path.exists(path):
+                with open(path, 'r', encoding='utf-8') as file:
+                    languages = json.load(file)
+                if any('first_skill_id' in states for states in languages.values()):
+                    # Written before the candidates were kept per language
+                    languages = {'': languages}
+                # Kept per programming language, the packages of different languages share their ids
+                self.__deferred = {(language, int(key)): state
+                                   for language, states in languages.items() for key, state in states.items()}
+        return self.__deferred
+
+    def save_deferred(self) -> None:
+        path = self.__config.filter_deferred_path
+        if not path or self.__deferred is None:
+            return
+        languages = {}
+        for (language, key), state in self.__deferred.items():
+            languages.setdefault(language, {})[str(key)] = state
+        temp_path = utils.temp_path_beside(path)
+        with open(temp_path, 'w', encoding='utf-8') as file:
+            json.dump(languages, file)
+        os.replace(temp_path, path)
+
+    def deferred_keys(self, language: Optional[str] = None) -> set[int]:
+        """Ids of the packages with candidates deferred by an earlier run"""
+        language = language or ''
+        return {key for deferred_language, key in self.__load_deferred() if deferred_language == language}
+
+    def deferred_batch(self, skills: dict[int, Skill], packages: list[Package], language: Optional[str] = None
+                       ) -> Optional[MatchingFilter.MatchBatch[Package, Skill]]:
+        """The candidates deferred by an earlier run for the given packages, while both their skills still exist"""
+        deferred = self.__load_deferred()
+        language = language or ''
+        rows = [(i, state) for i, package in enumerate(packages) if (state := deferred.get((language, package.key)))
+                and state['first_skill_id'] in skills and state['second_skill_id'] in skills]
+        if not rows:
+            return None
+        return MatchingFilter.MatchBatch[Package, Skill](
+            terms=packages,
+            matches=skills,
+            term_indexes=np.array([i for i, _ in rows], dtype=np.int64),
+            first_keys=np.array([state['first_skill_id'] for _, state in rows], dtype=np.int64),
+            first_distances=np.array([state['first_distance'] for _, state in rows], dtype=np.float32),
+            second_keys=np.array([state['second_skill_id'] for _, state in rows], dtype=np.int64),
+            second_distances=np.array([state['second_distance'] for _, state in rows], dtype=np.float32))
+
+    def __prioritized(self, batch: MatchingFilter.MatchBatch[Package, Skill], rows: np.ndarray) -> np.ndarray:
+        match self.__config.filter_priority:
+            case MatchingStrategyConfig.PRIORITY_NONE:
+                return rows
+            case MatchingStrategyConfig.PRIORITY_DISTANCE:
+                scores = batch.first_distances[rows]
+            case MatchingStrategyConfig.PRIORITY_MARGIN:
+                # A small margin between the two candidates is where the model's pick changes the outcome most
+                scores = batch.second_distances[rows] - batch.first_distances[rows]
+            case _:
+                scores = np.asarray(self.__scorer(batch, rows), dtype=np.float64)
+        return rows[np.argsort(-scores, kind='stable')]
+
+    def __admit(self, entry: MatchingFilter.MatchEntry[Package, Skill]) -> bool:
+        max_requests, max_tokens = self.__config.filter_max_requests, self.__config.filter_max_tokens
+        if max_requests is not None and self.__spent_requests >= max_requests:
+            return self.__refuse()
+        prompt = self.__config.filter_template.format(entry.terms.text_to_filter,
+                                                      entry.first_match.text_to_filter,
+                                                      entry.second_match.text_to_filter)
+        tokens = self.__wrapper.token_batcher().estimate_tokens(prompt) + 1
+        if max_tokens is not None and self.__spent_tokens + tokens > max_tokens:
+            return self.__refuse()
+        self.__spent_requests += 1
+        self.__spent_tokens += tokens
+        return True
+
+    def __refuse(self) -> bool:
+        if not self.__exhausted and self.__logger:
+            self.__logger.warning(f"Filter budget exhausted after {self.__spent_requests} requests and "
+                                  f"~{self.__spent_tokens} tokens, deferring the remaining candidates of the run")
+        self.__exhausted = True
+        return False
+
+    def __defer(self, entry: MatchingFilter.MatchEntry[Package, Skill], language: Optional[str]) -> None:
+        deferred = {
+            'first_skill_id': entry.first_match.key,
+            'first_distance': entry.first_distance,
+            'second_skill_id': entry.second_match.key,
+            'second_distance': entry.second_distance
+        }
+        self.__load_deferred()[(language or '', entry.terms.key)] = deferred
+
+    def log_match(self, package: Package, skill1: Skill, skill2: Skill, match: Optional[Skill],
+                  confidence: Optional[float] = None) -> None:
+        if not self.__logger or not self.__logger.isEnabledFor(logging.INFO):
+            return
+        # Formatted by the logging thread, and only for the records the sampling keeps
+        extra = {'sampled': True, 'package_id': package.key, 'first_skill_id': skill1.key,
+                 'second_skill_id': skill2.key, 'skill_id': match.key if match else None, 'confidence': confidence}
+        if confidence is None:
+            self.__logger.info("Matched %-40.50s with %-40.50s and %-40.50s as %.50s",
+                               package.label, skill1.label, skill2.label, match.label if match else None, extra=extra)
+        else:
+            self.__logger.info("Matched %-40.50s with %-40.50s and %-40.50s as %.50s (%.2f)",
+                               package.label, skill1.label, skill2.label, match.label if match else None, confidence,
+                               extra=extra)
+
+    async def __score_match(self, match: MatchingFilter.MatchEntry[Package, Skill]) -> Optional[Skill]:
+        choice, confidence = await self.__wrapper.score(self.__config.filter_template,
+                                                        (match.terms.text_to_filter,
+                                                         match.first_match.text_to_filter,
+                                                         match.second_match.text_to_filter),
+                                                        ['0', '1', '2'])
+        result = None
+        if confidence >= self.__config.filter_min_confidence:
+            result = {'1': match.first_match, '2': match.second_match}.get(choice)
+        self.log_match(match.terms, match.first_match, match.second_match, result, confidence)
+        return result
 
     async def __choose_best_match_for_term_core(self,
                                                 match: MatchingFilter.MatchEntry[Package, Skill]) -> Optional[Skill]:
         if match.first_distance < self.__config.min_distance_to_consider:
             return None
+        if self.__config.filter_mode == MatchingStrategyConfig.FILTER_MODE_LOGPROBS:
+            return await self.__score_match(match)
         for _ in range(3):
             try:
                 ai_response = await self.__wrapper.complete(self.__config.filter_template,
@@ -61,12 +257,83 @@ class PackageToSkillMatchingFilter(MatchingFilter[Package, Skill]):
                 pass
         return match.first_match
 
-    async def choose_best_match_for_term(self,
-                                         matches: list[MatchingFilter.MatchEntry[Package, Skill]]
-                                         ) -> list[Optional[Skill]]:
-        filtered_list = [match for match in matches if match.first_distance >= self.__config.min_distance_to_consider]
+    async def __choose_best_match_for_entry(self, entry: MatchingFilter.MatchEntry[Package, Skill],
+                                            admit: Callable[[MatchingFilter.MatchEntry[Package, Skill]], bool],
+                                            language: Optional[str]) -> Optional[Skill]:
+        if not admit(entry):
+            self.__defer(entry, language)
+            return None
+        self.__load_deferred().pop((language or '', entry.terms.key), None)
+        return await self.__choose_best_match_for_term_core(entry)
+
+    async def __choose_best_match_for_row(self, batch: MatchingFilter.MatchBatch[Package, Skill], row: int,
+                                          admit: Callable[[MatchingFilter.MatchEntry[Package, Skill]], bool],
+                                          language: Optional[str]) -> Optional[Skill]:
+        # The entry is built only once the request may go out, so a started row holds nothing but its task.
+        # Tasks start, and wait for the semaphore, in the order they were created, so the budget goes to the
+        # rows of the highest priority
+        if not self.__in_flight:
+            return await self.__choose_best_match_for_entry(batch.entry(row), admit, language)
+        async with self.__in_flight:
+            return await self.__choose_best_match_for_entry(batch.entry(row), admit, language)
+
+    async def __decide_row(self, batch: MatchingFilter.MatchBatch[Package, Skill], row: int,
+                           admit: Callable[[MatchingFilter.MatchEntry[Package, Skill]], bool],
+                           language: Optional[str]) -> tuple[int, Optional[Skill]]:
+        return row, await self.__choose_best_match_for_row(batch, row, admit, language)
+
+    async def stream_best_matches(self, batch: MatchingFilter.MatchBatch[Package, Skill], portion_size: int = 0,
+                                  language: Optional[str] = None) -> AsyncIterator[dict[int, Skill]]:
+        rows = self.__prioritized(batch, np.flatnonzero(batch.first_distances
+                                                        >= self.__config.min_distance_to_consider))
         if self.__logger:
-            self.__logger.info(f"Filtering {len(matches)} matches to {len(filtered_list)}")
-        task = [asyncio.create_task(self.__choose_best_match_for_term_core(match))
-                for match in filtered_list]
-        return list(await asyncio.gather(*task))
+            self.__logger.info(f"Filtering {batch.size} matches to {len(rows)}")
+        admitted, deferred = 0, 0
+
+        def admit(entry: MatchingFilter.MatchEntry[Package, Skill]) -> bool:
+            nonlocal admitted, deferred
+            limit = self.__config.filter_max_requests_per_iteration
+            if (limit is not None and admitted >= limit) or not self.__admit(entry):
+                deferred += 1
+                return False
+            admitted += 1
+            return True
+
+        # Tasks are created as earlier ones finish, so a large batch holds only a window of them
+        waiting = iter(rows)
+        tasks = set()
+
+        def start(count: int) -> None:
+            for row in itertools.islice(waiting, count):
+                tasks.add(asyncio.create_task(self.__decide_row(batch, int(row), admit, language)))
+
+        start(self.__config.filter_max_in_flight or self.IN_FLIGHT_PER_SERVER * self.__wrapper.parallelism)
+        try:
+            portion = {}
+            while tasks:
+                done, _ = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+                tasks -= done
+                start(len(done))
+                for decided in done:
+                    row, match = decided.result()
+                    if match:
+                        portion[row] = match
+                    if portion_size and len(portion) >= portion_size:
+                        yield portion
+                        portion = {}
+            if portion:
+                yield portion
+        finally:
+            # A consumer leaving early takes no more decisions
+            for task in tasks:
+                task.cancel()
+        if deferred and self.__logger:
+            self.__logger.info(f"Deferred {deferred} of {len(rows)} candidates over the filter budget, "
+                               f"spent {self.__spent_requests} requests and ~{self.__spent_tokens} tokens")
+
+    async def choose_best_matches(self, batch: MatchingFilter.MatchBatch[Package, Skill],
+                                  language: Optional[str] = None) -> dict[int, Skill]:
+        best_matches = {}
+        async for portion in self.stream_best_matches(batch, language=language):
+            best_matches.update(portion)
+        return best_matches
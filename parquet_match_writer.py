@@ -0,0 +1,128 @@
+import os
+from typing import Optional, Iterable
+from match_writer import MatchWriter
+from matching_strategy_config import MatchingStrategyConfig
+import utils
+
+
+class ParquetMatchWriter(MatchWriter):
+    """Buffers the matches into row groups of output_row_group_size rows and writes them to a Parquet file beside
+    the output, which replaces the output on finalize. The row groups of an existing output are copied first,
+    so the run appends to it. Nothing is published before finalize, a failed run leaves the output as it was.
+    Needs pyarrow"""
+    SCHEME = 'parquet://'
+
+    __path: str
+    __row_group_size: int
+    __temp_path: Optional[str]
+    __writer: Optional[object]
+    __buffer: list[MatchWriter.Record]
+    __removed: set[tuple[Optional[str], int]]
+
+    def __init__(self, path: str, config: MatchingStrategyConfig):
+        if not path:
+            raise ValueError("path cannot be empty")
+        if not isinstance(path, str):
+            raise TypeError("path must be a string")
+        super().__init__(config)
+        self.__path = path
+        self.__row_group_size = config.output_row_group_size
+        self.__temp_path = None
+        self.__writer = None
+        self.__buffer = []
+        self.__removed = set()
+
+    @staticmethod
+    def schema():
+        import pyarrow as pa
+        return pa.schema([('programming_language_name', pa.string()),
+                          ('package_name', pa.string()),
+                          ('package_id', pa.int64()),
+                          ('skill_name', pa.string()),
+                          ('skill_id', pa.int64()),
+                          ('match_source', pa.string()),
+                          ('decision_tier', pa.string()),
+                          ('iteration', pa.int32()),
+                          ('first_distance', pa.float32()),
+                          ('second_distance', pa.float32())])
+
+    def __enter__(self):
+        if self.__writer:
+            return self
+        import pyarrow.parquet as pq
+        schema = self.schema()
+        self.__temp_path = utils.temp_path_beside(self.__path)
+        self.__writer = pq.ParquetWriter(self.__temp_path, schema)
+        if os.path.exists(self.__path):
+            existing = pq.ParquetFile(self.__path)
+            if not existing.schema_arrow.equals(schema):
+                raise ValueError(f"{self.__path} was written with a different schema and cannot be appended to")
+            for i in range(existing.num_row_groups):
+                self.__writer.write_table(self.__without_removed(existing.read_row_group(i)))
+        return self
+
+    def __without_removed(self, table):
+        if not self.__removed:
+            return table
+        import pyarrow as pa
+        keep = [key not in self.__removed for key in zip(table.column('programming_language_name').to_pylist(),
+                                                         table.column('package_id').to_pylist())]
+        return table.filter(pa.array(keep, type=pa.bool_()))
+
+    def read_records(self) -> Iterable[MatchWriter.Record]:
+        if not os.path.exists(self.__path):
+            return []
+        import pyarrow.parquet as pq
+        return [MatchWriter.Record(**row) for row in pq.read_table(self.__path).to_pylist()]
+
+    def remove_records(self, keys: set[tuple[Optional[str], int]]) -> None:
+        if not isinstance(keys, set):
+            raise TypeError("keys must be a set")
+        if self.__writer:
+            raise ValueError("remove_records must be called before the first portion")
+        self.__removed |= keys
+
+    def __flush(self) -> None:
+        if not self.__buffer:
+            return
+        import pyarrow as pa
+        schema = self.schema()
+        columns = zip(*self.__buffer)
+        table = pa.Table.from_arrays([pa.array(column, type=field.type) for column, field in zip(columns, schema)],
+                                     schema=schema)
+        self.__writer.write_table(table, row_group_size=self.__row_group_size)
+        self.__buffer = []
+
+    def write_records(self, records: list[MatchWriter.Record]) -> None:
+        if not records:
+            raise ValueError("records cannot be empty")
+        if not isinstance(records, list):
+            raise TypeError("records must be a list")
+        if not utils.all_instances_of(records, MatchWriter.Record):
+            raise TypeError("records must be a list of MatchWriter.Record")
+        self.__buffer.extend(records)
+        if len(self.__buffer) >= self.__row_group_size:
+            self.__flush()
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        # Portions are smaller than a row group, so the buffer is kept until it fills up or the run ends
+        return False
+
+    def finalize(self) -> None:
+        self.__enter__()
+        self.__flush()
+        self.__writer.close()
+        self.__writer = None
+        os.replace(self.__temp_path, self.__path)
+        self.__temp_path = None
+        self.__removed = set()
+
+    def abort(self) -> None:
+        self.__buffer = []
+        self.__removed = set()
+        if self.__writer:
+            self.__writer.close()
+            self.__writer = None
+        if self.__temp_path:
+            os.remove(self.__temp_path)
+            self.__temp_path = None
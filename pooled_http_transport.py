@@ -0,0 +1,59 @@
+import gzip
+from collections import Counter
+from typing import Optional
+import httpx
+
+
+class PooledHttpTransport(httpx.AsyncBaseTransport):
+    """Sends the requests of one server through a connection pool, gzips request bodies of at least
+    gzip_min_bytes and counts the requests that had to open a connection and the ones that reused one"""
+    __transport: httpx.AsyncBaseTransport
+    __gzip_min_bytes: Optional[int]
+    __stats: Counter
+
+    def __init__(self, transport: httpx.AsyncBaseTransport, gzip_min_bytes: Optional[int] = None) -> None:
+        if not transport:
+            raise ValueError("transport is missing or empty")
+        if not isinstance(transport, httpx.AsyncBaseTransport):
+            raise TypeError("transport must be an instance of AsyncBaseTransport")
+        self.__transport = transport
+        self.__gzip_min_bytes = gzip_min_bytes
+        self.__stats = Counter()
+
+    @property
+    def stats(self) -> dict[str, int]:
+        return dict(self.__stats)
+
+    async def __compressed(self, request: httpx.Request) -> httpx.Request:
+        if self.__gzip_min_bytes is None or 'content-encoding' in request.headers:
+            return request
+        body = await request.aread()
+        if len(body) < self.__gzip_min_bytes:
+            return request
+        compressed = gzip.compress(body, compresslevel=5)
+        headers = request.headers.copy()
+        headers['Content-Encoding'] = 'gzip'
+        headers['Content-Length'] = str(len(compressed))
+        self.__stats['gzipped'] += 1
+        self.__stats['gzip_saved_bytes'] += len(body) - len(compressed)
+        return httpx.Request(request.method, request.url, headers=headers, content=compressed,
+                             extensions=request.extensions)
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        request = await self.__compressed(request)
+        connected = False
+
+        async def trace(event: str, _: dict) -> None:
+            nonlocal connected
+            if event == 'connection.connect_tcp.complete':
+                connected = True
+
+        request.extensions = dict(request.extensions, trace=trace)
+        response = await self.__transport.handle_async_request(request)
+        self.__stats['requests'] += 1
+        self.__stats['new_connections' if connected else 'reused_connections'] += 1
+        self.__stats[response.extensions.get('http_version', b'HTTP/1.1').decode('ascii')] += 1
+        return response
+
+    async def aclose(self) -> None:
+        await self.__transport.aclose()
@@ -0,0 +1,120 @@
+import asyncio
+from collections import Counter
+from typing import Generic, TypeVar, Iterable, Optional
+import numpy as np
+from embeddings_provider import EmbeddingsProvider
+from source_item import SourceItem
+import logging
+
+P = TypeVar('P', bound=SourceItem)
+
+
+class PrefetchingEmbeddingsProvider(Generic[P], EmbeddingsProvider[P, np.ndarray]):
+    """Wraps a provider so embeddings of items can be requested ahead of time. get_embeddings takes the prefetched
+    rows it finds and embeds only the rest. Prefetches of items that are never asked for are cancelled"""
+    __provider: EmbeddingsProvider[P, np.ndarray]
+    __pending: dict[P, tuple[asyncio.Task, int]]
+    __task_items: dict[asyncio.Task, set[P]]
+    __stats: Counter
+    __logger: Optional[logging.Logger]
+
+    def __init__(self, provider: EmbeddingsProvider[P, np.ndarray], logger: Optional[logging.Logger] = None) -> None:
+        if not provider:
+            raise ValueError("provider is missing or empty")
+        if not isinstance(provider, EmbeddingsProvider):
+            raise TypeError("provider must be an instance of EmbeddingsProvider")
+        if logger and not isinstance(logger, logging.Logger):
+            raise TypeError("logger must be an instance of Logger")
+        self.__provider = provider
+        self.__pending = {}
+        self.__task_items = {}
+        self.__stats = Counter()
+        self.__logger = logger
+
+    @property
+    def stats(self) -> dict[str, int]:
+        return dict(self.__stats)
+
+    def prefetch(self, items: Iterable[P]) -> None:
+        items = [item for item in dict.fromkeys(items) if item not in self.__pending]
+        if not items:
+            return
+        task = asyncio.create_task(self.__provider.get_embeddings(items))
+        # A failed prefetch nobody asks for any more must not be reported as a never retrieved exception
+        task.add_done_callback(lambda done: done.cancelled() or done.exception())
+        self.__task_items[task] = set(items)
+        for position, item in enumerate(items):
+            self.__pending[item] = (task, position)
+        self.__stats['prefetched'] += len(items)
+        if self.__logger:
+            self.__logger.debug(f"Prefetching embeddings of {len(items)} items")
+
+    def discard(self, items: Iterable[P]) -> None:
+        for item in items:
+            entry = self.__pending.pop(item, None)
+            if entry is None:
+                continue
+            self.__stats['discarded'] += 1
+            task = entry[0]
+            remaining = self.__task_items[task]
+            remaining.discard(item)
+            if not remaining:
+                del self.__task_items[task]
+                task.cancel()
+
+    def discard_all(self) -> None:
+        self.discard(list(self.__pending))
+
+    async def get_embeddings(self, items: Iterable[P]) -> np.ndarray:
+        self.raise_when_bad_items(items)
+        items = list(items)
+        taken: dict[int, tuple[asyncio.Task, int]] = {}
+        for row, item in enumerate(items):
+            entry = self.__pending.pop(item, None)
+            if entry is not None:
+                taken[row] = entry
+        try:
+            # Whatever is still pending was prefetched for items that got matched in the meantime. The taken items
+            # stay in their tasks until awaited, so a task still owing rows here is never cancelled
+            self.discard_all()
+            rows = {}
+            for task in {task for task, _ in taken.values()}:
+                if task.cancelled():
+                    continue
+                try:
+                    rows[task] = await task
+                except Exception as e:
+                    if self.__logger:
+                        self.__logger.warning(f"Prefetch failed, embedding again: {e}")
+        finally:
+            self.__release([items[row] for row in taken], {task for task, _ in taken.values()})
+        missing = [row for row, (task, _) in taken.items() if task not in rows]
+        missing += [row for row in range(len(items)) if row not in taken]
+        missing.sort()
+        self.__stats['hits'] += len(items) - len(missing)
+        self.__stats['misses'] += len(missing)
+        fresh = await self.__provider.get_embeddings([items[row] for row in missing]) if missing else None
+        embeddings = None
+        for row, (task, position) in taken.items():
+            if task in rows:
+                embeddings = self.__put(embeddings, len(items), row, rows[task][position])
+        for index, row in enumerate(missing):
+            embeddings = self.__put(embeddings, len(items), row, fresh[index])
+        return embeddings
+
+    def __release(self, items: list[P], tasks: set[asyncio.Task]) -> None:
+        for task in tasks:
+            remaining = self.__task_items.get(task)
+            if remaining is None:
+                continue
+            remaining.difference_update(items)
+            if not remaining:
+                del self.__task_items[task]
+                task.cancel()
+
+    @staticmethod
+    def __put(embeddings: Optional[np.ndarray], size: int, row: int, vector: np.ndarray) -> np.ndarray:
+        if embeddings is None:
+            embeddings = np.empty((size, vector.shape[0]), dtype=vector.dtype)
+        embeddings[row] = vector
+        return embeddings
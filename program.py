@@ -1,12 +1,11 @@
 import sys
 from typing import Optional
-
-from injector import Injector
-import asyncio
-from app_module import AppModule
-from main import Main
 import getopt
 import logging
+from memory_budget import MemoryBudget
+
+USAGE = ('program.py -s <skillsfile> [-p <packagesfile>] -o <outputfile> -c <configfile> [-l <host:port>] '
+         '[-m <memory budget, e.g. 4G>]')
 
 
 def main(argv):
@@ -14,16 +13,19 @@ def main(argv):
     packages_source_path: Optional[str] = None
     output_path: Optional[str] = None
     config_path: Optional[str] = None
+    listen: Optional[str] = None
+    memory_budget: Optional[int] = None
     log_level: int = logging.INFO
 
     try:
-        opts, args = getopt.getopt(argv, "hvs:p:o:c:", ["skills=", "packages=", "output=", "config="])
+        opts, args = getopt.getopt(argv, "hvs:p:o:c:l:m:", ["skills=", "packages=", "output=", "config=", "listen=",
+                                                             "memory-budget="])
     except getopt.GetoptError:
-        print('program.py -s <skillsfile> -p <packagesfile> -o <outputfile> -c <configfile>')
+        print(USAGE)
         sys.exit(2)
     for opt, arg in opts:
         if opt == '-h':
-            print('program.py -s <skillsfile> -p <packagesfile> -o <outputfile> -c <configfile>')
+            print(USAGE)
             sys.exit()
         elif opt in ("-s", "--skills"):
             skills_source_path = arg
@@ -33,14 +35,36 @@ def main(argv):
             output_path = arg
         elif opt in ("-c", "--config"):
             config_path = arg
+        elif opt in ("-l", "--listen"):
+            listen = arg
+        elif opt in ("-m", "--memory-budget"):
+            try:
+                memory_budget = MemoryBudget.parse_size(arg)
+            except ValueError as e:
+                print(e)
+                sys.exit(2)
         elif opt in "-v":
             log_level = logging.DEBUG
 
-    if not skills_source_path or not packages_source_path or not output_path or not config_path:
-        print('program.py -s <skillsfile> -p <packagesfile> -o <outputfile> -c <configfile>')
+    # The packages file may be omitted when the config defines per-language jobs or the program serves lookups
+    host, _, port = (listen or '').rpartition(':')
+    if not skills_source_path or not output_path or not config_path or (listen and not (host and port.isdigit())):
+        print(USAGE)
         sys.exit(2)
 
-    app_module = AppModule(skills_source_path, packages_source_path, output_path, config_path, log_level)
+    # Heavy dependencies are imported only once the arguments are known to be complete
+    from injector import Injector
+    import asyncio
+    from app_module import AppModule
+    from main import Main
+    from matching_strategy_config import MatchingStrategyConfig
+
+    try:
+        app_module = AppModule(skills_source_path, packages_source_path, output_path, config_path, log_level,
+                               service=bool(listen), memory_budget=memory_budget)
+    except (OSError, ValueError, TypeError) as e:
+        print(f"Invalid configuration: {e}")
+        sys.exit(2)
     injector = Injector(app_module)
     logger = injector.get(logging.Logger)
     logger.info("Starting the program")
@@ -48,8 +72,25 @@ def main(argv):
     logger.info(f"Packages source path: %s", packages_source_path)
     logger.info(f"Output path: %s", output_path)
     logger.info(f"Config path: %s", config_path)
+    if memory_budget:
+        config = injector.get(MatchingStrategyConfig)
+        logger.info(f"Memory budget: {memory_budget / 2 ** 20:.0f} MiB, batch size {config.batch_size}, "
+                    f"search chunk {config.search_chunk_size} rows, {config.filter_max_in_flight} filter requests "
+                    f"in flight")
 
-    asyncio.run(injector.get(Main).run())
+    if listen:
+        from matching_http_server import MatchingHttpServer
+        try:
+            asyncio.run(injector.get(MatchingHttpServer).serve(host, int(port)))
+        except KeyboardInterrupt:
+            logger.info("Stopped serving")
+    else:
+        from batch_file_exchange import BatchFileExchange
+        try:
+            asyncio.run(injector.get(Main).run())
+        except BatchFileExchange.Submitted as e:
+            logger.info(f"Stopped to wait for the batch: {e}")
+            sys.exit(3)
 
 
 if __name__ == "__main__":
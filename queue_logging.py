@@ -0,0 +1,60 @@
+import atexit
+import logging
+import queue
+import threading
+from logging.handlers import QueueHandler, QueueListener
+from typing import Optional
+from custom_log_formatter import CustomLogFormatter
+from json_log_formatter import JsonLogFormatter
+from matching_strategy_config import MatchingStrategyConfig
+from sampling_log_filter import SamplingLogFilter
+
+
+class QueueLogging:
+    """Keeps formatting and writing log records off the event loop: loggers only put records on a queue, a listener
+    thread formats them and writes them to the console and the log file. Handlers and the thread are set up once
+    per process, setting up again only changes the level, format and sampling"""
+    LOG_PATH = 'application_module.log'
+    TEXT_FORMAT = '%(asctime)s - %(levelname)s - %(message)s (%(filename)s:%(lineno)d)'
+
+    class DeferredQueueHandler(QueueHandler):
+        """Queues records unformatted, so the message is built on the listener thread. The records never leave the
+        process, there is nothing to pickle"""
+
+        def prepare(self, record):
+            return record
+
+    __lock = threading.Lock()
+    __queue_handler: Optional[QueueHandler] = None
+    __console_handler: Optional[logging.Handler] = None
+    __file_handler: Optional[logging.Handler] = None
+    __listener: Optional[QueueListener] = None
+
+    @classmethod
+    def setup(cls, logger: logging.Logger, level: int, log_format: str = MatchingStrategyConfig.LOG_FORMAT_TEXT,
+              sample_rate: float = 1.0) -> logging.Logger:
+        if not isinstance(logger, logging.Logger):
+            raise TypeError("logger must be an instance of Logger")
+        with cls.__lock:
+            if cls.__listener is None:
+                cls.__console_handler = logging.StreamHandler()
+                cls.__file_handler = logging.FileHandler(cls.LOG_PATH, delay=True)
+                cls.__file_handler.setLevel(logging.INFO)
+                cls.__queue_handler = cls.DeferredQueueHandler(queue.SimpleQueue())
+                cls.__listener = QueueListener(cls.__queue_handler.queue, cls.__console_handler, cls.__file_handler,
+                                               respect_handler_level=True)
+                cls.__listener.start()
+                # Stopping the listener writes out the records still queued
+                atexit.register(cls.__listener.stop)
+            json_format = log_format == MatchingStrategyConfig.LOG_FORMAT_JSON
+            cls.__console_handler.setLevel(level)
+            cls.__console_handler.setFormatter(JsonLogFormatter() if json_format else CustomLogFormatter())
+            cls.__file_handler.setFormatter(JsonLogFormatter() if json_format else logging.Formatter(cls.TEXT_FORMAT))
+            # Sampled on the calling thread, so dropped records are never queued
+            for log_filter in list(cls.__queue_handler.filters):
+                cls.__queue_handler.removeFilter(log_filter)
+            cls.__queue_handler.addFilter(SamplingLogFilter(sample_rate))
+            if cls.__queue_handler not in logger.handlers:
+                logger.addHandler(cls.__queue_handler)
+            logger.setLevel(level)
+        return logger
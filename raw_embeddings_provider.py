@@ -1,11 +1,11 @@
 from typing import Generic, TypeVar, Iterable, Optional
 from injector import inject
-import utils
 import numpy as np
 from matching_strategy_config import MatchingStrategyConfig
 from source_item import SourceItem
 from embeddings_provider import EmbeddingsProvider
 from open_ai_api_wrapper import OpenAiApiWrapper
+from token_batcher import TokenBatcher
 import logging
 
 P = TypeVar('P', bound=SourceItem)
@@ -36,17 +36,15 @@ class RawEmbeddingsProvider(Generic[P], EmbeddingsProvider[P, np.ndarray]):
     async def get_embeddings(self, items: Iterable[P]) -> np.ndarray:
         if self.__logger:
             self.__logger.info("Getting raw embeddings for items")
-        try:
-            self.raise_when_bad_items(items)
-            batches = utils.batch_list(list([item.text_to_match for item in items]), self.__config.batch_size)
-            embeddings = None
-            for batch in batches:
-                result = await self.__wrapper.embed_normalize(batch)
-                if embeddings is None:
-                    embeddings = result
-                else:
-                    embeddings = np.concatenate((embeddings, result))
-            return embeddings
-        finally:
-            if self.__logger:
-                self.__logger.debug(f"Raw embeddings obtained for {len(embeddings)} items")
+        self.raise_when_bad_items(items)
+        texts = [item.text_to_match for item in items]
+        batches = TokenBatcher(self.__config.batch_max_tokens, self.__config.batch_size,
+                               self.__wrapper.chars_per_token).batch(texts)
+        results = []
+        for batch in batches:
+            results.append(await self.__wrapper.embed_normalize([texts[i] for i in batch]))
+        embeddings = TokenBatcher.restore_rows(batches, results)
+        # Logged only on success, a failed request leaves no embeddings to count
+        if self.__logger:
+            self.__logger.debug(f"Raw embeddings obtained for {len(embeddings)} items")
+        return embeddings
@@ -0,0 +1,27 @@
+import logging
+
+
+class SamplingLogFilter(logging.Filter):
+    """Passes an evenly spread rate of the records logged with extra={'sampled': True}, and every other record"""
+    __rate: float
+    __credit: float
+
+    def __init__(self, rate: float) -> None:
+        super().__init__()
+        if not isinstance(rate, (int, float)) or not 0 <= rate <= 1:
+            raise ValueError("rate must be between 0 and 1")
+        self.__rate = rate
+        self.__credit = 0.0
+
+    @property
+    def rate(self) -> float:
+        return self.__rate
+
+    def filter(self, record):
+        if not getattr(record, 'sampled', False) or self.__rate >= 1:
+            return True
+        self.__credit += self.__rate
+        if self.__credit < 1:
+            return False
+        self.__credit -= 1
+        return True
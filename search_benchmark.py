@@ -0,0 +1,117 @@
+import asyncio
+import getopt
+import sys
+import time
+from typing import Iterable
+import numpy as np
+from compute_executor import ComputeExecutor
+from embeddings_provider import EmbeddingsProvider
+from matching_engine import MatchingEngine
+from matching_strategy_config import MatchingStrategyConfig
+from memory_monitor import MemoryMonitor
+from package import Package
+from skill import Skill
+from utils import Timer
+
+USAGE = ('search_benchmark.py [-s <skills>] [-p <packages>] [-d <dimension>] [-l <latency ms>] '
+         '[-c <concurrency>] [-w <compute workers>] [-t <faiss threads>] [-k <search chunk size>]')
+
+
+class RandomEmbeddingsProvider(EmbeddingsProvider):
+    __embeddings: np.ndarray
+
+    def __init__(self, count: int, dimension: int, seed: int) -> None:
+        embeddings = np.random.default_rng(seed).standard_normal((count, dimension), dtype=np.float32)
+        self.__embeddings = embeddings / np.linalg.norm(embeddings, axis=1, keepdims=True)
+
+    async def get_embeddings(self, items: Iterable) -> np.ndarray:
+        return self.__embeddings[[item.key for item in items]]
+
+
+class InlineComputeExecutor(ComputeExecutor):
+    """Runs the work on the event loop thread, as the engine did before the executor existed"""
+    async def run(self, function, *args, **kwargs):
+        return function(*args, **kwargs)
+
+
+async def simulate_api(concurrency: int, latency: float, stop: asyncio.Event) -> tuple[int, float]:
+    """Keeps concurrency requests of the given latency in flight and returns the completed ones and the worst
+    delay of a response caused by a busy event loop"""
+    completed, worst_lag = 0, 0.0
+
+    async def client() -> None:
+        nonlocal completed, worst_lag
+        while not stop.is_set():
+            started = time.monotonic()
+            await asyncio.sleep(latency)
+            worst_lag = max(worst_lag, time.monotonic() - started - latency)
+            completed += 1
+
+    await asyncio.gather(*(client() for _ in range(concurrency)))
+    return completed, worst_lag
+
+
+async def measure(executor: ComputeExecutor, monitor: MemoryMonitor, skills: dict[int, Skill],
+                  packages: list[Package], dimension: int, concurrency: int, latency: float
+                  ) -> tuple[float, int, float]:
+    engine = MatchingEngine[Skill, Package](executor, monitor, None)
+    engine.left_items = skills
+    engine.right_items = packages
+    left_provider = RandomEmbeddingsProvider(len(skills), dimension, 1)
+    right_provider = RandomEmbeddingsProvider(len(packages), dimension, 2)
+    stop = asyncio.Event()
+    api = asyncio.create_task(simulate_api(concurrency, latency, stop))
+    await asyncio.sleep(latency)
+    with Timer() as timer:
+        await engine.embed_and_search_right_in_left(left_provider, right_provider)
+    stop.set()
+    completed, worst_lag = await api
+    return float(timer), completed, worst_lag
+
+
+def main(argv):
+    skills_count, packages_count, dimension = 20000, 50000, 1536
+    latency, concurrency = 0.05, 64
+    settings = {'stop_matching_matches_num': 1, 'skill_template': '{0}', 'package_template': '{0}',
+                'filter_template': '{0} {1} {2}'}
+    try:
+        opts, args = getopt.getopt(argv, "hs:p:d:l:c:w:t:k:")
+    except getopt.GetoptError:
+        print(USAGE)
+        sys.exit(2)
+    for opt, arg in opts:
+        if opt == '-h':
+            print(USAGE)
+            sys.exit()
+        elif opt == '-s':
+            skills_count = int(arg)
+        elif opt == '-p':
+            packages_count = int(arg)
+        elif opt == '-d':
+            dimension = int(arg)
+        elif opt == '-l':
+            latency = float(arg) / 1000
+        elif opt == '-c':
+            concurrency = int(arg)
+        elif opt == '-w':
+            settings['compute_workers'] = int(arg)
+        elif opt == '-t':
+            settings['faiss_threads'] = int(arg)
+        elif opt == '-k':
+            settings['search_chunk_size'] = int(arg)
+
+    config = MatchingStrategyConfig(settings)
+    skills = {i: Skill(i, f"skill {i}", f"\\skills\\skill {i}") for i in range(skills_count)}
+    packages = [Package(i, f"package {i}", "") for i in range(packages_count)]
+    for name, executor in (('inline', InlineComputeExecutor(config, None)),
+                           ('executor', ComputeExecutor(config, None))):
+        seconds, completed, worst_lag = asyncio.run(measure(executor, MemoryMonitor(config, None), skills,
+                                                            packages, dimension, concurrency, latency))
+        # The requests a saturated client completes while the search runs
+        expected = seconds * concurrency / latency
+        print(f"{name:<10} search {seconds:.3f}s  responses {completed} of ~{expected:.0f} "
+              f"({completed / expected:.0%})  worst response delay {worst_lag * 1000:.0f}ms")
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
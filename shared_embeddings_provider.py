@@ -0,0 +1,44 @@
+import asyncio
+from typing import Generic, TypeVar, Iterable, Optional
+import numpy as np
+from embeddings_provider import EmbeddingsProvider
+from source_item import SourceItem
+
+P = TypeVar('P', bound=SourceItem)
+
+
+class SharedEmbeddingsProvider(Generic[P], EmbeddingsProvider[P, np.ndarray]):
+    """Embeds a union of items with the wrapped provider once and serves the rows of any subset of it.
+    Concurrent callers wait for the same embedding call"""
+    __provider: EmbeddingsProvider[P, np.ndarray]
+    __items: dict[int, P]
+    __positions: dict[int, int]
+    __embeddings: Optional[asyncio.Future]
+
+    def __init__(self, provider: EmbeddingsProvider[P, np.ndarray], items: dict[int, P]) -> None:
+        if not provider:
+            raise ValueError("provider is missing or empty")
+        if not isinstance(provider, EmbeddingsProvider):
+            raise TypeError("provider must be an instance of EmbeddingsProvider")
+        if not items:
+            raise ValueError("items is missing or empty")
+        if not isinstance(items, dict):
+            raise TypeError("items must be a dictionary")
+        self.__provider = provider
+        self.__items = items
+        self.__positions = {key: position for position, key in enumerate(items.keys())}
+        self.__embeddings = None
+
+    async def get_embeddings(self, items: Iterable[P]) -> np.ndarray:
+        self.raise_when_bad_items(items)
+        if self.__embeddings is None:
+            self.__embeddings = asyncio.ensure_future(self.__provider.get_embeddings(self.__items.values()))
+        embeddings = await asyncio.shield(self.__embeddings)
+        try:
+            rows = np.fromiter((self.__positions[item.key] for item in items), dtype=np.int64)
+        except KeyError as e:
+            raise ValueError(f"Item {e} is not a part of the shared items") from e
+        # The whole union in its own order is served as the same array, so callers can recognize it
+        if len(rows) == len(embeddings) and np.array_equal(rows, np.arange(len(rows))):
+            return embeddings
+        return embeddings[rows]
@@ -1,49 +1,72 @@
 import sqlite3
-from typing import Optional
-from functools import cached_property
+from typing import Optional, Union
 from source_item import SourceItem
 
 
 class Skill(SourceItem):
+    # LIKE patterns of the paths of the skills to read, a skill matching any of them is read
+    DEFAULT_PATH_PATTERNS = ('%.NET%', '%C#%')
+
+    __slots__ = ('__identifier', '__name', '__text_to_match', '__hash')
     __identifier: int
     __name: str
-    __path: str
+    __text_to_match: str
+    __hash: int
 
-    @cached_property
+    @property
     def text_to_match(self) -> str:
-        return self.__path.lstrip("\\")
+        return self.__text_to_match
 
-    @cached_property
+    @property
     def text_to_filter(self) -> str:
-        return self.text_to_match
+        return self.__text_to_match
 
-    @cached_property
+    @property
     def key(self) -> int:
         return self.__identifier
 
-    @cached_property
+    @property
     def label(self) -> Optional[str]:
         return self.__name
 
     def __init__(self, identifier: int, name: str, path: str) -> None:
         self.__identifier = identifier
         self.__name = name
-        self.__path = path
+        self.__text_to_match = path.lstrip("\\")
+        self.__hash = hash((identifier, name, self.__text_to_match, self.__text_to_match))
+
+    def __hash__(self):
+        return self.__hash
+
+    @staticmethod
+    def path_patterns(patterns: Union[str, list[str], tuple[str, ...]]) -> tuple[str, ...]:
+        """A single pattern or a list of them, as a tuple"""
+        if not patterns:
+            raise ValueError("path_patterns is missing or empty")
+        if isinstance(patterns, str):
+            return patterns,
+        if (not isinstance(patterns, (list, tuple))
+                or not all(isinstance(pattern, str) and pattern for pattern in patterns)):
+            raise TypeError("path_patterns must be a path pattern or a list of them")
+        return tuple(patterns)
 
     @classmethod
-    def read_db(cls, db_path: str) -> dict[int, 'Skill']:
+    def read_db(cls, db_path: str, path_patterns: tuple[str, ...] = DEFAULT_PATH_PATTERNS) -> dict[int, 'Skill']:
+        """The skills whose path is LIKE any of the patterns"""
         if not db_path:
             raise ValueError("db_path is missing or empty")
         if not isinstance(db_path, str):
             raise TypeError("db_path must be a string")
+        path_patterns = cls.path_patterns(path_patterns)
         with sqlite3.connect(db_path) as conn:
             cursor = conn.cursor()
             try:
-                cursor.execute("""
+                # Only the placeholders are generated, the patterns are bound
+                cursor.execute(f"""
                   SELECT id as identifier, name, path FROM Skills
-                  WHERE path LIKE '%.NET%' OR path LIKE '%C#%'
+                  WHERE {' OR '.join(['path LIKE ?'] * len(path_patterns))}
                    ORDER BY id ASC
-                """)
+                """, path_patterns)
                 return {row[0]: cls(*row) for row in cursor.fetchall()}
             finally:
                 cursor.close()
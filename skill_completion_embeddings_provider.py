@@ -25,7 +25,8 @@ class SkillCompletionEmbeddingsProvider(CompletionEmbeddingsProvider[Skill]):
         super().__init__(
             config.skill_template,
             wrapper,
-            config.batch_size
+            config.batch_size,
+            config.batch_max_tokens
         )
 
     async def complete(self, texts: list[str]) -> list[str]:
@@ -0,0 +1,177 @@
+import asyncio
+import hashlib
+import json
+import os
+from typing import Iterable, Optional, NamedTuple
+import numpy as np
+from injector import inject
+from compute_executor import ComputeExecutor
+from embeddings_provider import EmbeddingsProvider
+from matching_strategy_config import MatchingStrategyConfig
+from open_ai_api_wrapper_config import OpenAiApiWrapperConfig
+from raw_embeddings_provider import RawEmbeddingsProvider
+from skill import Skill
+import utils
+import logging
+
+
+class SkillIndexStore(EmbeddingsProvider[Skill, np.ndarray]):
+    """Keeps the raw skill embeddings in an IndexIDMap under skill_index_path, with a snapshot of the id and
+    content hash of every indexed skill. Only skills that are new or changed since the snapshot are embedded;
+    changed and removed ones are dropped from the index with remove_ids"""
+    INDEX_FILE = 'skills.faiss'
+    SNAPSHOT_FILE = 'skills.json'
+
+    class Diff(NamedTuple):
+        added: list[int]
+        changed: list[int]
+        removed: list[int]
+
+        @property
+        def empty(self) -> bool:
+            return not (self.added or self.changed or self.removed)
+
+    __raw_embed_provider: RawEmbeddingsProvider
+    __compute_executor: ComputeExecutor
+    __fingerprint: str
+    __path: Optional[str]
+    __index: Optional[object]
+    __hashes: Optional[dict[int, str]]
+    __lock: asyncio.Lock
+    __logger: Optional[logging.Logger]
+
+    @inject
+    def __init__(self, raw_embed_provider: RawEmbeddingsProvider,
+                 compute_executor: ComputeExecutor,
+                 wrapper_config: OpenAiApiWrapperConfig,
+                 config: MatchingStrategyConfig,
+                 logger: Optional[logging.Logger]) -> None:
+        if not raw_embed_provider:
+            raise ValueError("raw_embed_provider is missing or empty")
+        if not isinstance(raw_embed_provider, RawEmbeddingsProvider):
+            raise TypeError("raw_embed_provider must be an instance of RawEmbeddingsProvider")
+        if not compute_executor:
+            raise ValueError("compute_executor is missing or empty")
+        if not isinstance(compute_executor, ComputeExecutor):
+            raise TypeError("compute_executor must be an instance of ComputeExecutor")
+        if not wrapper_config:
+            raise ValueError("wrapper_config is missing or empty")
+        if not isinstance(wrapper_config, OpenAiApiWrapperConfig):
+            raise TypeError("wrapper_config must be an instance of OpenAiApiWrapperConfig")
+        if not config:
+            raise ValueError("config is missing or empty")
+        if not isinstance(config, MatchingStrategyConfig):
+            raise TypeError("config must be an instance of MatchingStrategyConfig")
+        if logger and not isinstance(logger, logging.Logger):
+            raise TypeError("logger must be an instance of Logger")
+        self.__raw_embed_provider = raw_embed_provider
+        self.__compute_executor = compute_executor
+        # Embeddings of another model are not comparable, so a snapshot of one is discarded
+        self.__fingerprint = wrapper_config.embed_model
+        self.__path = config.skill_index_path
+        self.__index = None
+        self.__hashes = None
+        self.__lock = asyncio.Lock()
+        self.__logger = logger
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self.__path)
+
+    @staticmethod
+    def digest(skill: Skill) -> str:
+        return hashlib.sha1(f"{skill.label}\n{skill.text_to_match}".encode('utf-8')).hexdigest()
+
+    def __load(self) -> None:
+        if self.__hashes is not None:
+            return
+        self.__hashes = {}
+        snapshot_path = os.path.join(self.__path, SkillIndexStore.SNAPSHOT_FILE)
+        index_path = os.path.join(self.__path, SkillIndexStore.INDEX_FILE)
+        if not (os.path.exists(snapshot_path) and os.path.exists(index_path)):
+            return
+        with open(snapshot_path, 'r', encoding='utf-8') as file:
+            snapshot = json.load(file)
+        if snapshot.get('fingerprint') != self.__fingerprint:
+            if self.__logger:
+                self.__logger.info("The skill index was built with another embedding model and is rebuilt")
+            return
+        from faiss import read_index
+        self.__index = read_index(index_path)
+        self.__hashes = {int(key): value for key, value in snapshot.get('hashes', {}).items()}
+
+    def __save(self) -> None:
+        from faiss import write_index
+        os.makedirs(self.__path, exist_ok=True)
+        index_path = os.path.join(self.__path, SkillIndexStore.INDEX_FILE)
+        snapshot_path = os.path.join(self.__path, SkillIndexStore.SNAPSHOT_FILE)
+        # The index goes first: a snapshot never describes vectors the index on disk does not have
+        temp_path = utils.temp_path_beside(index_path)
+        write_index(self.__index, temp_path)
+        os.replace(temp_path, index_path)
+        temp_path = utils.temp_path_beside(snapshot_path)
+        with open(temp_path, 'w', encoding='utf-8') as file:
+            json.dump({'fingerprint': self.__fingerprint,
+                       'hashes': {str(key): value for key, value in self.__hashes.items()}}, file)
+        os.replace(temp_path, snapshot_path)
+
+    def diff(self, skills: Iterable[Skill]) -> Diff:
+        """Compares the skills with the last indexed snapshot"""
+        if not self.enabled:
+            raise ValueError("skill_index_path is not configured")
+        self.raise_when_bad_items(skills)
+        self.__load()
+        current = {skill.key: self.digest(skill) for skill in skills}
+        return SkillIndexStore.Diff(added=[key for key in current if key not in self.__hashes],
+                                    changed=[key for key, value in current.items()
+                                             if key in self.__hashes and self.__hashes[key] != value],
+                                    removed=[key for key in self.__hashes if key not in current])
+
+    def __apply(self, diff: Diff, skills: list[Skill], fresh_keys: list[int],
+                embeddings: Optional[np.ndarray]) -> np.ndarray:
+        from faiss import IndexIDMap, IndexFlatIP, vector_to_array
+        stale = diff.changed + diff.removed
+        if self.__index is not None and stale:
+            # noinspection PyArgumentList
+            self.__index.remove_ids(np.asarray(stale, dtype=np.int64))
+        if embeddings is not None:
+            if self.__index is None:
+                self.__index = IndexIDMap(IndexFlatIP(embeddings.shape[1]))
+            elif self.__index.d != embeddings.shape[1]:
+                raise ValueError(f"The skill index under {self.__path} holds embeddings of another dimension")
+            # noinspection PyArgumentList
+            self.__index.add_with_ids(embeddings, np.asarray(fresh_keys, dtype=np.int64))
+        for key in diff.removed:
+            del self.__hashes[key]
+        for skill in skills:
+            self.__hashes[skill.key] = self.digest(skill)
+        if not diff.empty:
+            self.__save()
+        vectors = self.__index.index.reconstruct_n(0, self.__index.ntotal)
+        positions = {int(key): row for row, key in enumerate(vector_to_array(self.__index.id_map))}
+        return vectors[[positions[skill.key] for skill in skills]]
+
+    async def __update(self, diff: Diff, skills: list[Skill]) -> np.ndarray:
+        if self.__logger and not diff.empty:
+            self.__logger.info(f"Skill index: {len(diff.added)} added, {len(diff.changed)} changed, "
+                               f"{len(diff.removed)} removed")
+        fresh_keys = set(diff.added) | set(diff.changed)
+        fresh = [skill for skill in skills if skill.key in fresh_keys]
+        embeddings = await self.__raw_embed_provider.get_embeddings(fresh) if fresh else None
+        return await self.__compute_executor.run(self.__apply, diff, skills, [skill.key for skill in fresh],
+                                                 embeddings)
+
+    async def synchronize(self, skills: Iterable[Skill]) -> Diff:
+        """Brings the index up to date with the whole skills source, dropping the skills it no longer has"""
+        skills = list(skills)
+        async with self.__lock:
+            diff = self.diff(skills)
+            await self.__update(diff, skills)
+            return diff
+
+    async def get_embeddings(self, items: Iterable[Skill]) -> np.ndarray:
+        skills = list(items)
+        async with self.__lock:
+            # The items may be the skills of a single job, so the indexed skills missing from them are kept
+            diff = self.diff(skills)._replace(removed=[])
+            return await self.__update(diff, skills)
@@ -4,6 +4,8 @@ from utils import property_typecheck
 
 
 class SourceItem(metaclass=abc.ABCMeta):
+    __slots__ = ()
+
     @property
     @abc.abstractmethod
     def text_to_match(self) -> str:
@@ -32,7 +34,10 @@ class SourceItem(metaclass=abc.ABCMeta):
         return hash((self.key, self.label, self.text_to_match, self.text_to_filter))
 
     def __eq__(self, other):
+        if self is other:
+            return True
         return (self.__class__ == other.__class__
+                and hash(self) == hash(other)
                 and self.key == other.key
                 and self.text_to_match == other.text_to_match
                 and self.text_to_filter == other.text_to_filter
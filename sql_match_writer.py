@@ -0,0 +1,139 @@
+from itertools import groupby
+from typing import Optional, Iterable
+from sqlalchemy import Column, Integer, String, Float, create_engine, Engine, inspect, text
+from sqlalchemy.orm import sessionmaker, declarative_base, Session
+from match_writer import MatchWriter
+from matching_strategy_config import MatchingStrategyConfig
+import utils
+
+Base = declarative_base()
+
+
+class SqlMatchWriter(MatchWriter):
+    """Writes the matches to a database, committing every portion"""
+    DELETE_CHUNK_SIZE = 500
+
+    __engine: Engine
+    __session_maker: sessionmaker[Session]
+    __session: Optional[Session]
+    __upgraded: bool
+    __removed: set[tuple[Optional[str], int]]
+
+    def __init__(self, output_database: str, config: MatchingStrategyConfig):
+        if not output_database:
+            raise ValueError("output_database cannot be empty")
+        if not isinstance(output_database, str):
+            raise TypeError("output_database must be a string")
+        super().__init__(config)
+        self.__engine = create_engine(output_database)
+        self.__session_maker = sessionmaker(bind=self.__engine)
+        self.__session = None
+        self.__upgraded = False
+        self.__removed = set()
+
+    class Match(Base):
+        __tablename__ = 'package_to_skill_matches'
+        id = Column(Integer, primary_key=True)
+        programming_language_name = Column(String)
+        package_name = Column(String, nullable=False)
+        package_id = Column(Integer, nullable=False)
+        skill_name = Column(String, nullable=False)
+        skill_id = Column(Integer, nullable=False)
+        match_source = Column(String)
+        decision_tier = Column(String)
+        iteration = Column(Integer)
+        first_distance = Column(Float)
+        second_distance = Column(Float)
+
+        @staticmethod
+        def from_record(record: MatchWriter.Record) -> 'SqlMatchWriter.Match':
+            if not isinstance(record, MatchWriter.Record):
+                raise TypeError("record must be an instance of MatchWriter.Record")
+            return SqlMatchWriter.Match(**record._asdict())
+
+        def to_record(self) -> MatchWriter.Record:
+            return MatchWriter.Record(*(getattr(self, field) for field in MatchWriter.Record._fields))
+
+    def __upgrade_table(self) -> None:
+        # Appending to a table written by an older version adds the columns it does not have yet
+        table = SqlMatchWriter.Match.__table__
+        existing = {column['name'] for column in inspect(self.__engine).get_columns(table.name)}
+        missing = [column for column in table.columns if column.name not in existing]
+        if not missing:
+            return
+        with self.__engine.begin() as connection:
+            for column in missing:
+                connection.execute(text(f"ALTER TABLE {table.name} ADD COLUMN {column.name} "
+                                        f"{column.type.compile(self.__engine.dialect)}"))
+
+    def __prepare(self) -> None:
+        if not self.__upgraded:
+            Base.metadata.create_all(self.__engine)
+            self.__upgrade_table()
+            self.__upgraded = True
+
+    def __delete_removed(self) -> None:
+        # The removal is committed with the first portion, so a run failing before it keeps the old matches
+        match = SqlMatchWriter.Match
+        for language, keys in groupby(sorted(self.__removed, key=lambda key: (key[0] or '', key[1])),
+                                      key=lambda key: key[0]):
+            package_ids = [package_id for _, package_id in keys]
+            for i in range(0, len(package_ids), SqlMatchWriter.DELETE_CHUNK_SIZE):
+                self.__session.query(match).filter(
+                    match.programming_language_name.is_(None) if language is None
+                    else match.programming_language_name == language,
+                    match.package_id.in_(package_ids[i:i + SqlMatchWriter.DELETE_CHUNK_SIZE])
+                ).delete(synchronize_session=False)
+        self.__removed = set()
+
+    def __enter__(self):
+        if self.__session:
+            return self
+        self.__prepare()
+        self.__session = self.__session_maker()
+        if self.__removed:
+            self.__delete_removed()
+        return self
+
+    def read_records(self) -> Iterable[MatchWriter.Record]:
+        self.__prepare()
+        with self.__session_maker() as session:
+            return [match.to_record() for match in session.query(SqlMatchWriter.Match).all()]
+
+    def remove_records(self, keys: set[tuple[Optional[str], int]]) -> None:
+        if not isinstance(keys, set):
+            raise TypeError("keys must be a set")
+        self.__removed |= keys
+
+    def write_records(self, records: list[MatchWriter.Record]) -> None:
+        if not records:
+            raise ValueError("records cannot be empty")
+        if not isinstance(records, list):
+            raise TypeError("records must be a list")
+        if not utils.all_instances_of(records, MatchWriter.Record):
+            raise TypeError("records must be a list of MatchWriter.Record")
+        self.__session.add_all([SqlMatchWriter.Match.from_record(record) for record in records])
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if not self.__session:
+            return False
+        self.__session.commit()
+        self.__session.close()
+        self.__session = None
+        return False
+
+    def finalize(self) -> None:
+        if self.__removed:
+            # A run matching none of the removed packages again still drops their old matches
+            with self:
+                pass
+        self.__engine.dispose()
+
+    def abort(self) -> None:
+        # Portions are committed as they are written, so only an open one is rolled back
+        self.__removed = set()
+        if self.__session:
+            self.__session.rollback()
+            self.__session.close()
+            self.__session = None
+        self.__engine.dispose()
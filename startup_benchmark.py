@@ -0,0 +1,58 @@
+import os
+import subprocess
+import sys
+import getopt
+import statistics
+import tempfile
+from utils import Timer
+
+PROGRAM = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'program.py')
+
+SCENARIOS = {
+    'help': [PROGRAM, '-h'],
+    'import_app_module': ['-c', 'import app_module'],
+    'import_program': ['-c', 'import program'],
+}
+
+
+def measure(args: list[str], runs: int) -> list[float]:
+    timings = []
+    env = dict(os.environ, PYTHONPATH=os.path.dirname(PROGRAM))
+    # Runs in a scratch directory so the log file and the missing data files are not created in the repository
+    with tempfile.TemporaryDirectory() as work_dir:
+        for _ in range(runs):
+            with Timer() as timer:
+                subprocess.run([sys.executable, *args], cwd=work_dir, env=env,
+                               stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, check=False)
+            timings.append(float(timer))
+    return timings
+
+
+def main(argv):
+    runs = 10
+    scenarios = dict(SCENARIOS)
+    try:
+        opts, args = getopt.getopt(argv, "hn:c:", ["runs=", "config="])
+    except getopt.GetoptError:
+        print('startup_benchmark.py [-n <runs>] [-c <configfile>]')
+        sys.exit(2)
+    for opt, arg in opts:
+        if opt == '-h':
+            print('startup_benchmark.py [-n <runs>] [-c <configfile>]')
+            sys.exit()
+        elif opt in ("-n", "--runs"):
+            runs = int(arg)
+        elif opt in ("-c", "--config"):
+            # Measures the path up to the first data access: the data files do not exist,
+            # so the run fails as soon as a stage asks for them
+            scenarios['config_to_first_data_access'] = [PROGRAM, '-s', 'missing.db', '-p', 'missing.csv',
+                                                        '-o', 'sqlite://', '-c', os.path.abspath(arg)]
+
+    for name, args in scenarios.items():
+        timings = measure(args, runs)
+        print(f"{name:<30} median {statistics.median(timings):.3f}s  "
+              f"min {min(timings):.3f}s  max {max(timings):.3f}s  ({runs} runs)")
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,18 @@
+import os
+import sys
+
+# The modules live at the repository root
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+STRATEGY_CONFIG = {'stop_matching_matches_num': 1,
+                   'min_distance_to_consider': 0.5,
+                   'skill_template': '{0}',
+                   'package_template': '{0}',
+                   'filter_template': 'FILTER {0} {1} {2}'}
+
+WRAPPER_CONFIG = {'servers': ['http://127.0.0.1:1/v1'],
+                  'completion_model': 'm',
+                  'embed_model': 'e',
+                  'api_key': 'k',
+                  'system_message': 's',
+                  'temperature': 0.5}
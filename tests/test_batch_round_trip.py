@@ -0,0 +1,121 @@
+import asyncio
+import glob
+import hashlib
+import os
+import pytest
+from conftest import STRATEGY_CONFIG, WRAPPER_CONFIG
+from batch_file_exchange import BatchFileExchange
+from batch_processor import BatchProcessor
+from compute_executor import ComputeExecutor
+from matching_strategy_config import MatchingStrategyConfig
+from open_ai_api_wrapper import OpenAiApiWrapper
+from open_ai_api_wrapper_config import OpenAiApiWrapperConfig
+
+web = pytest.importorskip('aiohttp.web')
+
+TEXTS = ['Newtonsoft.Json', 'Serilog logging', 'Dapper micro ORM', 'Polly resilience']
+TEMPLATE = 'Describe {0}'
+
+
+def vector(text: str) -> list[float]:
+    digest = hashlib.sha1(text.encode('utf-8')).digest()
+    return [float(byte) + 1 for byte in digest[:8]]
+
+
+async def handle(request):
+    body = await request.json()
+    if request.path.endswith('/embeddings'):
+        return web.json_response({'object': 'list', 'model': body['model'],
+                                  'data': [{'object': 'embedding', 'index': i, 'embedding': vector(text)}
+                                           for i, text in enumerate(body['input'])],
+                                  'usage': {'prompt_tokens': len(body['input']), 'total_tokens': len(body['input'])}})
+    content = body['messages'][-1]['content']
+    return web.json_response({'id': 'stub', 'object': 'chat.completion', 'created': 0, 'model': body['model'],
+                              'choices': [{'index': 0, 'finish_reason': 'stop',
+                                           'message': {'role': 'assistant', 'content': content.upper()}}],
+                              'usage': {'prompt_tokens': 3, 'completion_tokens': 3, 'total_tokens': 6}})
+
+
+async def start_stub() -> tuple[web.AppRunner, str]:
+    app = web.Application()
+    app.add_routes([web.post('/{tail:.*}', handle)])
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, '127.0.0.1', 0).start()
+    return runner, f"http://127.0.0.1:{runner.addresses[0][1]}/v1"
+
+
+async def ask(server: str, **settings) -> tuple[list[list[float]], list[str]]:
+    config = OpenAiApiWrapperConfig(dict(WRAPPER_CONFIG, servers=[server], batch_collect_seconds=0.05,
+                                         batch_poll_seconds=0.05, **settings))
+    executor = ComputeExecutor(MatchingStrategyConfig(STRATEGY_CONFIG), None)
+    wrapper = OpenAiApiWrapper(config, executor, None)
+    try:
+        embeddings, completions = await asyncio.gather(wrapper.embed_normalize(TEXTS),
+                                                       wrapper.complete(TEMPLATE, [(text,) for text in TEXTS]))
+        return embeddings.tolist(), completions
+    finally:
+        await wrapper.close()
+        executor.close()
+
+
+def test_batch_results_equal_the_online_ones(tmp_path):
+    async def run():
+        runner, server = await start_stub()
+        try:
+            online = await ask(server)
+            watcher = asyncio.create_task(BatchProcessor(server, 'k').watch(str(tmp_path), 0.05))
+            try:
+                batched = await asyncio.wait_for(ask(server, batch_dir=str(tmp_path)), 30)
+            finally:
+                watcher.cancel()
+            return online, batched
+        finally:
+            await runner.cleanup()
+
+    online, batched = asyncio.run(run())
+    assert batched == online
+    assert len(glob.glob(os.path.join(tmp_path, 'batch_*.results.jsonl'))) == 1
+
+
+def test_submitted_batch_is_resumed_by_the_rerun(tmp_path):
+    async def run():
+        runner, server = await start_stub()
+        try:
+            online = await ask(server)
+            with pytest.raises(BatchFileExchange.Submitted):
+                await ask(server, batch_dir=str(tmp_path), batch_wait=False)
+            batches = glob.glob(os.path.join(tmp_path, 'batch_*.jsonl'))
+            assert len(batches) == 1
+            await BatchProcessor(server, 'k').process(batches[0])
+            resumed = await asyncio.wait_for(ask(server, batch_dir=str(tmp_path), batch_wait=False), 30)
+            return online, resumed
+        finally:
+            await runner.cleanup()
+
+    online, resumed = asyncio.run(run())
+    assert resumed == online
+    # Every request was answered from the results, nothing new was submitted
+    assert sorted(os.listdir(tmp_path)) == ['batch_0001.jsonl', 'batch_0001.results.jsonl']
+
+
+def test_unanswered_batch_is_not_submitted_again(tmp_path):
+    async def run():
+        runner, server = await start_stub()
+        try:
+            online = await ask(server)
+            for _ in range(2):
+                with pytest.raises(BatchFileExchange.Submitted):
+                    await ask(server, batch_dir=str(tmp_path), batch_wait=False)
+            assert sorted(os.listdir(tmp_path)) == ['batch_0001.jsonl']
+            # The waiting run picks the results of the batch written by the first one
+            waiting = asyncio.create_task(ask(server, batch_dir=str(tmp_path)))
+            await asyncio.sleep(0.3)
+            await BatchProcessor(server, 'k').process(os.path.join(tmp_path, 'batch_0001.jsonl'))
+            return online, await asyncio.wait_for(waiting, 30)
+        finally:
+            await runner.cleanup()
+
+    online, resumed = asyncio.run(run())
+    assert resumed == online
+    assert sorted(os.listdir(tmp_path)) == ['batch_0001.jsonl', 'batch_0001.results.jsonl']
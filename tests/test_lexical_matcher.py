@@ -0,0 +1,47 @@
+import pytest
+from conftest import STRATEGY_CONFIG
+from lexical_matcher import LexicalMatcher
+from matching_strategy_config import MatchingStrategyConfig
+from package import Package
+from skill import Skill
+
+SKILLS = {1: Skill(1, 'C#', '\\Programming\\C#'),
+          2: Skill(2, '.NET', '\\Programming\\C#\\.NET'),
+          3: Skill(3, 'F#', '\\Programming\\F#'),
+          4: Skill(4, 'Newtonsoft.Json', '\\Programming\\C#\\Libraries\\Newtonsoft.Json')}
+
+
+def match(titles: list[str], aliases: dict[str, str] = None) -> tuple[dict[str, int], dict[str, int], list[str]]:
+    matcher = LexicalMatcher(MatchingStrategyConfig(dict(STRATEGY_CONFIG, lexical_aliases=aliases)), None)
+    packages = [Package(key, title, 'description') for key, title in enumerate(titles)]
+    exact, alias, remaining = matcher.match(SKILLS, packages)
+    return ({package.label: skill.key for package, skill in exact.items()},
+            {package.label: skill.key for package, skill in alias.items()},
+            [package.label for package in remaining])
+
+
+@pytest.mark.parametrize('title', ['C', 'c', 'Net', 'NET', 'F', 'Fsharp'])
+def test_symbols_are_not_dropped_from_alias_keys(title):
+    assert match([title]) == ({}, {}, [title])
+
+
+def test_names_match_exactly_and_through_separators():
+    exact, alias, remaining = match(['c#', '.net', 'F#', 'newtonsoft-json', 'Newtonsoft Json', 'Newtonsoft'])
+    assert exact == {'c#': 1, '.net': 2, 'F#': 3}
+    assert alias == {'newtonsoft-json': 4, 'Newtonsoft Json': 4}
+    assert remaining == ['Newtonsoft']
+
+
+def test_short_configured_alias_matches():
+    exact, alias, remaining = match(['CS', 'C'], aliases={'cs': 'C#'})
+    assert alias == {'CS': 1}
+    assert remaining == ['C']
+
+
+def test_indexes_follow_the_skills_snapshot():
+    matcher = LexicalMatcher(MatchingStrategyConfig(dict(STRATEGY_CONFIG)), None)
+    packages = [Package(1, 'F#', 'description')]
+    assert list(matcher.match(SKILLS, packages)[0].values()) == [SKILLS[3]]
+    assert list(matcher.match(SKILLS, packages)[0].values()) == [SKILLS[3]]
+    snapshot = {key: skill for key, skill in SKILLS.items() if key != 3}
+    assert matcher.match(snapshot, packages) == ({}, {}, packages)
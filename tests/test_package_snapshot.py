@@ -0,0 +1,100 @@
+import pytest
+from conftest import STRATEGY_CONFIG
+from jsonl_match_writer import JsonlMatchWriter
+from matching_strategy_config import MatchingStrategyConfig
+from package import Package
+from package_snapshot import PackageSnapshot
+from skill import Skill
+from skill_index_store import SkillIndexStore
+from sql_match_writer import SqlMatchWriter
+
+DESCRIPTION = 'a description long enough to be read from the packages source'
+
+
+def package(key: int, title: str = None, description: str = DESCRIPTION) -> Package:
+    return Package(key, title or f"Package{key}", description)
+
+
+@pytest.fixture(params=['jsonl', 'sqlite'])
+def writer(request, tmp_path):
+    config = MatchingStrategyConfig(dict(STRATEGY_CONFIG, skill_index_path=str(tmp_path / 'index'),
+                                         rematch_affected_only=True))
+    if request.param == 'jsonl':
+        return JsonlMatchWriter(str(tmp_path / 'out.jsonl'), config), config
+    return SqlMatchWriter(f"sqlite:///{tmp_path / 'out.db'}", config), config
+
+
+def rematch(match_writer, snapshot, diff, packages):
+    """What Main does before matching: pick the affected packages and drop their stored matches"""
+    stored = match_writer.read_matches()
+    affected = snapshot.affected(diff, packages, stored)
+    match_writer.remove_matches([item.key for item in affected if item.key in stored])
+    return affected
+
+
+def test_affected_packages_for_skill_and_package_changes(writer):
+    match_writer, config = writer
+    skills = {key: Skill(key, f"Skill{key}", f"Programming\\C#\\Skill{key}") for key in (1, 2, 3)}
+    packages = [package(10), package(11), package(12), package(13)]
+    with match_writer as output:
+        output.write_matches({packages[0]: skills[1], packages[1]: skills[2], packages[2]: skills[3],
+                              packages[3]: skills[1]})
+    match_writer.finalize()
+    snapshot = PackageSnapshot(config)
+    snapshot.update(packages)
+    snapshot.save()
+
+    # Skill 2 edited, skill 3 deleted, skill 4 added; package 13 edited and package 14 new
+    diff = SkillIndexStore.Diff(added=[4], changed=[2], removed=[3])
+    current = [package(10), package(11), package(12), package(13, description=DESCRIPTION + ' edited'),
+               package(14)]
+    affected = rematch(match_writer, PackageSnapshot(config), diff, current)
+    assert sorted(item.key for item in affected) == [11, 12, 13, 14]
+    match_writer.finalize()
+    assert match_writer.read_matches() == {10: 1}
+
+
+def test_new_package_is_matched_while_skills_are_unchanged(writer):
+    match_writer, config = writer
+    skill = Skill(1, 'Skill1', 'Programming\\C#\\Skill1')
+    packages = [package(10)]
+    with match_writer as output:
+        output.write_matches({packages[0]: skill})
+    match_writer.finalize()
+    snapshot = PackageSnapshot(config)
+    snapshot.update(packages)
+    snapshot.save()
+
+    affected = rematch(match_writer, PackageSnapshot(config), SkillIndexStore.Diff([], [], []),
+                       packages + [package(11)])
+    assert [item.key for item in affected] == [11]
+    match_writer.finalize()
+    assert match_writer.read_matches() == {10: 1}
+
+
+def test_unmatched_package_is_left_alone_until_skills_are_added(writer):
+    match_writer, config = writer
+    skill = Skill(1, 'Skill1', 'Programming\\C#\\Skill1')
+    packages = [package(key) for key in range(5)]
+    with match_writer as output:
+        output.write_matches({packages[0]: skill})
+    match_writer.finalize()
+    snapshot = PackageSnapshot(config)
+    snapshot.update(packages)
+    snapshot.save()
+
+    snapshot = PackageSnapshot(config)
+    assert rematch(match_writer, snapshot, SkillIndexStore.Diff([], [], []), packages) == []
+    affected = rematch(match_writer, snapshot, SkillIndexStore.Diff(added=[2], changed=[], removed=[]), packages)
+    assert [item.key for item in affected] == [1, 2, 3, 4]
+    match_writer.finalize()
+    assert match_writer.read_matches() == {0: 1}
+
+
+def test_pending_package_is_affected(writer):
+    _, config = writer
+    packages = [package(10), package(11)]
+    snapshot = PackageSnapshot(config)
+    snapshot.update(packages)
+    affected = snapshot.affected(SkillIndexStore.Diff([], [], []), packages, {10: 1}, pending={11})
+    assert [item.key for item in affected] == [11]
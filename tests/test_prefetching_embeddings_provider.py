@@ -0,0 +1,53 @@
+import asyncio
+import numpy as np
+from package import Package
+from prefetching_embeddings_provider import PrefetchingEmbeddingsProvider
+
+
+class StubProvider:
+    """Embeds an item as a vector filled with its key and remembers every call"""
+
+    def __init__(self, delay: float = 0.01) -> None:
+        self.calls = []
+        self.delay = delay
+
+    async def get_embeddings(self, items) -> np.ndarray:
+        items = list(items)
+        self.calls.append([item.key for item in items])
+        await asyncio.sleep(self.delay)
+        return np.array([[float(item.key)] * 2 for item in items], dtype=np.float32)
+
+
+def packages(*keys: int) -> list[Package]:
+    return [Package(key, f"Package{key}", 'description') for key in keys]
+
+
+def test_partial_take_of_a_prefetch_is_not_cancelled():
+    async def run():
+        stub = StubProvider()
+        provider = PrefetchingEmbeddingsProvider(stub)
+        a, b = packages(1, 2)
+        provider.prefetch([a, b])
+        embeddings = await provider.get_embeddings([a])
+        return stub, provider, embeddings
+
+    stub, provider, embeddings = asyncio.run(run())
+    assert embeddings.tolist() == [[1.0, 1.0]]
+    assert stub.calls == [[1, 2]]
+    assert provider.stats['hits'] == 1 and provider.stats['discarded'] == 1
+
+
+def test_unused_prefetch_is_cancelled():
+    async def run():
+        stub = StubProvider(delay=10)
+        provider = PrefetchingEmbeddingsProvider(stub)
+        a, b = packages(1, 2)
+        provider.prefetch([a])
+        await asyncio.sleep(0)
+        stub.delay = 0
+        embeddings = await provider.get_embeddings([b])
+        return provider, embeddings
+
+    provider, embeddings = asyncio.run(run())
+    assert embeddings.tolist() == [[2.0, 2.0]]
+    assert provider.stats['misses'] == 1 and provider.stats['discarded'] == 1
@@ -0,0 +1,30 @@
+import sqlite3
+import pytest
+from conftest import STRATEGY_CONFIG
+from matching_strategy_config import MatchingStrategyConfig
+from skill import Skill
+
+
+@pytest.fixture
+def skills_db(tmp_path):
+    path = str(tmp_path / 'skills.db')
+    with sqlite3.connect(path) as conn:
+        conn.execute("CREATE TABLE Skills (id INTEGER PRIMARY KEY, name TEXT, path TEXT)")
+        conn.executemany("INSERT INTO Skills VALUES (?, ?, ?)",
+                         [(1, 'C#', '\\Programming\\C#'), (2, '.NET', '\\Programming\\C#\\.NET'),
+                          (3, 'Python', '\\Programming\\Python'), (4, "O'Reilly", "\\Books\\O'Reilly")])
+    return path
+
+
+@pytest.mark.parametrize('skills_filter, keys', [(None, [1, 2]), ('%Python%', [3]), (['%Python%', '%.NET%'], [2, 3]),
+                                                 ("%O'Reilly%", [4]), ("%' OR 1=1 --", [])])
+def test_skills_are_read_by_path_patterns(skills_db, skills_filter, keys):
+    overrides = {'skills_filter': skills_filter} if skills_filter else {}
+    config = MatchingStrategyConfig(dict(STRATEGY_CONFIG, **overrides))
+    assert sorted(Skill.read_db(skills_db, config.skills_filter)) == keys
+
+
+@pytest.mark.parametrize('skills_filter', [[''], [1], {'path': '%C#%'}])
+def test_invalid_path_patterns_are_refused(skills_filter):
+    with pytest.raises(TypeError):
+        MatchingStrategyConfig(dict(STRATEGY_CONFIG, skills_filter=skills_filter))
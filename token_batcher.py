@@ -0,0 +1,78 @@
+import numpy as np
+
+
+class TokenBatcher:
+    __max_tokens_per_request: int
+    __max_items_per_request: int
+    __chars_per_token: float
+
+    @property
+    def max_tokens_per_request(self) -> int:
+        return self.__max_tokens_per_request
+
+    @property
+    def max_items_per_request(self) -> int:
+        return self.__max_items_per_request
+
+    def __init__(self, max_tokens_per_request: int, max_items_per_request: int,
+                 chars_per_token: float = 4.0) -> None:
+        if not max_tokens_per_request:
+            raise ValueError("max_tokens_per_request is missing or empty")
+        if not isinstance(max_tokens_per_request, int):
+            raise TypeError("max_tokens_per_request must be an integer")
+        if not max_items_per_request:
+            raise ValueError("max_items_per_request is missing or empty")
+        if not isinstance(max_items_per_request, int):
+            raise TypeError("max_items_per_request must be an integer")
+        if not chars_per_token:
+            raise ValueError("chars_per_token is missing or empty")
+        if not isinstance(chars_per_token, (int, float)):
+            raise TypeError("chars_per_token must be a number")
+        self.__max_tokens_per_request = max_tokens_per_request
+        self.__max_items_per_request = max_items_per_request
+        self.__chars_per_token = float(chars_per_token)
+
+    def estimate_tokens(self, text: str) -> int:
+        return int(len(text) / self.__chars_per_token) + 1
+
+    def batch(self, texts: list[str]) -> list[list[int]]:
+        """Packs texts into requests by estimated token count and returns the original indexes of each request.
+        Texts are sorted by length first, so every request holds texts of similar size. A text that alone exceeds
+        the token limit gets a request of its own."""
+        if not isinstance(texts, list) or not all(isinstance(text, str) for text in texts):
+            raise TypeError("texts must be a list of strings")
+        tokens = [self.estimate_tokens(text) for text in texts]
+        batches, current, current_tokens = [], [], 0
+        for i in sorted(range(len(texts)), key=lambda j: tokens[j]):
+            if current and (current_tokens + tokens[i] > self.__max_tokens_per_request
+                            or len(current) >= self.__max_items_per_request):
+                batches.append(current)
+                current, current_tokens = [], 0
+            current.append(i)
+            current_tokens += tokens[i]
+        if current:
+            batches.append(current)
+        return batches
+
+    @staticmethod
+    def restore_order(batches: list[list[int]], results: list[list]) -> list:
+        """Maps per-request results produced for batch() output back to the original order of the texts"""
+        if len(batches) != len(results):
+            raise ValueError("batches and results must have the same length")
+        ordered = [None] * sum(len(batch) for batch in batches)
+        for batch, batch_results in zip(batches, results):
+            if len(batch) != len(batch_results):
+                raise ValueError("each batch must have exactly one result per text")
+            for i, result in zip(batch, batch_results):
+                ordered[i] = result
+        return ordered
+
+    @staticmethod
+    def restore_rows(batches: list[list[int]], results: list[np.ndarray]) -> np.ndarray:
+        """Stacks per-request result matrices produced for batch() output in the original order of the texts"""
+        if len(batches) != len(results):
+            raise ValueError("batches and results must have the same length")
+        stacked = np.concatenate(results, axis=0)
+        ordered = np.empty_like(stacked)
+        ordered[np.concatenate([np.asarray(batch, dtype=np.int64) for batch in batches])] = stacked
+        return ordered
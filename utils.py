@@ -1,5 +1,6 @@
 from functools import cached_property
-from typing import get_type_hints
+from typing import get_type_hints, Iterable
+import os
 import time
 
 
@@ -8,6 +9,16 @@ def batch_list(items: list[str], batch_size: int) -> list[list[str]]:
     return [items[i:i + batch_size] for i in batches_range]
 
 
+def all_instances_of(items: Iterable, cls: type) -> bool:
+    return all(issubclass(item_type, cls) for item_type in set(map(type, items)))
+
+
+def temp_path_beside(path: str) -> str:
+    """A file name in the directory of path, so the file can later replace path with an atomic rename"""
+    directory = os.path.dirname(os.path.abspath(path))
+    return os.path.join(directory, f".{os.path.basename(path)}.{os.getpid()}.part")
+
+
 def property_typecheck(cls: object, property_name: str, expected_type: type) -> bool:
     property_obj = getattr(cls, property_name)
     if isinstance(property_obj, cached_property):